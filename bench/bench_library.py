@@ -0,0 +1,147 @@
+# Pyap - The Python Audio Player Library
+#
+# Copyright (c) 2012 Joel Griffith
+# Copyright (c) 2005 Joe Wreschnig
+# Copyright (c) 2002 David I. Lehn
+# Copyright (c) 2005-2011 the SQLAlchemy authors and contributors
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+# Rough throughput numbers for writing to the library. Run from the
+# repository root:
+#
+#     python bench/bench_library.py [rows]
+
+import os
+import sys
+import tempfile
+import time
+
+from pyap.audio import Audio, FILE
+from pyap.library import Library
+
+def rows(count, offset=0):
+    for i in range(offset, offset + count):
+        yield {
+            'uri': u'/bench/%08d.mp3' % i,
+            'type': FILE,
+            'artist': u'Artist %d' % (i % 1000),
+            'title': u'Title %d' % i,
+            'album': u'Album %d' % (i % 5000),
+            'track': i % 20,
+            'length': 180 + i % 120,
+            'year': u'%d' % (1960 + i % 60)
+        }
+
+def report(name, count, seconds):
+    print("%-24s %8d rows %8.2fs %10.0f rows/sec" % (
+        name, count, seconds, count / seconds))
+
+def bench_add_audio(library, count):
+    audio = [Audio(row.pop('uri'), **row) for row in rows(count)]
+    start = time.time()
+    library.add_audio(audio)
+    report("add_audio (ORM)", count, time.time() - start)
+
+def bench_bulk_load(library, count):
+    start = time.time()
+    library.bulk_load(rows(count, offset=count))
+    report("bulk_load (insert)", count, time.time() - start)
+
+    start = time.time()
+    library.bulk_load(rows(count, offset=count))
+    report("bulk_load (update)", count, time.time() - start)
+
+def bench_search(library, queries=(u'artist 12', u'title 99', u'alb')):
+    for query in queries:
+        start = time.time()
+        found = library.search(query, limit=20)
+        print("%-24s %8d hits %8.2fms" % (
+            "search %r" % query, len(found), (time.time() - start) * 1000))
+
+def bench_stats(library):
+    start = time.time()
+    counts = {}
+    for audio in library.all_audio():
+        counts[audio.artist] = counts.get(audio.artist, 0) + 1
+    print("%-24s %8d groups %7.2fms" % (
+        "per artist, all_audio", len(counts), (time.time() - start) * 1000))
+
+    start = time.time()
+    rows = library.artist_stats()
+    print("%-24s %8d groups %7.2fms" % (
+        "per artist, artist_stats", len(rows), (time.time() - start) * 1000))
+
+def bench_snapshot(library):
+    uri = tempfile.mktemp('.snapshot')
+    try:
+        start = time.time()
+        library.export_snapshot(uri)
+        count = len(library.all_audio_table())
+        report("export_snapshot", count, time.time() - start)
+
+        start = time.time()
+        snapshot = Library.open_snapshot(uri)
+        print("%-24s %8d rows %8.2fms" % (
+            "open_snapshot", len(snapshot), (time.time() - start) * 1000))
+        start = time.time()
+        for i in range(0, count, max(count // 1000, 1)):
+            snapshot.audio_by_uri(u'/bench/%08d.mp3' % i)
+        print("%-24s %8.2fus per lookup" % (
+            "snapshot.audio_by_uri",
+            (time.time() - start) * 1e6 / min(count, 1000)))
+        snapshot.close()
+    finally:
+        os.remove(uri)
+
+def bench_virtual_playlist(library):
+    playlist = library.virtual_playlist(u'bench')
+    count = len(playlist)
+    start = time.time()
+    for i in range(count):
+        playlist.next()
+    report("virtual playlist, play", count, time.time() - start)
+
+    playlist.set_shuffle(True)
+    plays = min(count, 1000)
+    start = time.time()
+    for i in range(plays):
+        playlist.next()
+    report("virtual playlist, shuffle", plays, time.time() - start)
+
+def bench_smart_playlist(library, count):
+    rule = ['all', [['length', '<', 240], ['year', '>=', u'1990']]]
+    start = time.time()
+    playlist = library.add_smart_playlist(u'bench smart', rule, 'album')
+    report("add_smart_playlist", len(playlist), time.time() - start)
+
+    changes = min(count, 100)
+    library.bulk_load(dict(row, length=200, year=u'2000')
+                      for row in rows(changes))
+    start = time.time()
+    library.refresh_smart_playlist(u'bench smart')
+    report("refresh_smart_playlist", changes, time.time() - start)
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    library = Library()
+    bench_add_audio(library, count)
+    bench_bulk_load(library, count)
+    bench_search(library)
+    bench_stats(library)
+    bench_snapshot(library)
+    bench_virtual_playlist(library)
+    bench_smart_playlist(library, count)
@@ -0,0 +1,70 @@
+# Pyap - The Python Audio Player Library
+#
+# Copyright (c) 2012 Joel Griffith
+# Copyright (c) 2005 Joe Wreschnig
+# Copyright (c) 2002 David I. Lehn
+# Copyright (c) 2005-2011 the SQLAlchemy authors and contributors
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+# Rough numbers for sorting and editing a playlist. Run from the repository root:
+#
+#     python bench/bench_playlist.py [entries]
+
+import sys
+import time
+
+from pyap.audio import Audio, FILE
+from pyap.playlist import Playlist
+
+def playlist(count):
+    audio_list = []
+    for i in range(count):
+        audio_list.append(Audio(
+            u'/bench/%08d.mp3' % i, type=FILE,
+            artist=u'The Artist %d' % (i * 7919 % 1000),
+            title=u'Title %d' % (i * 104729 % count),
+            album=u'Album %d' % (i * 7919 % 5000),
+            track=i % 20, length=180 + i % 120,
+            year=u'%d' % (1960 + i * 7919 % 60)))
+    return Playlist(u'bench', audio_list)
+
+def bench_sort(playlist):
+    for by in ('artist', 'artist', 'album', 'title'):
+        start = time.time()
+        playlist.sort(by)
+        print("%-24s %8d entries %8.2fs" % (
+            "sort %r" % by, len(playlist), time.time() - start))
+
+def bench_edits(playlist, count=500):
+    audio_list = playlist[:count]
+    for name, index in (('front', lambda: 0),
+                        ('end', lambda: len(playlist) - count)):
+        start = time.time()
+        for audio in audio_list:
+            playlist.remove(audio)
+            playlist.insert(index(), audio)
+        print("%-24s %8d entries %8.2fs" % (
+            "remove/insert %s" % name, len(playlist), time.time() - start))
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    start = time.time()
+    entries = playlist(count)
+    print("%-24s %8d entries %8.2fs" % (
+        "build", count, time.time() - start))
+    bench_sort(entries)
+    bench_edits(entries)
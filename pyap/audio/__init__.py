@@ -21,24 +21,55 @@
 # Boston, MA 02111-1307, USA.
 
 import os
+import weakref
 
 from mutagen import File
+from mutagen.easyid3 import EasyID3
+from mutagen.id3 import ID3NoHeaderError
 
-from pyap.util import get_extension, is_audio
+from pyap.util import formats, iter_pool
+from pyap.audio.mpeg import estimate_length, scan_length
 
 FILE = 0
 STREAM = 1
 UNKNOWN = 2
 
-def uri_type(uri):
+def uri_type(uri, sniff=False):
+    """ With sniff, files are told apart by their content rather than
+        their extension (see pyap.util.FormatRegistry.classify) """
     if uri.startswith(r'http://'):
         return STREAM
-    extension = get_extension(uri)
-    if extension and is_audio(extension):
+    result = formats.classify(uri, sniff)
+    if result is not None and result[0] == "audio":
         return FILE
     return UNKNOWN
 
-def audio_info(uri):
+def _tag_info(info, tags):
+    if 'tracknumber' in tags:
+        track = tags['tracknumber'][0]
+        if track.find('/'):
+            track = int(track.split('/')[0])
+        else:
+            track = int(track)
+        info['track'] = track
+
+    if 'date' in tags:
+        info['year'] = unicode(", ".join(tags['date']))
+
+    if 'artist' in tags:
+        info['artist'] = unicode(" & ".join(tags['artist']))
+    
+    if 'title' in tags:
+        info['title'] = unicode(", ".join(tags['title']))
+
+    if 'album' in tags:
+        info['album'] = unicode(", ".join(tags['album']))
+
+def audio_info(uri, fast=False):
+    """ With fast, an MP3's length is worked out from the start of the
+        file alone (see pyap.audio.mpeg.estimate_length) rather than by
+        mutagen, which may read all of it, and info gets a
+        'length_estimated' flag telling whether it's only an estimate """
     info = {
         'length': -1,
         'track': -1,
@@ -47,39 +78,183 @@ def audio_info(uri):
         'title': unicode(os.path.splitext(os.path.basename(uri))[0]),
         'album': u''
     }
+
+    if fast and formats.classify(uri) == ("audio", "mp3"):
+        length, estimated = estimate_length(uri)
+        if length is not None:
+            try:
+                tags = EasyID3(uri)
+            except ID3NoHeaderError:
+                tags = {}
+            info['length'] = int(length)
+            info['length_estimated'] = estimated
+            _tag_info(info, tags)
+            return info
     
     audio_file = File(uri, easy=True)
     if not audio_file:
         return None
 
     info['length'] = int(audio_file.info.length)
-
-    if 'tracknumber' in audio_file:
-        track = audio_file['tracknumber'][0]
-        if track.find('/'):
-            track = int(track.split('/')[0])
-        else:
-            track = int(track)
-        info['track'] = track
-
-    if 'date' in audio_file:
-        info['year'] = unicode(", ".join(audio_file['date']))
-
-    if 'artist' in audio_file:
-        info['artist'] = unicode(" & ".join(audio_file['artist']))
-    
-    if 'title' in audio_file:
-        info['title'] = unicode(", ".join(audio_file['title']))
-
-    if 'album' in audio_file:
-        info['album'] = unicode(", ".join(audio_file['album']))
+    if fast:
+        info['length_estimated'] = False
+    _tag_info(info, audio_file)
 
     return info
 
+def exact_length(uri):
+    """ The length of a file in seconds, counting every frame of an MP3
+        rather than trusting its headers, or None if it isn't audio """
+    if formats.classify(uri) == ("audio", "mp3"):
+        length = scan_length(uri)
+        if length is not None:
+            return int(length)
+    info = audio_info(uri)
+    if info is None:
+        return None
+    return info['length']
+
+_cache = None
+
+def set_cache(cache):
+    """ Installs a cache (see pyap.audio.cache.MetadataCache) that Audio
+        and the bulk readers go through instead of calling audio_info
+        directly. Passing None removes it """
+    global _cache
+    _cache = cache
+
+def get_cache():
+    return _cache
+
+def cached_audio_info(uri):
+    """ audio_info, through the installed cache if there is one """
+    if _cache is None:
+        return audio_info(uri)
+    return _cache.audio_info(uri)
+
+def _audio_info_job(uri, fast=False):
+    # runs in a pool worker, so failures are handed back instead of raised.
+    # estimates aren't cached, the cache is for exact results
+    try:
+        if fast:
+            info = audio_info(uri, fast=True)
+        else:
+            info = cached_audio_info(uri)
+    except Exception as e:
+        return (uri, None, e)
+    if info is None:
+        return (uri, None, Exception("Not an audio file"))
+    return (uri, info, None)
+
+def _fast_audio_info_job(uri):
+    return _audio_info_job(uri, fast=True)
+
+def iter_audio_info(uris, workers=None, threads=False, ordered=True,
+                    chunksize=16, fast=False):
+    """ Runs audio_info over uris in a pool of worker processes (or threads)
+        and yields a (uri, info, error) tuple for each. Results come back in
+        the order of uris if ordered is set, otherwise as they complete.
+        A uri that can't be read only sets its error, the rest of the batch
+        carries on. workers=None uses one worker per CPU, 0 runs inline.
+        fast is passed on to audio_info """
+    job = _fast_audio_info_job if fast else _audio_info_job
+    return iter_pool(job, uris, workers, threads, ordered, chunksize)
+
+def _exact_length_job(uri):
+    try:
+        length = exact_length(uri)
+    except Exception as e:
+        return (uri, None, e)
+    if length is None:
+        return (uri, None, Exception("Not an audio file"))
+    return (uri, length, None)
+
+def iter_exact_lengths(uris, workers=None, threads=False, ordered=True,
+                       chunksize=16):
+    """ Runs exact_length over uris in a pool of workers, like
+        iter_audio_info, yielding a (uri, length, error) tuple for each """
+    return iter_pool(_exact_length_job, uris, workers, threads, ordered,
+                     chunksize)
+
+def materialize_all(audio_list, workers=None, threads=False):
+    """ Reads the tags of every lazily loaded Audio in audio_list in a pool
+        of workers (see iter_audio_info) rather than one at a time on first
+        use. Returns an (audio, error) tuple for each one that failed """
+    pending = {}
+    for audio in audio_list:
+        if audio.is_lazy():
+            pending.setdefault(audio.uri, []).append(audio)
+
+    failed = []
+    for uri, info, error in iter_audio_info(list(pending), workers=workers,
+                                            threads=threads, ordered=False):
+        for audio in pending[uri]:
+            if error is None:
+                audio._lazy = False
+                audio.update(**info)
+            else:
+                failed.append((audio, error))
+    return failed
+
+# tag-derived attributes, which a lazily loaded Audio only reads from the
+# file once one of them is first used
+METADATA = ('artist', 'title', 'album', 'track', 'length', 'year')
+
+# tags shared by many tracks, which every Audio keeps a single copy of
+INTERNED = ('artist', 'album', 'year')
+
+class _Tag(unicode):
+    # plain unicode can't be weakly referenced
+    __slots__ = ('__weakref__',)
+
+    def __reduce__(self):
+        return (intern_tag, (unicode(self),))
+
+# held weakly, so a tag goes once no Audio uses it
+_interned = weakref.WeakValueDictionary()
+
+def intern_tag(value):
+    """ Returns the one copy of value shared by every Audio that has it.
+        Unlike the intern builtin this takes unicode """
+    if not isinstance(value, unicode):
+        return value
+    tag = _interned.get(value)
+    if tag is None:
+        tag = _interned[value] = _Tag(value)
+    return tag
+
+def _metadata_property(name):
+    attribute = '_' + name
+    interned = name in INTERNED
+    def get(self):
+        if self._lazy:
+            self.materialize()
+        return getattr(self, attribute)
+    def set(self, value):
+        # load first so the file's tags don't overwrite this value later
+        if self._lazy:
+            self.materialize()
+        if interned:
+            value = intern_tag(value)
+        setattr(self, attribute, value)
+    return property(get, set)
+
 
 class Audio(object):
     """ Note: Title attribute will never be blank """
-    def __init__(self, uri, **kwargs):
+    # instances loaded by the library don't go through __init__
+    _lazy = False
+
+    artist = _metadata_property('artist')
+    title = _metadata_property('title')
+    album = _metadata_property('album')
+    track = _metadata_property('track')
+    length = _metadata_property('length')
+    year = _metadata_property('year')
+
+    def __init__(self, uri, lazy=False, **kwargs):
+        """ A lazy Audio only records its uri and type, its tags are read
+            the first time any of METADATA is used (or by materialize_all) """
         self.type = kwargs['type'] if 'type' in kwargs else UNKNOWN
         self.artist = kwargs['artist'] if 'artist' in kwargs else u''
         self.title = kwargs['title'] if 'title' in kwargs else u''
@@ -98,16 +273,33 @@ class Audio(object):
 
             if not kwargs:
                 # analyze the track ourselves if no info was given
-                info = audio_info(self.uri)
-                if info is None:
-                    raise Exception("Not an audio file")
-                self.update(**info)
+                if lazy:
+                    self._lazy = True
+                else:
+                    info = cached_audio_info(self.uri)
+                    if info is None:
+                        raise Exception("Not an audio file")
+                    self.update(**info)
         elif self.is_stream():
             if not self.title:
                 self.title = "Stream: %s" % self.uri
 
         self.player = None
 
+    def is_lazy(self):
+        """ Whether the tags have yet to be read """
+        return self._lazy
+
+    def materialize(self):
+        """ Reads the tags of a lazily loaded Audio now """
+        if not self._lazy:
+            return
+        info = cached_audio_info(self.uri)
+        if info is None:
+            raise Exception("Not an audio file")
+        self._lazy = False
+        self.update(**info)
+
     def update(self, **kwargs):
         if 'length' in kwargs:
             self.length = kwargs['length']
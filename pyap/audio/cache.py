@@ -0,0 +1,158 @@
+# Pyap - The Python Audio Player Library
+#
+# Copyright (c) 2012 Joel Griffith
+# Copyright (c) 2005 Joe Wreschnig
+# Copyright (c) 2002 David I. Lehn
+# Copyright (c) 2005-2011 the SQLAlchemy authors and contributors
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import os
+import json
+import sqlite3
+import threading
+import time
+
+from pyap.audio import audio_info
+from pyap.util import fingerprint
+
+class MetadataCache(object):
+    """ A persistent cache of audio_info results backed by a SQLite file.
+        Entries are keyed by path and only hit while the file's mtime and
+        size are unchanged. Once more than max_entries are stored, the least
+        recently used ones are evicted. Install it with pyap.audio.set_cache
+        to have every Audio go through it.
+
+        Hits don't write anything, when each entry was last used is kept in
+        memory and written touch_batch at a time, before evicting and on
+        close """
+    def __init__(self, uri, max_entries=100000, touch_batch=1000):
+        self.uri = uri
+        self.max_entries = max_entries
+        self.touch_batch = touch_batch
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = None
+        self._pid = None
+        self._count = None
+        self._touched = {}
+
+    def _connect(self):
+        # connections don't survive a fork into pool workers, so each
+        # process opens its own
+        if self._connection is None or self._pid != os.getpid():
+            connection = sqlite3.connect(self.uri, timeout=30,
+                                         isolation_level=None,
+                                         check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS audio_info ("
+                               "uri TEXT PRIMARY KEY, mtime REAL, "
+                               "size INTEGER, info TEXT, used REAL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS audio_info_used "
+                               "ON audio_info (used)")
+            self._connection = connection
+            self._pid = os.getpid()
+            self._count = None
+        return self._connection
+
+    def audio_info(self, uri):
+        """ Same as pyap.audio.audio_info, but only reads the file if it
+            isn't cached or changed since it was cached """
+        try:
+            mtime, size, inode = fingerprint(uri)
+        except OSError:
+            return audio_info(uri)
+
+        with self._lock:
+            connection = self._connect()
+            row = connection.execute("SELECT mtime, size, info FROM audio_info "
+                                     "WHERE uri = ?", (uri,)).fetchone()
+            if row is not None and row[0] == mtime and row[1] == size:
+                self._touched[uri] = time.time()
+                if len(self._touched) >= self.touch_batch:
+                    self._flush()
+                self.hits += 1
+                return json.loads(row[2])
+            self.misses += 1
+
+        info = audio_info(uri)
+
+        with self._lock:
+            connection = self._connect()
+            connection.execute("INSERT OR REPLACE INTO audio_info "
+                               "VALUES (?, ?, ?, ?, ?)",
+                               (uri, mtime, size, json.dumps(info),
+                                time.time()))
+            if row is None:
+                self._added()
+        return info
+
+    def _flush(self):
+        # write out when the entries hit since the last flush were used
+        if self._touched:
+            connection = self._connect()
+            connection.execute("BEGIN")
+            connection.executemany("UPDATE audio_info SET used = ? "
+                                   "WHERE uri = ?",
+                                   [(used, uri) for uri, used
+                                    in self._touched.items()])
+            connection.execute("COMMIT")
+            self._touched.clear()
+
+    def _added(self):
+        connection = self._connection
+        if self._count is None:
+            self._count = connection.execute("SELECT COUNT(*) "
+                                             "FROM audio_info").fetchone()[0]
+        else:
+            self._count += 1
+        if self._count > self.max_entries:
+            # evict a tenth more than needed so we don't evict on every add
+            excess = self._count - self.max_entries + self.max_entries // 10
+            self._flush()
+            connection.execute("DELETE FROM audio_info WHERE uri IN ("
+                               "SELECT uri FROM audio_info "
+                               "ORDER BY used LIMIT ?)", (excess,))
+            self._count = connection.execute("SELECT COUNT(*) "
+                                             "FROM audio_info").fetchone()[0]
+
+    def __len__(self):
+        with self._lock:
+            return self._connect().execute("SELECT COUNT(*) "
+                                           "FROM audio_info").fetchone()[0]
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return float(self.hits) / lookups
+
+    def clear(self):
+        with self._lock:
+            self._connect().execute("DELETE FROM audio_info")
+            self._touched.clear()
+            self._count = 0
+            self.hits = 0
+            self.misses = 0
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._flush()
+                self._connection.close()
+            self._connection = None
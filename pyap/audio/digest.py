@@ -0,0 +1,186 @@
+# Pyap - The Python Audio Player Library
+#
+# Copyright (c) 2012 Joel Griffith
+# Copyright (c) 2005 Joe Wreschnig
+# Copyright (c) 2002 David I. Lehn
+# Copyright (c) 2005-2011 the SQLAlchemy authors and contributors
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import hashlib
+import mmap
+import os
+import struct
+
+from pyap.util import iter_pool
+
+# bytes hashed per read, so a big file never sits in memory whole
+CHUNK_SIZE = 1 << 20
+
+def _syncsafe(data):
+    # ID3v2 sizes use 7 bits per byte
+    size = 0
+    for byte in bytearray(data):
+        size = (size << 7) | (byte & 0x7f)
+    return size
+
+def skip_id3v2(data, start, end):
+    """ The offset of the first byte after any ID3v2 tags at start """
+    while end - start >= 10 and data[start:start+3] == b'ID3':
+        header = bytearray(data[start:start+10])
+        size = 10 + _syncsafe(data[start+6:start+10])
+        if header[5] & 0x10:
+            # a footer follows the tag
+            size += 10
+        start += size
+    return start
+
+def strip_trailing_tags(data, start, end):
+    """ The offset just past the last byte before any ID3v1, APEv2 and
+        Lyrics3v2 tags at the end of data[start:end], which can come in any
+        order """
+    while True:
+        if end - start >= 128 and data[end-128:end-125] == b'TAG':
+            end -= 128
+        elif end - start >= 32 and data[end-32:end-24] == b'APETAGEX':
+            size = struct.unpack('<I', data[end-20:end-16])[0]
+            flags = struct.unpack('<I', data[end-12:end-8])[0]
+            if flags & 0x80000000:
+                # the tag has a header as well as a footer
+                size += 32
+            if not 32 <= size <= end - start:
+                # a corrupt footer, so leave the rest in the payload
+                return end
+            end -= size
+        elif (end - start >= 15 and data[end-9:end] == b'LYRICS200' and
+              data[end-15:end-9].isdigit()):
+            end -= 15 + int(data[end-15:end-9])
+        else:
+            return end
+
+def _flac_ranges(data, start, end):
+    position = start + 4
+    while position + 4 <= end:
+        header = bytearray(data[position:position+4])
+        position += 4 + ((header[1] << 16) | (header[2] << 8) | header[3])
+        if header[0] & 0x80:
+            # the last metadata block
+            break
+    return [(position, strip_trailing_tags(data, position, end))]
+
+def _ogg_ranges(data, start, end):
+    # header packets (including comments) sit in pages with a granule
+    # position of 0. only the bodies of later pages are hashed since their
+    # headers carry sequence numbers and checksums that retagging shifts
+    ranges = []
+    position = start
+    while position + 27 <= end and data[position:position+4] == b'OggS':
+        granule = struct.unpack('<q', data[position+6:position+14])[0]
+        segments = bytearray(data[position+26:position+27])[0]
+        table = bytearray(data[position+27:position+27+segments])
+        body = position + 27 + segments
+        position = body + sum(table)
+        if granule != 0:
+            ranges.append((body, min(position, end)))
+    return ranges
+
+def _mp4_ranges(data, start, end):
+    # only the media data atoms, tags live in moov
+    ranges = []
+    position = start
+    while position + 8 <= end:
+        size, kind = struct.unpack('>I4s', data[position:position+8])
+        header = 8
+        if size == 1:
+            size = struct.unpack('>Q', data[position+8:position+16])[0]
+            header = 16
+        elif size == 0:
+            size = end - position
+        if size < header:
+            break
+        if kind == b'mdat':
+            ranges.append((position + header, min(position + size, end)))
+        position += size
+    return ranges
+
+def _riff_ranges(data, start, end):
+    ranges = []
+    position = start + 12
+    while position + 8 <= end:
+        kind, size = struct.unpack('<4sI', data[position:position+8])
+        if kind == b'data':
+            ranges.append((position + 8, min(position + 8 + size, end)))
+        position += 8 + size + (size & 1)
+    return ranges
+
+def payload_ranges(data, size):
+    """ The (start, end) byte ranges of data, a whole file as a string or
+        mmap, that hold audio rather than tags. ID3, APE and Lyrics3 tags,
+        FLAC metadata blocks, Ogg header pages, MP4 atoms other than mdat
+        and RIFF chunks other than data are left out """
+    start = skip_id3v2(data, 0, size)
+    magic = data[start:start+12]
+    ranges = None
+    if magic[:4] == b'fLaC':
+        ranges = _flac_ranges(data, start, size)
+    elif magic[:4] == b'OggS':
+        ranges = _ogg_ranges(data, start, size)
+    elif magic[4:8] == b'ftyp':
+        ranges = _mp4_ranges(data, start, size)
+    elif magic[:4] == b'RIFF' and magic[8:12] == b'WAVE':
+        ranges = _riff_ranges(data, start, size)
+    else:
+        ranges = [(start, strip_trailing_tags(data, start, size))]
+    ranges = [(s, e) for s, e in ranges if 0 <= s < e <= size]
+    if not ranges:
+        # nothing recognisable, so the whole file stands for its audio
+        return [(0, size)]
+    return ranges
+
+def payload_hash(uri):
+    """ The SHA-1 hex digest of the audio in a file, ignoring its tags, so
+        that copies of a track hash the same however they're tagged """
+    digest = hashlib.sha1()
+    file = open(uri, 'rb')
+    try:
+        size = os.fstat(file.fileno()).st_size
+        if size == 0:
+            return digest.hexdigest()
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for start, end in payload_ranges(data, size):
+                for offset in range(start, end, CHUNK_SIZE):
+                    digest.update(data[offset:min(offset + CHUNK_SIZE, end)])
+        finally:
+            data.close()
+    finally:
+        file.close()
+    return digest.hexdigest()
+
+def _payload_hash_job(uri):
+    # runs in a pool worker, so failures are handed back instead of raised
+    try:
+        return (uri, payload_hash(uri), None)
+    except Exception as e:
+        return (uri, None, e)
+
+def iter_payload_hashes(uris, workers=None, threads=False, ordered=True,
+                        chunksize=16):
+    """ Runs payload_hash over uris in a pool of workers (see
+        pyap.util.iter_pool) and yields a (uri, hash, error) tuple for
+        each """
+    return iter_pool(_payload_hash_job, uris, workers, threads, ordered,
+                     chunksize)
@@ -0,0 +1,194 @@
+# Pyap - The Python Audio Player Library
+#
+# Copyright (c) 2012 Joel Griffith
+# Copyright (c) 2005 Joe Wreschnig
+# Copyright (c) 2002 David I. Lehn
+# Copyright (c) 2005-2011 the SQLAlchemy authors and contributors
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import mmap
+import os
+import struct
+
+from pyap.audio.digest import skip_id3v2, strip_trailing_tags
+
+# how much of a file estimate_length reads, past any ID3v2 tag
+PREFIX_SIZE = 64 * 1024
+
+# kbps by (version is 1, layer) and bitrate index
+_BITRATES = {
+    (True, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384,
+                416, 448),
+    (True, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256,
+                320, 384),
+    (True, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256,
+                320),
+    (False, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192,
+                 224, 256),
+    (False, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144,
+                 160)
+}
+_BITRATES[(False, 3)] = _BITRATES[(False, 2)]
+
+# by version bits, 1 is reserved
+_SAMPLE_RATES = {0: (11025, 12000, 8000), 2: (22050, 24000, 16000),
+                 3: (44100, 48000, 32000)}
+
+class FrameHeader(object):
+    """ The fields of an MPEG audio frame header that matter for timing """
+    def __init__(self, version, layer, bitrate, sample_rate, padding, mono):
+        self.version = version
+        self.layer = layer
+        self.bitrate = bitrate
+        self.sample_rate = sample_rate
+        self.padding = padding
+        self.mono = mono
+        if layer == 1:
+            self.samples = 384
+        elif layer == 3 and version != 3:
+            self.samples = 576
+        else:
+            self.samples = 1152
+        slot = 4 if layer == 1 else 1
+        self.size = ((self.samples // 8 * bitrate * 1000 // sample_rate //
+                      slot + padding) * slot)
+
+    def side_info_size(self):
+        # layer III side information, between the header and a Xing tag
+        if self.version == 3:
+            return 17 if self.mono else 32
+        return 9 if self.mono else 17
+
+def parse_header(data, offset=0):
+    """ Returns the FrameHeader of the frame at offset, or None if there
+        isn't a valid one there. Free-format frames aren't supported """
+    if len(data) < offset + 4:
+        return None
+    header = struct.unpack('>I', data[offset:offset+4])[0]
+    if header >> 21 != 0x7ff:
+        return None
+    version = (header >> 19) & 3
+    layer = 4 - ((header >> 17) & 3)
+    bitrate_index = (header >> 12) & 0xf
+    rate_index = (header >> 10) & 3
+    if (version == 1 or layer == 4 or bitrate_index in (0, 15) or
+        rate_index == 3):
+        return None
+    return FrameHeader(version, layer,
+                       _BITRATES[(version == 3, layer)][bitrate_index],
+                       _SAMPLE_RATES[version][rate_index],
+                       (header >> 9) & 1, (header >> 6) & 3 == 3)
+
+def find_frame(data, start=0):
+    """ The offset and FrameHeader of the first frame at or after start
+        that's followed by another one, which rules out most false syncs.
+        Returns (None, None) if there's none in data """
+    position = data.find(b'\xff', start)
+    while position != -1:
+        header = parse_header(data, position)
+        if header is not None:
+            following = position + header.size
+            if (following + 4 > len(data) or
+                parse_header(data, following) is not None):
+                return (position, header)
+        position = data.find(b'\xff', position + 1)
+    return (None, None)
+
+def _frame_count(data, offset, header):
+    # a Xing (or Info) or VBRI tag in the first frame counts the frames
+    xing = offset + 4 + header.side_info_size()
+    if data[xing:xing+4] in (b'Xing', b'Info'):
+        flags = struct.unpack('>I', data[xing+4:xing+8])[0]
+        if flags & 1:
+            return struct.unpack('>I', data[xing+8:xing+12])[0]
+    vbri = offset + 36
+    if data[vbri:vbri+4] == b'VBRI':
+        return struct.unpack('>I', data[vbri+14:vbri+18])[0]
+    return None
+
+def estimate_length(uri, prefix_size=PREFIX_SIZE):
+    """ Works out the length in seconds of an MPEG audio file from the
+        start of the file alone, for slow storage. Returns a (length,
+        estimated) tuple: exact if the first frame counts the frames (a
+        Xing, Info or VBRI tag), otherwise estimated from the first
+        frame's bitrate, which is only right for constant bitrate files.
+        Returns (None, None) if no frame turns up """
+    file = open(uri, 'rb')
+    try:
+        size = os.fstat(file.fileno()).st_size
+        # skip ID3v2 tags by their headers, without reading them
+        start = 0
+        tag = file.read(10)
+        while len(tag) == 10 and tag[:3] == b'ID3':
+            start += skip_id3v2(tag, 0, 10)
+            file.seek(start)
+            tag = file.read(10)
+        file.seek(start)
+        data = file.read(prefix_size)
+        end = size
+        if size - start > 128:
+            file.seek(-128, os.SEEK_END)
+            if file.read(3) == b'TAG':
+                end -= 128
+    finally:
+        file.close()
+
+    offset, header = find_frame(data)
+    if header is None:
+        return (None, None)
+    frames = _frame_count(data, offset, header)
+    if frames is not None:
+        return (float(frames * header.samples) / header.sample_rate, False)
+    audio_size = end - start - offset
+    return (audio_size * 8.0 / (header.bitrate * 1000), True)
+
+def scan_length(uri):
+    """ The exact length in seconds of an MPEG audio file, by walking every
+        frame up to any trailing tags. A corrupt frame is skipped by
+        looking for the next one. Reads the whole file; see
+        estimate_length for a quick answer. Returns None if no frame turns
+        up """
+    file = open(uri, 'rb')
+    try:
+        size = os.fstat(file.fileno()).st_size
+        if size == 0:
+            return None
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            offset, header = find_frame(data, skip_id3v2(data, 0, size))
+            if header is None:
+                return None
+            if _frame_count(data, offset, header) is not None:
+                # the Xing frame is silent, it only holds the tag
+                offset += header.size
+            end = strip_trailing_tags(data, offset, size)
+            samples = 0.0
+            sample_rate = header.sample_rate
+            while offset + 4 <= end:
+                header = parse_header(data, offset)
+                if header is None:
+                    # garbage, the audio picks up again at the next frame
+                    offset, header = find_frame(data, offset + 1)
+                    if header is None or offset + 4 > end:
+                        break
+                samples += header.samples
+                offset += header.size
+        finally:
+            data.close()
+    finally:
+        file.close()
+    return samples / sample_rate
@@ -0,0 +1,230 @@
+# Pyap - The Python Audio Player Library
+#
+# Copyright (c) 2012 Joel Griffith
+# Copyright (c) 2005 Joe Wreschnig
+# Copyright (c) 2002 David I. Lehn
+# Copyright (c) 2005-2011 the SQLAlchemy authors and contributors
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+from array import array
+
+from pyap.audio import Audio, FILE
+
+class _DictionaryColumn(object):
+    """ A column of strings kept as integer codes into a list of the
+        distinct values, so a string repeated on many rows is stored once """
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+        self.column = array('i')
+
+    def encode(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def append(self, value):
+        self.column.append(self.encode(value))
+
+    def insert(self, index, value):
+        self.column.insert(index, self.encode(value))
+
+    def __getitem__(self, index):
+        return self.values[self.column[index]]
+
+    def __setitem__(self, index, value):
+        self.column[index] = self.encode(value)
+
+    def __delitem__(self, index):
+        del self.column[index]
+
+    def __len__(self):
+        return len(self.column)
+
+
+class AudioTable(object):
+    """ A compact, column-oriented list of audio. Rather than a full Audio
+        object per track, uris and titles are kept in plain lists, artists,
+        albums and years are dictionary encoded and the integer columns
+        live in arrays. Indexing hands out a new Audio built from the row,
+        so changes to it aren't written back; assign it to the index
+        instead. Supports the list operations a Playlist uses, so one can
+        hold an AudioTable. in and count go by uri through a count of the
+        rows of every uri """
+    def __init__(self, audio_list=()):
+        self._clear()
+        self.extend(audio_list)
+
+    def _clear(self):
+        self._uris = []
+        self._types = array('b')
+        self._artists = _DictionaryColumn()
+        self._titles = []
+        self._albums = _DictionaryColumn()
+        self._tracks = array('i')
+        self._lengths = array('i')
+        self._years = _DictionaryColumn()
+        self._counts = {}
+        # the first row of every uri, worked out when index needs it and
+        # dropped once rows move
+        self._first = None
+
+    def _columns(self):
+        return (self._uris, self._types, self._artists, self._titles,
+                self._albums, self._tracks, self._lengths, self._years)
+
+    def _counted(self, uri, change):
+        count = self._counts.get(uri, 0) + change
+        if count:
+            self._counts[uri] = count
+        else:
+            del self._counts[uri]
+
+    def append_row(self, uri, type=FILE, artist=u'', title=u'', album=u'',
+                   track=-1, length=-1, year=u''):
+        """ Appends a row without building an Audio first """
+        self.insert_row(len(self), uri, type, artist, title, album, track,
+                        length, year)
+
+    def insert_row(self, index, uri, type=FILE, artist=u'', title=u'',
+                   album=u'', track=-1, length=-1, year=u''):
+        """ Inserts a row before index, like list.insert """
+        if index < 0:
+            index = max(len(self) + index, 0)
+        index = min(index, len(self))
+        if index == len(self):
+            if self._first is not None:
+                self._first.setdefault(uri, index)
+        else:
+            self._first = None
+        self._uris.insert(index, uri)
+        self._types.insert(index, type)
+        self._artists.insert(index, artist or u'')
+        self._titles.insert(index, title or u'')
+        self._albums.insert(index, album or u'')
+        self._tracks.insert(index, -1 if track is None else track)
+        self._lengths.insert(index, -1 if length is None else length)
+        self._years.insert(index, year or u'')
+        self._counted(uri, 1)
+
+    def append(self, audio):
+        self.insert(len(self), audio)
+
+    def insert(self, index, audio):
+        self.insert_row(index, audio.uri, audio.type, audio.artist,
+                        audio.title, audio.album, audio.track, audio.length,
+                        audio.year)
+
+    def extend(self, audio_list):
+        for audio in audio_list:
+            self.append(audio)
+
+    def row(self, index):
+        """ Returns the (uri, type, artist, title, album, track, length, year)
+            at index """
+        return (self._uris[index], self._types[index], self._artists[index],
+                self._titles[index], self._albums[index], self._tracks[index],
+                self._lengths[index], self._years[index])
+
+    def __len__(self):
+        return len(self._uris)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            table = AudioTable()
+            for i in range(*index.indices(len(self))):
+                table.append_row(*self.row(i))
+            return table
+        uri, type, artist, title, album, track, length, year = self.row(index)
+        return Audio(uri, type=type, artist=artist, title=title, album=album,
+                     track=track, length=length, year=year)
+
+    def __setitem__(self, index, audio):
+        if isinstance(index, slice):
+            # rows are copied out before any are replaced, audio may be self
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError("Extended slices aren't supported")
+            rows = [self.row(i) for i in range(start)]
+            rows.extend((a.uri, a.type, a.artist, a.title, a.album, a.track,
+                         a.length, a.year) for a in audio)
+            rows.extend(self.row(i) for i in range(max(start, stop),
+                                                    len(self)))
+            self._clear()
+            for row in rows:
+                self.append_row(*row)
+            return
+        if index < 0:
+            index += len(self)
+        if self._uris[index] != audio.uri:
+            self._counted(self._uris[index], -1)
+            self._counted(audio.uri, 1)
+            self._first = None
+        self._uris[index] = audio.uri
+        self._types[index] = audio.type
+        self._artists[index] = audio.artist
+        self._titles[index] = audio.title
+        self._albums[index] = audio.album
+        self._tracks[index] = audio.track
+        self._lengths[index] = audio.length
+        self._years[index] = audio.year
+
+    def __delitem__(self, index):
+        if index < 0:
+            index += len(self)
+        uri = self._uris[index]
+        if self._first is not None and (index < len(self) - 1 or
+                                        self._first[uri] == index):
+            self._first = None
+        self._counted(uri, -1)
+        for column in self._columns():
+            del column[index]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __contains__(self, audio):
+        return audio.uri in self._counts
+
+    def index(self, audio):
+        """ Returns the first index of audio, going by its uri """
+        if audio.uri not in self._counts:
+            raise ValueError("%r is not in the table" % (audio,))
+        if self._first is None:
+            first = {}
+            for i, uri in enumerate(self._uris):
+                first.setdefault(uri, i)
+            self._first = first
+        return self._first[audio.uri]
+
+    def count(self, audio):
+        return self._counts.get(audio.uri, 0)
+
+    def pop(self, index=-1):
+        audio = self[index]
+        del self[index]
+        return audio
+
+    def reverse(self):
+        self._first = None
+        for column in (self._uris, self._types, self._titles, self._tracks,
+                       self._lengths, self._artists.column,
+                       self._albums.column, self._years.column):
+            column.reverse()
@@ -20,77 +20,1147 @@
 # Free Software Foundation, Inc., 59 Temple Place - Suite 330,
 # Boston, MA 02111-1307, USA.
 
-from pyap.library.db import setup
-from pyap.audio import Audio
+import os
+import threading
+import cPickle
 
-Session = None
+from sqlalchemy import select, bindparam, func, and_, or_, text, exists
+from sqlalchemy.orm.attributes import instance_state
+
+from pyap.library.db import setup, audio_table, playlist_table
+from pyap.library.db import audio_playlist_table, ORDERS, POSITION_GAP
+from pyap.library import search, snapshot, stats, smart
+from pyap.library.cache import ResultCache
+from pyap.library.writer import WriteBehind
+from pyap.library.watcher import LibraryWatcher
+from pyap.audio import Audio, FILE, METADATA, uri_type, iter_audio_info
+from pyap.audio import iter_exact_lengths
+from pyap.audio.table import AudioTable
+from pyap.audio.digest import iter_payload_hashes
+from pyap.playlist import Playlist
+from pyap.playlist.virtual import VirtualPlaylist
+from pyap.util import fingerprint, iter_files
+
+# what bulk_load fills in for columns a row leaves out, same as Audio
+_audio_defaults = (
+    ('artist', u''),
+    ('title', u''),
+    ('album', u''),
+    ('track', -1),
+    ('length', -1),
+    ('length_estimated', False),
+    ('year', u''),
+    ('mtime', None),
+    ('size', None),
+    ('inode', None)
+)
+
+def _audio_row(audio):
+    """ The audio table row for an Audio that isn't in the library """
+    row = dict((name, getattr(audio, name)) for name in METADATA)
+    row['uri'], row['type'] = audio.uri, audio.type
+    return row
+
+def _file_uri(uri):
+    # uris as they're stored: files by absolute path
+    if uri_type(uri) == FILE:
+        return unicode(os.path.abspath(uri))
+    return unicode(uri)
+
+def _detached(value):
+    """ A copy of a query result that belongs to no session, for caching.
+        Pickling keeps each object's identity so it can be merged back """
+    return cPickle.loads(cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL))
+
+def _merged(session, value):
+    """ A cached result merged into session, without loading anything """
+    if value is None:
+        return None
+    if isinstance(value, list):
+        return [session.merge(v, load=False) for v in value]
+    merged = session.merge(value, load=False)
+    if isinstance(value, Playlist):
+        # the audio of a playlist isn't mapped, so merge doesn't copy it
+        fresh = not hasattr(merged, '_audio_list')
+        merged._audio_list = _merged(session, value._audio_list)
+        if fresh:
+            merged.reset()
+        else:
+            merged._reorder()
+    return merged
+
+def _persisted_id(audio):
+    """ The id of audio loaded from the library, None for other audio,
+        without loading anything """
+    key = instance_state(audio).key
+    return key[1][0] if key is not None else None
+
+def _after(columns, key):
+    """ The keyset condition for rows sorting after key, a tuple of values
+        for columns in ascending order. SQLite sorts NULLs first """
+    clauses = []
+    for i, (column, value) in enumerate(zip(columns, key)):
+        equal = [c == v if v is not None else c == None
+                 for c, v in zip(columns[:i], key[:i])]
+        if value is None:
+            greater = column != None
+        else:
+            greater = column > value
+        clauses.append(and_(*(equal + [greater])))
+    if key[0] is None:
+        return or_(*clauses)
+    # implied by the rest, but lets SQLite seek into the index rather than
+    # step through every row before key
+    return and_(columns[0] >= key[0], or_(*clauses))
 
 class Library(object):
-    def __init__(self, uri=None):
-        """ Not specifying a URI results in an in-memory library """
-        global Session
-        if Session is None:
-            Session = setup(uri)
+    def __init__(self, uri=None, echo=False, pragmas=None, cache_size=None,
+                 cache_ttl=None, **engine_options):
+        """ Not specifying a URI results in an in-memory library, which
+            only the thread that made it can use (so no write_behind or
+            watch either). Every library has its own engine (see
+            pyap.library.db.setup for the options) and each thread gets its
+            own session from Session. A cache_size caches that many results
+            of audio_by_index, audio_by_uri, all_audio_table and
+            playlist_by_name for up to cache_ttl seconds (see
+            pyap.library.cache.ResultCache) """
+        self.uri = uri
+        self.Session = setup(uri, echo=echo, pragmas=pragmas,
+                             **engine_options)
+        # False if SQLite was built without FTS5
+        self.searchable = search.installed(self.Session.bind)
+        self.cache = None
+        if cache_size:
+            self.cache = ResultCache(cache_size, cache_ttl)
+        # invalidations wait for the thread that wrote to commit
+        self._local = threading.local()
+
+    def close_session(self):
+        """ Discards the calling thread's session, say at the end of a
+            request. Objects loaded through it become detached """
+        self.Session.remove()
+
+    def close(self):
+        """ Closes the calling thread's session and every pooled
+            connection """
+        engine = self.Session.bind
+        self.Session.remove()
+        engine.dispose()
+
+    def export_snapshot(self, uri):
+        """ Writes the audio and playlists of the library to a snapshot
+            file, which open_snapshot reads back """
+        snapshot.write(self.Session(), uri)
+
+    @staticmethod
+    def open_snapshot(uri):
+        """ Opens a snapshot written by export_snapshot as a read-only
+            pyap.library.snapshot.Snapshot, without a database """
+        return snapshot.Snapshot(uri)
+
+    def write_behind(self, max_batch=500, max_delay=0.05):
+        """ Returns a WriteBehind (see pyap.library.writer) that commits
+            writes to this library in batches from a thread of its own """
+        return WriteBehind(self, max_batch, max_delay)
+
+    def _cached(self, key, load):
+        session = self.Session()
+        if self.cache is None:
+            return load(session)
+        found, value = self.cache.get(key)
+        if found:
+            return _merged(session, value)
+        generation = self.cache.generation
+        value = load(session)
+        self.cache.put(key, _detached(value), generation)
+        return value
+
+    def _invalidate(self, kind, arg=None):
+        """ Queues the cached results that a write changes: ('audio', uris)
+            for audio added, changed or removed (uris=None for any) and
+            ('playlist', name) for a playlist. They're dropped by _commit """
+        if self.cache is not None:
+            self._queued('invalidations').append((kind, arg))
+
+    def _queued(self, name):
+        # what the calling thread has waiting on its next commit
+        queue = getattr(self._local, name, None)
+        if queue is None:
+            queue = []
+            setattr(self._local, name, queue)
+        return queue
+
+    def _commit(self, session, then=None):
+        """ Commits, then drops the cached results the transaction changed
+            and calls then. Inside a write-behind batch (see
+            pyap.library.writer) the session is only flushed and the rest
+            waits for the batch to commit """
+        if then is not None:
+            self._queued('after_commit').append(then)
+        if getattr(self._local, 'batch', False):
+            session.flush()
+            return
+        session.commit()
+        self._after_commit()
+
+    def _after_commit(self):
+        # everything runs even if something fails, the first error is
+        # raised once it has
+        invalidations, self._local.invalidations = self._queued(
+            'invalidations'), []
+        after_commit, self._local.after_commit = self._queued(
+            'after_commit'), []
+        actions = [lambda kind=kind, arg=arg: self._drop_cached(kind, arg)
+                   for kind, arg in invalidations] + after_commit
+        error = None
+        for action in actions:
+            try:
+                action()
+            except Exception as e:
+                error = error or e
+        if error is not None:
+            raise error
+
+    def _rollback(self, session):
+        session.rollback()
+        self._local.invalidations = []
+        self._local.after_commit = []
+
+    def _drop_cached(self, kind, arg):
+        cache = self.cache
+        if kind == 'playlist':
+            cache.invalidate(('playlist_by_name', arg))
+            return
+        cache.invalidate_kind('all_audio_table')
+        if arg is None:
+            for kind in ('audio_by_uri', 'audio_by_index',
+                         'playlist_by_name'):
+                cache.invalidate_kind(kind)
+            return
+        uris = set(arg)
+        for uri in uris:
+            cache.invalidate(('audio_by_uri', uri))
+        # a cached miss by index may be the id a new audio got
+        cache.invalidate_kind('audio_by_index',
+                              lambda a: a is None or a.uri in uris)
+        cache.invalidate_kind('playlist_by_name', lambda p:
+            p is not None and any(a.uri in uris for a in p._audio_list))
 
     def audio_by_index(self, index):
-        return Session().query(Audio).filter_by(id=index).first()
+        return self._cached(('audio_by_index', index), lambda session:
+            session.query(Audio).filter_by(id=index).first())
 
     def audio_by_uri(self, uri):
-        return Session().query(Audio).filter_by(uri=uri).first()
+        uri = _file_uri(uri)
+        return self._cached(('audio_by_uri', uri), lambda session:
+            session.query(Audio).filter_by(uri=uri).first())
 
     def all_audio(self):
-        return Session().query(Audio).order_by(Audio.id).all()
+        """ Every audio in the library, by id. This isn't cached, copying
+            and merging back the whole table costs more than the query """
+        return self.Session().query(Audio).order_by(Audio.id).all()
+
+    def iter_audio(self, order='library', page_size=500, **filters):
+        """ Yields the audio matching filters (see audio_page) sorted by
+            order, one of the keys of pyap.library.db.ORDERS. Rows are read
+            page_size at a time by keyset, so memory stays flat however big
+            the library is, as long as the caller doesn't hold on to them """
+        after = None
+        while True:
+            page, after = self.audio_page(page_size, after, order, **filters)
+            for audio in page:
+                yield audio
+            if after is None:
+                return
+
+    def audio_page(self, limit=50, after=None, order='library', artist=None,
+                   album=None, year=None, min_length=None, max_length=None,
+                   offset=None):
+        """ Returns up to limit audio sorted by order, starting after the
+            key returned with the previous page (None for the first), as an
+            (audio, key) tuple. key is None on the last page. artist, album
+            and year match exactly; min_length and max_length bound length
+            in seconds, inclusive. offset skips that many audio first, which
+            SQLite has to step through one by one, so prefer after """
+        if order not in ORDERS:
+            raise ValueError("Unknown order '%s'" % order)
+        columns = [audio_table.c[name] for name in ORDERS[order]]
+        query = self._filtered(self.Session().query(Audio), artist, album,
+                               year, min_length, max_length)
+        if after is not None:
+            query = query.filter(_after(columns, after))
+        query = query.order_by(*columns).limit(limit)
+        if offset:
+            query = query.offset(offset)
+        page = query.all()
+        if not page or len(page) < limit:
+            return (page, None)
+        last = page[-1]
+        return (page, tuple(getattr(last, name) for name in ORDERS[order]))
+
+    def count_audio(self, artist=None, album=None, year=None,
+                    min_length=None, max_length=None):
+        """ The number of audio matching the filters of audio_page """
+        query = self.Session().query(func.count(audio_table.c.id))
+        return self._filtered(query, artist, album, year, min_length,
+                              max_length).scalar()
+
+    def _filtered(self, query, artist, album, year, min_length, max_length):
+        for name, value in (('artist', artist), ('album', album),
+                            ('year', year)):
+            if value is not None:
+                query = query.filter(audio_table.c[name] == value)
+        if min_length is not None:
+            query = query.filter(audio_table.c.length >= min_length)
+        if max_length is not None:
+            query = query.filter(audio_table.c.length <= max_length)
+        return query
+
+    def virtual_playlist(self, name, order='library', **kwargs):
+        """ A playlist of the audio matching the filters of audio_page,
+            sorted by order, that reads them from the library as it plays
+            (see pyap.playlist.virtual.VirtualPlaylist) """
+        return VirtualPlaylist(self, name, order, **kwargs)
+
+    def all_audio_table(self):
+        """ Returns every audio in the library as an AudioTable, which takes
+            a fraction of the memory of all_audio's mapped objects. A
+            cached table is copied rather than handed out """
+        if self.cache is None:
+            return self._audio_table(self.Session())
+        found, table = self.cache.get(('all_audio_table',))
+        if not found:
+            generation = self.cache.generation
+            table = self._audio_table(self.Session())
+            self.cache.put(('all_audio_table',), table, generation)
+        return table[:]
+
+    def _audio_table(self, session):
+        table = AudioTable()
+        c = audio_table.c
+        query = select([c.uri, c.type, c.artist, c.title, c.album, c.track,
+                        c.length, c.year]).order_by(c.id)
+        for row in session.execute(query):
+            table.append_row(*row)
+        return table
+
+    def search(self, query, limit=50, fields=None):
+        """ Full-text search over the artist, title and album of every
+            audio, matching each word of query as a prefix. fields limits
+            the search to some of those. Returns up to limit Audio, best
+            match first. Needs SQLite with FTS5, raises RuntimeError if it
+            isn't (see searchable) """
+        if not self.searchable:
+            raise RuntimeError("Searching needs SQLite built with FTS5")
+        session = self.Session()
+        ids = search.search_ids(session, query, limit, fields)
+        if not ids:
+            return []
+        found = dict((audio.id, audio) for audio in
+                     session.query(Audio).filter(Audio.id.in_(ids)))
+        return [found[id] for id in ids if id in found]
+
+    def artist_stats(self, order=None, descending=False, limit=None):
+        """ The number of tracks and their total length in seconds per
+            artist, as (artist, tracks, length) tuples sorted by order
+            (artist by default). These come from tables the database keeps
+            up to date (see pyap.library.stats), so they cost as much as
+            there are artists, not tracks """
+        return stats.group_stats(self.Session(), 'artist', None, order,
+                                 descending, limit)
+
+    def album_stats(self, artist=None, order=None, descending=False,
+                    limit=None):
+        """ Like artist_stats per album of an artist, as (artist, album,
+            tracks, length) tuples, optionally for one artist only """
+        where = {'artist': artist} if artist is not None else None
+        return stats.group_stats(self.Session(), 'album', where, order,
+                                 descending, limit)
+
+    def year_stats(self, order=None, descending=False, limit=None):
+        """ Like artist_stats per year, as (year, tracks, length) tuples """
+        return stats.group_stats(self.Session(), 'year', None, order,
+                                 descending, limit)
+
+    def totals(self):
+        """ The number of tracks in the library and their total length """
+        return stats.totals(self.Session())
 
     def playlist_by_name(self, name):
-        return Session().query(Playlist).filter_by(name=name).first()
+        """ Returns the playlist called name with its audio in order, or
+            None if there's no such playlist """
+        return self._cached(('playlist_by_name', name), lambda session:
+            self._load_playlist(session, name))
+
+    def _load_playlist(self, session, name):
+        playlist = session.query(Playlist).filter_by(name=name).first()
+        if playlist is not None:
+            playlist._audio_list = list(self.iter_playlist(playlist))
+            playlist._reorder()
+        return playlist
+
+    def iter_playlist(self, playlist, page_size=500):
+        """ Yields the audio of a saved playlist in order, reading entries
+            page_size at a time """
+        session = self.Session()
+        id = self._playlist_id(session, playlist)
+        entries = audio_playlist_table.c
+        position = None
+        while True:
+            query = session.query(Audio, entries.position).join(
+                audio_playlist_table, Audio.id == entries.audio_id
+            ).filter(entries.playlist_id == id)
+            if position is not None:
+                query = query.filter(entries.position > position)
+            page = query.order_by(entries.position).limit(page_size).all()
+            for audio, position in page:
+                yield audio
+            if len(page) < page_size:
+                return
         
     def add_audio(self, audio):
-        session = Session()
+        session = self.Session()
         if isinstance(audio, list) and isinstance(audio[0], Audio):
             session.add_all(audio)
-            session.commit()
+            self._invalidate('audio', [a.uri for a in audio])
+            self._commit(session)
         elif isinstance(audio, Audio):
             session.add(audio)
-            session.commit()
+            self._invalidate('audio', [audio.uri])
+            self._commit(session)
 
     def remove_audio(self, audio):
-        session = Session()
+        # deleting by uri works whichever thread's session audio came from
         if isinstance(audio, list) and isinstance(audio[0], Audio):
-            session.delete_all(audio)
-            session.commit()
+            self.remove_audio_by_uri([a.uri for a in audio])
         elif isinstance(audio, Audio):
-            session.delete(audio)
-            session.commit()
+            self.remove_audio_by_uri(audio.uri)
 
     def add_audio_by_uri(self, uri):
-        session = Session()
-        if isinstance(uri, list) and isinstance(uri[0], str):
-            session.add_all([Audio(u) for u in uri])
-            session.commit()
+        session = self.Session()
+        if isinstance(uri, list) and isinstance(uri[0], basestring):
+            audio = [Audio(u) for u in uri]
+            session.add_all(audio)
+            self._invalidate('audio', [a.uri for a in audio])
+            self._commit(session)
         else:
-            session.add(Audio(uri))
-            session.commit()
+            audio = Audio(uri)
+            session.add(audio)
+            self._invalidate('audio', [audio.uri])
+            self._commit(session)
+
+    def bulk_load(self, rows, chunk_size=500):
+        """ Writes rows straight to the audio table with executemany,
+            skipping the per-object overhead of the ORM. Each row is a dict
+            of audio columns with at least a uri (the result of audio_info
+            plus a uri will do); missing columns of a new row get the same
+            defaults as Audio, while a row whose uri is already in the
+            library only replaces the columns it has. Returns the number of
+            (inserted, updated) rows """
+        return self._bulk_load(self.Session(), rows, chunk_size)
+
+    def _bulk_load(self, session, rows, chunk_size):
+        inserted = updated = 0
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                counts = self._bulk_write(session, chunk)
+                inserted, updated = inserted + counts[0], updated + counts[1]
+                self._commit(session)
+                chunk = []
+        counts = self._bulk_write(session, chunk)
+        self._commit(session)
+        return (inserted + counts[0], updated + counts[1])
+
+    def _bulk_write(self, session, rows):
+        # later rows for the same uri replace the columns they supply
+        by_uri = {}
+        for row in rows:
+            uri = unicode(row['uri'])
+            by_uri.setdefault(uri, {}).update(row, uri=uri)
+
+        # only counts inserts and updates, a uri another writer adds before
+        # this commits is updated below all the same
+        existing = self._ids_by_uri(session, by_uri)
+        self._invalidate('audio', list(by_uri))
+
+        # one INSERT ... ON CONFLICT per set of columns rows supply, as
+        # executemany needs the same ones in every row. a new row gets the
+        # defaults of Audio, an existing one only has what it supplies set
+        groups = {}
+        for uri, row in by_uri.iteritems():
+            supplied = tuple(sorted(c for c in row if c in audio_table.c))
+            values = dict(_audio_defaults)
+            values['type'] = uri_type(uri)
+            values.update(row)
+            groups.setdefault(supplied, []).append(values)
+        for supplied, group in groups.iteritems():
+            columns = sorted(c for c in group[0] if c in audio_table.c)
+            updates = [c for c in supplied if c != 'uri']
+            sql = "INSERT INTO audio (%s) VALUES (%s) ON CONFLICT (uri) " % (
+                ', '.join(columns), ', '.join(':' + c for c in columns))
+            if updates:
+                sql += "DO UPDATE SET " + ', '.join(
+                    '%s = excluded.%s' % (c, c) for c in updates)
+            else:
+                sql += "DO NOTHING"
+            session.execute(text(sql), group)
+        return (len(by_uri) - len(existing), len(existing))
+
+    def _ids_by_uri(self, session, uris):
+        ids = {}
+        uris = list(uris)
+        # stay under SQLite's limit on bound parameters
+        for i in range(0, len(uris), 500):
+            query = select([audio_table.c.id, audio_table.c.uri],
+                           audio_table.c.uri.in_(uris[i:i+500]))
+            ids.update((uri, id) for id, uri in session.execute(query))
+        return ids
+
+    def _audio_ids(self, session, audio_list):
+        # audio that isn't in the library yet is added to it
+        uris = [unicode(audio.uri) for audio in audio_list]
+        ids = self._ids_by_uri(session, uris)
+        missing = [audio for audio in audio_list
+                   if unicode(audio.uri) not in ids]
+        if missing:
+            self._bulk_write(session, [_audio_row(audio) for audio in missing])
+            ids.update(self._ids_by_uri(session,
+                                        [unicode(a.uri) for a in missing]))
+        return [ids[uri] for uri in uris]
+
+    def ingest(self, uris, workers=None, threads=False, ordered=True,
+               chunk_size=500, fast=False):
+        """ Bulk version of add_audio_by_uri. Tags are read in a pool of
+            workers (see pyap.audio.iter_audio_info) and written through
+            bulk_load every chunk_size files, so files already in the library
+            are updated rather than reported as errors. Yields a (uri, row,
+            error) tuple per uri once its chunk is committed, where row is
+            the dict of columns written rather than an Audio so that nothing
+            goes through the ORM (audio_by_uri loads one). A file that can't
+            be read gets an error and no row but doesn't abort the batch.
+            fast estimates the length of
+            MP3s from their first frames, see refine_lengths """
+        session = self.Session()
+        # files are stat'ed before they're read so that a change made while
+        # reading shows up as a new fingerprint on the next rescan. the pool
+        # pulls uris from its own thread, hence the dict
+        fingerprints = {}
+        def stat_uris():
+            for uri in uris:
+                uri = unicode(os.path.abspath(uri))
+                try:
+                    fingerprints[uri] = fingerprint(uri)
+                except OSError:
+                    pass
+                yield uri
+
+        chunk = []
+        for result in iter_audio_info(stat_uris(), workers=workers,
+                                      threads=threads, ordered=ordered,
+                                      fast=fast):
+            chunk.append(result)
+            if len(chunk) >= chunk_size:
+                for result in self._commit_ingested(session, chunk,
+                                                    fingerprints):
+                    yield result
+                chunk = []
+        for result in self._commit_ingested(session, chunk, fingerprints):
+            yield result
+
+    def ingest_directory(self, roots, follow_symlinks=False, hidden=False,
+                         max_depth=None, cancel=None, **kwargs):
+        """ Ingests the audio files under one or more root directories, as
+            found by pyap.util.iter_files. Takes the same keyword arguments
+            as ingest """
+        uris = iter_files(roots, follow_symlinks=follow_symlinks,
+                          hidden=hidden, max_depth=max_depth, cancel=cancel)
+        return self.ingest(uris, **kwargs)
+
+    def _commit_ingested(self, session, chunk, fingerprints):
+        rows = []
+        results = []
+        for uri, info, error in chunk:
+            row = None
+            if error is None:
+                row = dict(info, uri=uri, type=FILE)
+                if uri in fingerprints:
+                    row['mtime'], row['size'], row['inode'] = \
+                        fingerprints.pop(uri)
+                rows.append(row)
+            results.append((uri, row, error))
+        self._bulk_write(session, rows)
+        self._commit(session)
+        return results
+
+    def rescan(self, roots, workers=None, threads=False, chunk_size=500,
+               cancel=None, fast=False, follow_symlinks=False, hidden=False):
+        """ Brings the library in line with the audio files under one or
+            more root directories. New files are added, files whose
+            fingerprint (mtime, size and inode) changed are read again and
+            files that are gone are removed; everything else is only
+            stat'ed. follow_symlinks and hidden are passed on to
+            pyap.util.iter_files, audio the walk skips is only removed if
+            its file no longer exists. Setting cancel (a threading.Event)
+            during the walk leaves the library untouched. Returns the number
+            of (added, updated, removed) audio """
+        if isinstance(roots, basestring):
+            roots = [roots]
+        roots = [unicode(os.path.abspath(root)) for root in roots]
+        session = self.Session()
+
+        on_disk = {}
+        for uri in iter_files(roots, follow_symlinks=follow_symlinks,
+                              hidden=hidden, cancel=cancel):
+            if cancel is not None and cancel.is_set():
+                break
+            try:
+                on_disk[uri] = fingerprint(uri)
+            except OSError:
+                pass
+        if cancel is not None and cancel.is_set():
+            # a partial walk would make files look vanished
+            return (0, 0, 0)
+
+        known = {}
+        for root in roots:
+            # every uri under root sorts between "root/" and "root0"
+            prefix = os.path.join(root, u'')
+            query = session.query(Audio.id, Audio.uri, Audio.mtime,
+                                  Audio.size, Audio.inode).filter(
+                Audio.uri >= prefix,
+                Audio.uri < prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+            )
+            for id, uri, mtime, size, inode in query:
+                known[uri] = (id, (mtime, size, inode))
+
+        # files in directories the walk didn't enter are still there
+        vanished = [uri for uri in known
+                    if uri not in on_disk and not os.path.exists(uri)]
+        removed = [known[uri][0] for uri in vanished]
+        stale = [uri for uri, fp in on_disk.iteritems()
+                 if uri not in known or known[uri][1] != fp]
+
+        rows = self._read_rows(stale, on_disk, workers, threads, fast)
+        added, updated = self._bulk_load(session, rows, chunk_size)
+
+        for i in range(0, len(removed), chunk_size):
+            self._delete_audio(session,
+                               audio_table.c.id.in_(removed[i:i+chunk_size]))
+        self._invalidate('audio', vanished)
+        self._commit(session)
+
+        return (added, updated, len(removed))
+
+    def _read_rows(self, uris, fingerprints, workers, threads, fast):
+        for uri, info, error in iter_audio_info(uris, workers=workers,
+                                                threads=threads,
+                                                ordered=False, fast=fast):
+            # changed files that can't be read are left alone, they'll be
+            # tried again the next time they're rescanned
+            if error is None:
+                info['uri'], info['type'] = uri, FILE
+                info['mtime'], info['size'], info['inode'] = \
+                    fingerprints[uri]
+                yield info
+
+    def refresh(self, uris, workers=None, threads=False, chunk_size=500,
+                fast=False):
+        """ Like rescan, for when it's known which paths changed.
+            Directories among uris are rescanned. Audio files are read
+            again if their fingerprint changed, or added if they're new.
+            Paths that no longer exist are removed along with any audio
+            under them. Returns the number of (added, updated, removed)
+            audio """
+        directories = []
+        on_disk = {}
+        gone = []
+        for uri in set(unicode(os.path.abspath(uri)) for uri in uris):
+            if os.path.isdir(uri):
+                directories.append(uri)
+            elif not os.path.exists(uri):
+                gone.append(uri)
+            elif uri_type(uri) == FILE:
+                try:
+                    on_disk[uri] = fingerprint(uri)
+                except OSError:
+                    gone.append(uri)
+
+        added = updated = removed = 0
+        if directories:
+            added, updated, removed = self.rescan(directories, workers,
+                                                  threads, chunk_size,
+                                                  fast=fast)
+
+        session = self.Session()
+        c = audio_table.c
+        known = {}
+        uris = list(on_disk)
+        for i in range(0, len(uris), 500):
+            query = select([c.uri, c.mtime, c.size, c.inode],
+                           c.uri.in_(uris[i:i+500]))
+            for uri, mtime, size, inode in session.execute(query):
+                known[uri] = (mtime, size, inode)
+        stale = [uri for uri, fp in on_disk.iteritems()
+                 if known.get(uri) != fp]
+        rows = self._read_rows(stale, on_disk, workers, threads, fast)
+        counts = self._bulk_load(session, rows, chunk_size)
+        added, updated = added + counts[0], updated + counts[1]
+
+        for uri in gone:
+            # the uri itself, or everything under it if it was a directory
+            prefix = os.path.join(uri, u'')
+            criterion = or_(c.uri == uri, and_(
+                c.uri >= prefix,
+                c.uri < prefix[:-1] + unichr(ord(prefix[-1]) + 1)))
+            found = [u for u, in session.execute(select([c.uri], criterion))]
+            if found:
+                self._delete_audio(session, criterion)
+                self._invalidate('audio', found)
+                removed += len(found)
+        self._commit(session)
+
+        return (added, updated, removed)
+
+    def watch(self, roots, **kwargs):
+        """ Starts keeping the library in line with the audio files under
+            one or more root directories as they change, see
+            pyap.library.watcher.LibraryWatcher for the options. Returns the
+            watcher; call its stop method when done """
+        watcher = LibraryWatcher(self, roots, **kwargs)
+        watcher.start()
+        return watcher
+
+    def refine_lengths(self, workers=None, threads=False, chunk_size=500):
+        """ Replaces the lengths estimated in fast mode with exact ones,
+            read in a pool of workers (see pyap.audio.exact_length). Meant
+            to run in the background once a fast ingest is done. Returns
+            the number of (refined, failed) audio """
+        session = self.Session()
+        c = audio_table.c
+        ids = dict((uri, id) for id, uri in session.execute(
+            select([c.id, c.uri], c.length_estimated == True)))
+
+        refined = failed = 0
+        chunk = []
+        def write(chunk):
+            session.execute(audio_table.update().where(
+                c.id == bindparam('_id')
+            ).values(length=bindparam('_length'), length_estimated=False),
+                chunk)
+            self._invalidate('audio', [row['_uri'] for row in chunk])
+            self._commit(session)
+        for uri, length, error in iter_exact_lengths(
+                list(ids), workers=workers, threads=threads, ordered=False):
+            if error is not None:
+                failed += 1
+                continue
+            chunk.append({'_id': ids[uri], '_uri': uri, '_length': length})
+            refined += 1
+            if len(chunk) >= chunk_size:
+                write(chunk)
+                chunk = []
+        if chunk:
+            write(chunk)
+        return (refined, failed)
+
+    def hash_audio(self, workers=None, threads=False, chunk_size=500):
+        """ Stores the payload hash (see pyap.audio.digest) of every audio
+            file in the library, for duplicates. Files are hashed in a pool
+            of workers, and only if they weren't hashed before or their
+            mtime or size changed since. Returns the number of (hashed,
+            failed) files """
+        session = self.Session()
+        c = audio_table.c
+        stale = {}
+        query = select([c.id, c.uri, c.content_hash, c.hash_mtime,
+                        c.hash_size], c.type == FILE)
+        for id, uri, content_hash, mtime, size in session.execute(query):
+            try:
+                stamp = fingerprint(uri)[:2]
+            except OSError:
+                continue
+            if content_hash is None or (mtime, size) != stamp:
+                stale[uri] = (id, stamp)
+
+        hashed = failed = 0
+        chunk = []
+        def write(chunk):
+            session.execute(audio_table.update().where(
+                c.id == bindparam('_id')
+            ).values(content_hash=bindparam('_hash'),
+                     hash_mtime=bindparam('_mtime'),
+                     hash_size=bindparam('_size')), chunk)
+            self._invalidate('audio', [row['_uri'] for row in chunk])
+            self._commit(session)
+        for uri, content_hash, error in iter_payload_hashes(
+                list(stale), workers=workers, threads=threads,
+                ordered=False):
+            if error is not None:
+                failed += 1
+                continue
+            id, (mtime, size) = stale[uri]
+            chunk.append({'_id': id, '_uri': uri, '_hash': content_hash,
+                          '_mtime': mtime, '_size': size})
+            hashed += 1
+            if len(chunk) >= chunk_size:
+                write(chunk)
+                chunk = []
+        if chunk:
+            write(chunk)
+        return (hashed, failed)
+
+    def duplicates(self):
+        """ Returns the audio that shares its payload hash with some other
+            audio, as a list of lists of copies. Only hashed audio is
+            considered, see hash_audio """
+        c = audio_table.c
+        hashes = select([c.content_hash], c.content_hash != None).group_by(
+            c.content_hash).having(func.count(c.id) > 1)
+        groups = []
+        query = self.Session().query(Audio).filter(
+            c.content_hash.in_(hashes)).order_by(c.content_hash, c.id)
+        for audio in query:
+            if not groups or groups[-1][0].content_hash != audio.content_hash:
+                groups.append([])
+            groups[-1].append(audio)
+        return groups
+
+    def _delete_audio(self, session, criterion):
+        # playlist links go first, then the audio matching criterion
+        ids = select([audio_table.c.id], criterion)
+        session.execute(audio_playlist_table.delete().where(
+            audio_playlist_table.c.audio_id.in_(ids)))
+        session.execute(audio_table.delete().where(criterion))
 
     def remove_audio_by_uri(self, uri):
-        session = Session()
-        if isinstance(uri, list) and isinstance(uri[0], str):
-            session.delete_all([Audio(u) for u in uri])
-            session.commit()
-        else:
-            session.delete(Audio(uri))
-            session.commit()
+        session = self.Session()
+        if not isinstance(uri, list):
+            uri = [uri]
+        uris = [_file_uri(u) for u in uri]
+        for i in range(0, len(uris), 500):
+            self._delete_audio(session, audio_table.c.uri.in_(uris[i:i+500]))
+        self._invalidate('audio', uris)
+        self._commit(session)
 
     def add_playlist(self, playlist):
-        session = Session()
-        # TODO: this should automatically add all Audio to the Library
-        #       in the playlist that doesn't already exist
-        #for audio in playlist:
-        #    playlist.audio.append(audio)
+        """ Saves playlist with its audio in order, replacing the entries
+            of a playlist saved before, or the playlist saved under its name
+            if it's a new Playlist. Audio that isn't in the library yet is
+            added to it """
+        session = self.Session()
+        if instance_state(playlist).key is None:
+            # a new Playlist takes the place of one saved under its name
+            existing = session.execute(select([playlist_table.c.id],
+                playlist_table.c.name == playlist.name)).scalar()
+            if existing is not None:
+                self._delete_playlist(session, existing)
         session.add(playlist)
-        session.commit()
+        session.flush()
+        entries = audio_playlist_table.c
+        session.execute(audio_playlist_table.delete().where(
+            entries.playlist_id == playlist.id))
+        audio_list = playlist.all_audio(with_shuffle=False)
+        self._insert_entries(session, playlist.id,
+                             self._audio_ids(session, audio_list), 0)
+        self._invalidate('playlist', playlist.name)
+        self._commit(session)
 
     def remove_playlist(self, playlist):
-        session = Session()
-        session.delete(playlist)
-        session.commit()
+        session = self.Session()
+        self._delete_playlist(session, self._playlist_id(session, playlist))
+        if playlist in session:
+            session.expunge(playlist)
+        self._invalidate('playlist', playlist.name)
+        self._commit(session)
+
+    def _delete_playlist(self, session, id):
+        session.execute(audio_playlist_table.delete().where(
+            audio_playlist_table.c.playlist_id == id))
+        session.execute(playlist_table.delete().where(
+            playlist_table.c.id == id))
+        smart.remove(session, id)
+        loaded = session.identity_map.get((Playlist, (id,)))
+        if loaded is not None:
+            session.expunge(loaded)
+
+    # the methods below change a saved playlist and write only the entries
+    # that changed, then apply the same change to playlist itself once
+    # committed
+
+    def add_to_playlist(self, playlist, audio):
+        """ Appends audio, or a list of audio, to a saved playlist """
+        audio_list = audio if isinstance(audio, list) else [audio]
+        session = self.Session()
+        id = self._playlist_id(session, playlist)
+        entries = audio_playlist_table.c
+        last = session.execute(select([func.max(entries.position)],
+                                      entries.playlist_id == id)).scalar()
+        self._insert_entries(session, id, self._audio_ids(session, audio_list),
+                             last or 0)
+        self._invalidate('playlist', playlist.name)
+        self._commit(session, lambda: playlist.extend(audio_list))
+
+    def insert_in_playlist(self, playlist, index, audio):
+        """ Inserts audio before index in a saved playlist """
+        # where list.insert puts it
+        if index < 0:
+            index = max(len(playlist) + index, 0)
+        session = self.Session()
+        id = self._playlist_id(session, playlist)
+        session.execute(audio_playlist_table.insert(), {
+            'playlist_id': id,
+            'audio_id': self._audio_ids(session, [audio])[0],
+            'position': self._position_before(session, id, playlist,
+                                              min(index, len(playlist)))
+        })
+        self._invalidate('playlist', playlist.name)
+        self._commit(session, lambda: playlist.insert(index, audio))
+
+    def remove_from_playlist(self, playlist, index):
+        """ Removes the audio at index from a saved playlist """
+        if index < 0:
+            index += len(playlist)
+        session = self.Session()
+        entry = self._entry_at(session, self._playlist_id(session, playlist),
+                               playlist, index)[0]
+        session.execute(audio_playlist_table.delete().where(
+            audio_playlist_table.c.id == entry))
+        self._invalidate('playlist', playlist.name)
+        self._commit(session, lambda: playlist.__delitem__(index))
+
+    def move_in_playlist(self, playlist, old_index, new_index):
+        """ Moves the audio at old_index in a saved playlist so that it ends
+            up at new_index """
+        if old_index < 0:
+            old_index += len(playlist)
+        session = self.Session()
+        id = self._playlist_id(session, playlist)
+        entry = self._entry_at(session, id, playlist, old_index)[0]
+        # new_index is where playlist.move puts it once it's taken out,
+        # which is before the entry now at target
+        if new_index < 0:
+            new_index = max(len(playlist) - 1 + new_index, 0)
+        new_index = min(new_index, len(playlist) - 1)
+        target = new_index if new_index < old_index else new_index + 1
+        position = self._position_before(session, id, playlist, target,
+                                         exclude=entry)
+        session.execute(audio_playlist_table.update().where(
+            audio_playlist_table.c.id == entry).values(position=position))
+        self._invalidate('playlist', playlist.name)
+        self._commit(session,
+                     lambda: playlist.move(old_index, new_index))
+
+    def add_smart_playlist(self, name, rule, order='library'):
+        """ Saves a playlist called name of the audio matching rule (see
+            pyap.library.smart), sorted by order, one of the keys of
+            pyap.library.db.ORDERS. Returns the playlist. It's kept as it
+            is until refreshed by refresh_smart_playlist """
+        clause = smart.compile_rule(rule, audio_table)
+        if order not in ORDERS:
+            raise ValueError("Unknown order '%s'" % order)
+        columns = [audio_table.c[column] for column in ORDERS[order]]
+        session = self.Session()
+        playlist = Playlist(name)
+        session.add(playlist)
+        session.flush()
+        since = smart.last_change(session)
+        ids = [id for id, in session.execute(
+            select([audio_table.c.id], clause).order_by(*columns))]
+        self._insert_entries(session, playlist.id, ids, 0)
+        smart.save(session, playlist.id, rule, order, since)
+        self._invalidate('playlist', name)
+        self._commit(session)
+        return self.playlist_by_name(name)
+
+    def refresh_smart_playlist(self, playlist):
+        """ Brings a smart playlist up to date with the library, looking
+            only at the audio that changed since it was last refreshed.
+            Takes the playlist, which is changed the same way, or just its
+            name. Returns how many audio were (added, removed) """
+        name = playlist if isinstance(playlist, basestring) else playlist.name
+        session = self.Session()
+        id = self._playlist_id(session, playlist)
+        saved = smart.load(session, id)
+        if saved is None:
+            raise ValueError("Playlist '%s' isn't a smart playlist" % name)
+        rule, order, since = saved
+        changed, last = smart.changes(session, since)
+        if not changed:
+            return (0, 0)
+
+        clause = smart.compile_rule(rule, audio_table)
+        entries = audio_playlist_table.c
+        present = set()
+        matching = []
+        for i in range(0, len(changed), 500):
+            chunk = changed[i:i+500]
+            in_chunk = and_(entries.playlist_id == id,
+                            entries.audio_id.in_(chunk))
+            present.update(audio_id for audio_id, in session.execute(
+                select([entries.audio_id], in_chunk)))
+            matching.extend(session.query(Audio).filter(
+                and_(audio_table.c.id.in_(chunk), clause)))
+            # whatever still matches goes back in where it now sorts
+            session.execute(audio_playlist_table.delete().where(in_chunk))
+
+        # in order, so that each lands after the ones before it
+        fields = ORDERS[order]
+        key = lambda audio: tuple(getattr(audio, field) for field in fields)
+        matching.sort(key=key)
+        columns = [audio_table.c[field] for field in fields]
+        for audio in matching:
+            position = self._sorted_position(session, id, columns, key(audio))
+            session.execute(audio_playlist_table.insert(), {
+                'playlist_id': id, 'audio_id': audio.id, 'position': position
+            })
+        inserts = []
+        if matching and not isinstance(playlist, basestring):
+            # where each goes in playlist, read in one pass once they're
+            # all in. they're inserted by index, so each lands after the
+            # ones before it. audio is in a smart playlist once
+            indices = {}
+            for index, (audio_id,) in enumerate(session.execute(
+                    select([entries.audio_id], entries.playlist_id == id)
+                    .order_by(entries.position))):
+                indices[audio_id] = index
+            inserts = sorted((indices[audio.id], audio)
+                             for audio in matching)
+        smart.mark(session, id, last)
+        self._invalidate('playlist', name)
+
+        matched = set(audio.id for audio in matching)
+        changed = set(changed)
+        def apply():
+            if isinstance(playlist, basestring):
+                return
+            # by id, as some of the audio may be gone from the library
+            dropped = [i for i, audio in enumerate(playlist)
+                       if _persisted_id(audio) in changed]
+            for i in reversed(dropped):
+                del playlist[i]
+            for index, audio in inserts:
+                playlist.insert(index, audio)
+        self._commit(session, apply)
+        return (len(matched - present), len(present - matched))
+
+    def refresh_smart_playlists(self):
+        """ Refreshes every smart playlist, returning how many audio were
+            (added, removed) by playlist name """
+        return dict((name, self.refresh_smart_playlist(name)) for name in
+                    smart.playlist_names(self.Session()))
+
+    def _playlist_id(self, session, playlist):
+        # by name, so playlist can come from any thread's session. a name
+        # will do as well
+        name = playlist if isinstance(playlist, basestring) else playlist.name
+        id = session.execute(select([playlist_table.c.id],
+                                    playlist_table.c.name == name)).scalar()
+        if id is None:
+            raise ValueError("Playlist '%s' is not in the library" % name)
+        return id
+
+    def _insert_entries(self, session, playlist_id, audio_ids, after):
+        if audio_ids:
+            session.execute(audio_playlist_table.insert(), [
+                {'playlist_id': playlist_id, 'audio_id': audio_id,
+                 'position': after + (i + 1) * POSITION_GAP}
+                for i, audio_id in enumerate(audio_ids)
+            ])
+
+    def _entry_at(self, session, playlist_id, playlist, index):
+        # the (id, position) of the entry at index of playlist, which is in
+        # step with the library. it's found among the entries of the same
+        # audio, so it costs as much as there are of those rather than
+        # stepping through the entries before it
+        if not 0 <= index < len(playlist):
+            raise IndexError("playlist index out of range")
+        audio = playlist[index]
+        audio_id = _persisted_id(audio)
+        if audio_id is None:
+            audio_id = self._ids_by_uri(session, [unicode(audio.uri)]).get(
+                unicode(audio.uri))
+        entries = audio_playlist_table.c
+        row = session.execute(select([entries.id, entries.position], and_(
+            entries.playlist_id == playlist_id, entries.audio_id == audio_id))
+            .order_by(entries.position)
+            .offset(playlist._occurrence(index)).limit(1)).first()
+        if row is None:
+            raise IndexError("playlist index out of range")
+        return tuple(row)
+
+    def _position_before(self, session, playlist_id, playlist, index,
+                         exclude=None):
+        # a position between the entry at index of playlist (the end if
+        # index is its length) and the one before it, leaving out the
+        # entry exclude. the neighbours are found by position, which the
+        # (playlist_id, position) index makes cheap. the playlist is
+        # renumbered when there's no room left between them
+        entries = audio_playlist_table.c
+        criterion = entries.playlist_id == playlist_id
+        if exclude is not None:
+            criterion = and_(criterion, entries.id != exclude)
+        after = None
+        if index < len(playlist):
+            after = self._entry_at(session, playlist_id, playlist, index)[1]
+            criterion = and_(criterion, entries.position < after)
+        before = session.execute(
+            select([func.max(entries.position)], criterion)).scalar()
+
+        if before is None and after is None:
+            return POSITION_GAP
+        if after is None:
+            return before + POSITION_GAP
+        if before is None:
+            return after - POSITION_GAP
+        if after - before > 1:
+            return (before + after) // 2
+        self._renumber(session, playlist_id)
+        return self._position_before(session, playlist_id, playlist, index,
+                                     exclude)
+
+    def _sorted_position(self, session, playlist_id, columns, key):
+        # a position between the last entry whose audio sorts before key,
+        # a tuple of values for columns, and the first that sorts after.
+        # that one is found walking the audio in order, which the indexes
+        # behind ORDERS make cheap, rather than sorting the entries
+        entries = audio_playlist_table.c
+        member = exists().where(and_(entries.playlist_id == playlist_id,
+                                     entries.audio_id == audio_table.c.id))
+        successor = session.execute(select([audio_table.c.id], and_(
+            member, _after(columns, key))).order_by(*columns).limit(1)
+                                    ).scalar()
+        after = None
+        if successor is not None:
+            after = session.execute(select([func.min(entries.position)],
+                and_(entries.playlist_id == playlist_id,
+                     entries.audio_id == successor))).scalar()
+        criterion = entries.playlist_id == playlist_id
+        if after is not None:
+            criterion = and_(criterion, entries.position < after)
+        before = session.execute(
+            select([func.max(entries.position)], criterion)).scalar()
+
+        if before is None and after is None:
+            return POSITION_GAP
+        if after is None:
+            return before + POSITION_GAP
+        if before is None:
+            return after - POSITION_GAP
+        if after - before > 1:
+            return (before + after) // 2
+        self._renumber(session, playlist_id)
+        return self._sorted_position(session, playlist_id, columns, key)
 
+    def _renumber(self, session, playlist_id):
+        entries = audio_playlist_table.c
+        ids = [id for id, in session.execute(
+            select([entries.id], entries.playlist_id == playlist_id)
+            .order_by(entries.position))]
+        session.execute(audio_playlist_table.update().where(
+            entries.id == bindparam('_id')
+        ).values(position=bindparam('_position')), [
+            {'_id': id, '_position': (i + 1) * POSITION_GAP}
+            for i, id in enumerate(ids)
+        ])
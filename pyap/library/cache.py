@@ -0,0 +1,107 @@
+# Pyap - The Python Audio Player Library
+#
+# Copyright (c) 2012 Joel Griffith
+# Copyright (c) 2005 Joe Wreschnig
+# Copyright (c) 2002 David I. Lehn
+# Copyright (c) 2005-2011 the SQLAlchemy authors and contributors
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import threading
+import time
+
+from collections import OrderedDict
+
+class ResultCache(object):
+    """ An in-process cache of query results for Library. Keys are tuples
+        starting with the kind of lookup, like ('audio_by_uri', uri). At
+        most max_entries are kept, evicting the least recently used, and
+        entries older than ttl seconds are dropped when next looked up
+        (ttl=None keeps them until evicted or invalidated). generation
+        changes with every invalidation, so that a result read before one
+        isn't cached after it """
+    def __init__(self, max_entries=1000, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """ Returns a (found, value) tuple; value may legitimately be None """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                stored, value = entry
+                if self.ttl is None or time.time() - stored < self.ttl:
+                    # reinserting moves it to the most recently used end
+                    self._entries[key] = entry
+                    self.hits += 1
+                    return (True, value)
+            self.misses += 1
+            return (False, None)
+
+    def put(self, key, value, generation=None):
+        """ Caches value under key, unless generation is given and there
+            have been invalidations since """
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time(), value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self.generation += 1
+            self._entries.pop(key, None)
+
+    def invalidate_kind(self, kind, predicate=None):
+        """ Drops the entries of one kind of lookup, or only those whose
+            value satisfies predicate """
+        with self._lock:
+            self.generation += 1
+            for key in list(self._entries):
+                if key[0] == kind and (predicate is None or
+                                       predicate(self._entries[key][1])):
+                    del self._entries[key]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return float(self.hits) / lookups
+
+    def stats(self):
+        return {'entries': len(self), 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions,
+                'hit_rate': self.hit_rate()}
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
@@ -20,56 +20,233 @@
 # Free Software Foundation, Inc., 59 Temple Place - Suite 330,
 # Boston, MA 02111-1307, USA.
 
-from sqlalchemy import create_engine
-from sqlalchemy import Table, Column, Integer, Unicode, MetaData
+import threading
+
+from sqlalchemy import create_engine, event
+from sqlalchemy import Table, Column, Integer, Float, Unicode, MetaData
+from sqlalchemy import Index, Boolean
 from sqlalchemy.schema import ForeignKey
-from sqlalchemy.orm import mapper, relationship, sessionmaker
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.orm import mapper, relationship, backref, sessionmaker
+from sqlalchemy.orm import synonym
+from sqlalchemy.orm import scoped_session
 
-from pyap.audio import Audio
+from pyap.audio import Audio, METADATA, INTERNED, intern_tag
 from pyap.playlist import Playlist
+from pyap.library import search, stats, smart
+
+metadata = MetaData()
+
+#audio_types_table = Table('audio_types', metadata,
+#    Column('id', Integer, primary_key=True),
+#    Column('type', Unicode, unique=True)
+#)
+
+# mtime, size and inode make up the fingerprint used to tell whether
+# a file changed since its tags were last read. content_hash identifies
+# the audio itself (see pyap.audio.digest) and hash_mtime and hash_size
+# the state of the file when it was hashed. length_estimated marks
+# lengths read in fast mode that refine_lengths has yet to work out
+audio_table = Table('audio', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('uri', Unicode, unique=True, index=True),
+    Column('type', Integer, nullable=False),
+    Column('artist', Unicode),
+    Column('title', Unicode),
+    Column('album', Unicode),
+    Column('track', Integer),
+    Column('length', Integer),
+    Column('length_estimated', Boolean, default=False),
+    Column('year', Unicode),
+    Column('mtime', Float),
+    Column('size', Integer),
+    Column('inode', Integer),
+    Column('content_hash', Unicode),
+    Column('hash_mtime', Float),
+    Column('hash_size', Integer)
+)
+
+# composite indexes behind Library.iter_audio's filters and orders, see
+# ORDERS. an artist or artist and album filter walks the first in order
+Index('ix_audio_artist_year_album', audio_table.c.artist, audio_table.c.year,
+      audio_table.c.album, audio_table.c.track, audio_table.c.title)
+Index('ix_audio_album_track', audio_table.c.album, audio_table.c.track,
+      audio_table.c.title)
+Index('ix_audio_year_artist', audio_table.c.year, audio_table.c.artist)
+Index('ix_audio_title', audio_table.c.title, audio_table.c.id)
+Index('ix_audio_length', audio_table.c.length)
+Index('ix_audio_content_hash', audio_table.c.content_hash)
+
+# sort orders for paging through the audio table, each ending in id so
+# that every row has a distinct key. 'library' is the SQL equivalent of
+# Audio.__cmp__: by artist, then the artist's albums by year, then tracks
+ORDERS = {
+    'library': ('artist', 'year', 'album', 'track', 'title', 'id'),
+    'album': ('album', 'track', 'title', 'id'),
+    'title': ('title', 'id'),
+    'length': ('length', 'id'),
+    'id': ('id',)
+}
+
+playlist_table = Table('playlists', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('name', Unicode, unique=True, index=True)
+)
+
+# the entries of every playlist. entries are ordered by position, which
+# is spaced POSITION_GAP apart so that an entry can be inserted or moved
+# by writing only its own row. the same audio can appear more than once
+audio_playlist_table = Table('audio_playlists', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('audio_id', Integer, ForeignKey('audio.id')),
+    Column('playlist_id', Integer, ForeignKey('playlists.id')),
+    Column('position', Integer, nullable=False)
+)
+Index('ix_audio_playlists_position', audio_playlist_table.c.playlist_id,
+      audio_playlist_table.c.position)
+# finding the entries of an audio, and whether a playlist has an audio.
+# migrate widens the audio_id only index of older databases to this one
+Index('ix_audio_playlists_audio', audio_playlist_table.c.audio_id,
+      audio_playlist_table.c.playlist_id)
+
+POSITION_GAP = 1024
+
+# applied to every new connection; None leaves SQLite's default
+PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    # negative sizes are in KiB
+    'cache_size': -20000
+}
 
-def setup(uri):
-    # TODO: echo should be false
+_mapped = False
+_mapping_lock = threading.Lock()
+
+def _map_classes():
+    # classes can only be mapped once, however many libraries there are
+    global _mapped
+    with _mapping_lock:
+        if _mapped:
+            return
+        # the tag columns sit behind Audio's lazy-loading properties
+        properties = {}
+        for name in METADATA:
+            properties['_' + name] = audio_table.c[name]
+            properties[name] = synonym('_' + name)
+        mapper(Audio, audio_table, properties=properties)
+        # entries are written by Library a row at a time, never by
+        # flushing these collections
+        mapper(Playlist, playlist_table, properties={
+            'audio': relationship(Audio, secondary=audio_playlist_table,
+                                  order_by=audio_playlist_table.c.position,
+                                  viewonly=True,
+                                  backref=backref('playlists',
+                                                  viewonly=True))}
+        )
+        event.listen(Audio, 'load', _intern_loaded_audio)
+        event.listen(Audio, 'refresh', _intern_loaded_audio)
+        event.listen(Playlist, 'load', _init_loaded_playlist)
+        _mapped = True
+
+def _intern_loaded_audio(audio, context, attrs=None):
+    # straight into the instance's dict, the values haven't changed
+    state = audio.__dict__
+    for name in INTERNED:
+        attribute = '_' + name
+        if attribute in state:
+            state[attribute] = intern_tag(state[attribute])
+
+def _init_loaded_playlist(playlist, context):
+    # the ORM doesn't call __init__; Library fills in the audio
+    playlist._audio_list = []
+    playlist.reset()
+
+def migrate(connectable):
+    """ Brings a database made by an earlier version up to the schema
+        above, adding the audio columns it lacks, giving playlist entries
+        their positions and creating or widening indexes. Does nothing to
+        a database that's up to date """
+    connection = connectable.connect()
+    try:
+        columns = set(row[1] for row in
+                      connection.execute("PRAGMA table_info(audio)"))
+        for column in audio_table.columns:
+            if column.name not in columns:
+                connection.execute("ALTER TABLE audio ADD COLUMN %s %s" % (
+                    column.name,
+                    column.type.compile(dialect=connection.dialect)))
+
+        columns = set(row[1] for row in
+                      connection.execute("PRAGMA table_info(audio_playlists)"))
+        if 'position' not in columns:
+            # entries used to be unordered rows without ids, number them
+            # in the order they were added
+            connection.execute("ALTER TABLE audio_playlists "
+                               "RENAME TO audio_playlists_old")
+            audio_playlist_table.create(connection)
+            connection.execute(
+                "INSERT INTO audio_playlists (audio_id, playlist_id, "
+                "position) SELECT audio_id, playlist_id, 0 FROM "
+                "audio_playlists_old ORDER BY playlist_id, rowid")
+            connection.execute(
+                "UPDATE audio_playlists SET position = (id - (SELECT "
+                "MIN(id) FROM audio_playlists AS first WHERE "
+                "first.playlist_id = audio_playlists.playlist_id) + 1) "
+                "* %d" % POSITION_GAP)
+            connection.execute("DROP TABLE audio_playlists_old")
+
+        for table in (audio_table, audio_playlist_table):
+            for index in table.indexes:
+                result = connection.execute("PRAGMA index_info(%s)" %
+                                            index.name)
+                # a missing index doesn't even return an empty result
+                existing = []
+                if result.returns_rows:
+                    existing = [row[2] for row in result]
+                if existing == [column.name for column in index.columns]:
+                    continue
+                if existing:
+                    connection.execute("DROP INDEX %s" % index.name)
+                index.create(connection)
+    finally:
+        connection.close()
+
+def setup(uri, echo=False, pragmas=None, **engine_options):
+    """ Creates an engine for the SQLite database at uri (in memory if uri
+        is None), creating the schema if needed, and returns a thread-local
+        scoped_session factory bound to it. pragmas are merged into PRAGMAS
+        and engine_options (poolclass, pool_size, ...) are passed on to
+        create_engine. SQL is only logged with echo.
+
+        An in-memory database lives and dies with its one connection, so
+        it can only be used from the thread that set it up; SQLite raises
+        ProgrammingError for any other """
+    engine_options.setdefault('connect_args', {})
     if uri is None:
-        engine = create_engine('sqlite:///:memory:', echo=True)
+        engine_options.setdefault('poolclass', StaticPool)
+        engine = create_engine('sqlite://', echo=echo, **engine_options)
     else:
-        engine = create_engine('sqlite:///' + uri, echo=True)
-
-    metadata = MetaData()
-
-    #audio_types_table = Table('audio_types', metadata,
-    #    Column('id', Integer, primary_key=True),
-    #    Column('type', Unicode, unique=True)
-    #)
-
-    audio_table = Table('audio', metadata,
-        Column('id', Integer, primary_key=True),
-        Column('uri', Unicode, unique=True, index=True),
-        Column('type', Integer, nullable=False),
-        Column('artist', Unicode),
-        Column('title', Unicode),
-        Column('album', Unicode),
-        Column('track', Integer),
-        Column('length', Integer)
-    )
-
-    playlist_table = Table('playlists', metadata,
-        Column('id', Integer, primary_key=True),
-        Column('name', Unicode, unique=True, index=True)
-    )
-
-    # many-to-many junction table for audio and playlists
-    audio_playlist_table = Table('audio_playlists', metadata,
-        Column('audio_id', Integer, ForeignKey('audio.id')),
-        Column('playlist_id', Integer, ForeignKey('playlists.id'))
-    )
+        # pooled connections are handed from thread to thread
+        engine_options['connect_args'].setdefault('check_same_thread', False)
+        engine = create_engine('sqlite:///' + uri, echo=echo,
+                               **engine_options)
 
-    metadata.create_all(engine)
+    settings = dict(PRAGMAS)
+    settings.update(pragmas or {})
+    def set_up(connection, connection_record):
+        cursor = connection.cursor()
+        for name, value in settings.items():
+            if value is not None:
+                cursor.execute("PRAGMA %s = %s" % (name, value))
+        cursor.close()
+        smart.register(connection)
+    event.listen(engine, 'connect', set_up)
 
-    mapper(Audio, audio_table)
-    mapper(Playlist, playlist_table, properties={
-        'audio': relationship(Audio, secondary=audio_playlist_table,
-                                     backref='playlists')}
-    )
+    metadata.create_all(engine)
+    migrate(engine)
+    search.install(engine)
+    stats.install(engine)
+    smart.install(engine)
+    _map_classes()
 
-    return sessionmaker(bind=engine)
+    return scoped_session(sessionmaker(bind=engine))
@@ -0,0 +1,109 @@
+# Pyap - The Python Audio Player Library
+#
+# Copyright (c) 2012 Joel Griffith
+# Copyright (c) 2005 Joe Wreschnig
+# Copyright (c) 2002 David I. Lehn
+# Copyright (c) 2005-2011 the SQLAlchemy authors and contributors
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import re
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+# an external-content FTS5 index over the tag columns of the audio table,
+# kept in sync by triggers so every write path (ORM or Core) updates it
+_ddl = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS audio_search USING fts5("
+    "artist, title, album, content='audio', content_rowid='id', "
+    "tokenize='unicode61 remove_diacritics 1', prefix='2 3')",
+
+    "CREATE TRIGGER IF NOT EXISTS audio_search_insert AFTER INSERT ON audio "
+    "BEGIN "
+    "INSERT INTO audio_search(rowid, artist, title, album) "
+    "VALUES (new.id, new.artist, new.title, new.album); "
+    "END",
+
+    "CREATE TRIGGER IF NOT EXISTS audio_search_delete AFTER DELETE ON audio "
+    "BEGIN "
+    "INSERT INTO audio_search(audio_search, rowid, artist, title, album) "
+    "VALUES ('delete', old.id, old.artist, old.title, old.album); "
+    "END",
+
+    "CREATE TRIGGER IF NOT EXISTS audio_search_update "
+    "AFTER UPDATE OF artist, title, album ON audio "
+    "BEGIN "
+    "INSERT INTO audio_search(audio_search, rowid, artist, title, album) "
+    "VALUES ('delete', old.id, old.artist, old.title, old.album); "
+    "INSERT INTO audio_search(rowid, artist, title, album) "
+    "VALUES (new.id, new.artist, new.title, new.album); "
+    "END"
+]
+
+FIELDS = ('artist', 'title', 'album')
+
+def installed(connectable):
+    """ Whether the database has the search index """
+    return connectable.execute("SELECT name FROM sqlite_master WHERE name "
+                               "= 'audio_search'").fetchone() is not None
+
+def install(engine):
+    """ Creates the search index and its triggers if they don't exist yet,
+        indexing whatever audio is already there. Returns False if SQLite
+        was built without FTS5, in which case searching isn't available """
+    connection = engine.connect()
+    try:
+        exists = installed(connection)
+        try:
+            connection.execute(_ddl[0])
+        except OperationalError as e:
+            if 'fts5' not in str(e):
+                raise
+            return False
+        for ddl in _ddl[1:]:
+            connection.execute(ddl)
+        if not exists:
+            connection.execute("INSERT INTO audio_search(audio_search) "
+                               "VALUES ('rebuild')")
+    finally:
+        connection.close()
+    return True
+
+def match_query(query, fields=None):
+    """ Turns free text into an FTS5 query that matches every word as a
+        prefix, optionally only in some of FIELDS. Returns None if there's
+        nothing to search for. Raises ValueError for any other field """
+    for field in fields or ():
+        if field not in FIELDS:
+            raise ValueError("Unknown field '%s'" % field)
+    words = re.findall(r'\w+', query, re.UNICODE)
+    if not words:
+        return None
+    match = u' '.join(u'"%s"*' % word for word in words)
+    if fields:
+        match = u'{%s} : (%s)' % (u' '.join(fields), match)
+    return match
+
+def search_ids(session, query, limit=50, fields=None):
+    """ Returns the ids of the audio best matching query, best first """
+    match = match_query(query, fields)
+    if match is None:
+        return []
+    result = session.execute(text(
+        "SELECT rowid FROM audio_search WHERE audio_search MATCH :match "
+        "ORDER BY rank LIMIT :limit"), {'match': match, 'limit': limit})
+    return [id for (id,) in result]
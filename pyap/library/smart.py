@@ -0,0 +1,190 @@
+# Pyap - The Python Audio Player Library
+#
+# Copyright (c) 2012 Joel Griffith
+# Copyright (c) 2005 Joe Wreschnig
+# Copyright (c) 2002 David I. Lehn
+# Copyright (c) 2005-2011 the SQLAlchemy authors and contributors
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import json
+
+from sqlalchemy import text, and_, or_, not_, func
+
+# Smart playlists are saved playlists whose entries are the audio matching
+# a rule, sorted by one of pyap.library.db.ORDERS. A rule is a list (or
+# tuple), so that it can be stored as JSON:
+#
+#     [field, operator, value]        a condition on a column of audio
+#     ['all', [rule, ...]]            every rule holds
+#     ['any', [rule, ...]]            at least one rule holds
+#     ['not', rule]
+#
+# for instance tracks by some artists, shorter than 6 minutes, from 1990 on:
+#
+#     ['all', [['artist', 'in', [u'Low', u'Slint']],
+#              ['length', '<', 360], ['year', '>=', u'1990']]]
+#
+# Every change to the audio table is logged by triggers, while there are
+# smart playlists, so that refreshing one only has to look at the audio
+# that changed since it was last refreshed
+
+FIELDS = ('uri', 'artist', 'title', 'album', 'track', 'length', 'year')
+
+OPERATORS = {
+    '=': lambda column, value: column == value,
+    '!=': lambda column, value: column != value,
+    '<': lambda column, value: column < value,
+    '<=': lambda column, value: column <= value,
+    '>': lambda column, value: column > value,
+    '>=': lambda column, value: column >= value,
+    'in': lambda column, value: column.in_(value),
+    'not in': lambda column, value: not_(column.in_(value)),
+    # case-insensitive, without LIKE's wildcards. both sides are lowered
+    # by Python (see register), SQLite's own lower() only folds ASCII
+    'contains': lambda column, value:
+        func.instr(func.pyap_lower(column), value.lower()) > 0
+}
+
+def _lower(value):
+    if isinstance(value, basestring):
+        return value.lower()
+    return value
+
+def register(connection):
+    """ Adds the SQL functions that rules compile to to a new DB-API
+        connection """
+    connection.create_function('pyap_lower', 1, _lower)
+
+def compile_rule(rule, table):
+    """ Turns rule into a condition on table, the audio table, raising
+        ValueError if it isn't a rule """
+    if not isinstance(rule, (list, tuple)) or not rule:
+        raise ValueError("Not a rule: %r" % (rule,))
+    if rule[0] in ('all', 'any') and len(rule) == 2:
+        if not isinstance(rule[1], (list, tuple)):
+            raise ValueError("'%s' takes a list of rules" % rule[0])
+        clauses = [compile_rule(r, table) for r in rule[1]]
+        return (and_ if rule[0] == 'all' else or_)(*clauses)
+    if rule[0] == 'not' and len(rule) == 2:
+        return not_(compile_rule(rule[1], table))
+    if len(rule) != 3:
+        raise ValueError("Not a rule: %r" % (rule,))
+    field, operator, value = rule
+    if field not in FIELDS:
+        raise ValueError("Unknown field '%s'" % field)
+    if operator not in OPERATORS:
+        raise ValueError("Unknown operator '%s'" % operator)
+    if operator in ('in', 'not in') and not isinstance(value, (list, tuple)):
+        raise ValueError("'%s' takes a list of values" % operator)
+    if operator == 'contains' and not isinstance(value, basestring):
+        raise ValueError("'contains' takes a string")
+    return OPERATORS[operator](table.c[field], value)
+
+_ddl = [
+    "CREATE TABLE IF NOT EXISTS smart_playlists ("
+    "playlist_id INTEGER PRIMARY KEY REFERENCES playlists (id), "
+    "rule TEXT NOT NULL, sort_order TEXT NOT NULL, "
+    "last_change INTEGER NOT NULL)",
+
+    # AUTOINCREMENT so that numbers aren't handed out again once pruned
+    "CREATE TABLE IF NOT EXISTS audio_changes ("
+    "seq INTEGER PRIMARY KEY AUTOINCREMENT, audio_id INTEGER NOT NULL)",
+
+    "CREATE TRIGGER IF NOT EXISTS audio_changes_insert AFTER INSERT ON audio "
+    "WHEN EXISTS (SELECT 1 FROM smart_playlists) "
+    "BEGIN INSERT INTO audio_changes (audio_id) VALUES (new.id); END",
+
+    "CREATE TRIGGER IF NOT EXISTS audio_changes_delete AFTER DELETE ON audio "
+    "WHEN EXISTS (SELECT 1 FROM smart_playlists) "
+    "BEGIN INSERT INTO audio_changes (audio_id) VALUES (old.id); END",
+
+    "CREATE TRIGGER IF NOT EXISTS audio_changes_update "
+    "AFTER UPDATE OF %s ON audio "
+    "WHEN EXISTS (SELECT 1 FROM smart_playlists) "
+    "BEGIN INSERT INTO audio_changes (audio_id) VALUES (new.id); END" %
+    ', '.join(FIELDS)
+]
+
+def install(engine):
+    """ Creates the smart playlist tables and the triggers logging changes
+        if they don't exist yet """
+    connection = engine.connect()
+    try:
+        for ddl in _ddl:
+            connection.execute(ddl)
+    finally:
+        connection.close()
+
+def last_change(session):
+    """ The number of the latest change logged, 0 if there's none """
+    return session.execute(text(
+        "SELECT COALESCE(MAX(seq), 0) FROM audio_changes")).scalar()
+
+def save(session, playlist_id, rule, order, since):
+    """ Makes the playlist smart, up to date with the changes up to since """
+    session.execute(text(
+        "INSERT OR REPLACE INTO smart_playlists "
+        "(playlist_id, rule, sort_order, last_change) "
+        "VALUES (:id, :rule, :order, :since)"),
+        {'id': playlist_id, 'rule': json.dumps(rule), 'order': order,
+         'since': since})
+
+def load(session, playlist_id):
+    """ The (rule, order, last_change) of a smart playlist, or None if the
+        playlist isn't smart """
+    row = session.execute(text(
+        "SELECT rule, sort_order, last_change FROM smart_playlists "
+        "WHERE playlist_id = :id"), {'id': playlist_id}).fetchone()
+    if row is None:
+        return None
+    return (json.loads(row[0]), row[1], row[2])
+
+def playlist_names(session):
+    return [name for name, in session.execute(text(
+        "SELECT playlists.name FROM smart_playlists JOIN playlists "
+        "ON smart_playlists.playlist_id = playlists.id "
+        "ORDER BY playlists.name"))]
+
+def changes(session, since):
+    """ The ids of the audio changed after change since, and the number of
+        the latest change """
+    rows = session.execute(text(
+        "SELECT audio_id, MAX(seq) FROM audio_changes WHERE seq > :since "
+        "GROUP BY audio_id"), {'since': since}).fetchall()
+    return ([audio_id for audio_id, seq in rows],
+            max([seq for audio_id, seq in rows] or [since]))
+
+def mark(session, playlist_id, since):
+    """ Records that the playlist is up to date with the changes up to
+        since, and forgets the changes every smart playlist has seen """
+    session.execute(text(
+        "UPDATE smart_playlists SET last_change = :since "
+        "WHERE playlist_id = :id"), {'id': playlist_id, 'since': since})
+    prune(session)
+
+def remove(session, playlist_id):
+    session.execute(text(
+        "DELETE FROM smart_playlists WHERE playlist_id = :id"),
+        {'id': playlist_id})
+    prune(session)
+
+def prune(session):
+    # with no smart playlists left, nothing is logged and nothing is needed
+    session.execute(text(
+        "DELETE FROM audio_changes WHERE NOT EXISTS "
+        "(SELECT 1 FROM smart_playlists) OR seq <= "
+        "(SELECT MIN(last_change) FROM smart_playlists)"))
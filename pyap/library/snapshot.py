@@ -0,0 +1,307 @@
+# Pyap - The Python Audio Player Library
+#
+# Copyright (c) 2012 Joel Griffith
+# Copyright (c) 2005 Joe Wreschnig
+# Copyright (c) 2002 David I. Lehn
+# Copyright (c) 2005-2011 the SQLAlchemy authors and contributors
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+from sqlalchemy import select
+
+from pyap.audio import Audio
+from pyap.playlist import Playlist
+from pyap.library.db import audio_table, playlist_table
+from pyap.library.db import audio_playlist_table
+
+# A snapshot is a read-only copy of the audio and playlists tables laid out
+# to be used straight from a memory-mapped file. After a header comes a
+# table of (offset, length) sections, each one column:
+#   - fixed-size columns: one little-endian value per row
+#   - string columns: n+1 uint32 offsets into a heap of UTF-8 bytes
+#   - sorted orders: uint32 row numbers, for binary searches by uri and
+#     by playlist name
+#   - playlist entries: per playlist, a run of audio row numbers
+# Opening one reads the header alone, however big the catalog
+
+MAGIC = b'PYAPSNAP'
+VERSION = 1
+
+_HEADER = struct.Struct('<8sIIII')
+_SECTION = struct.Struct('<QQ')
+
+_STRINGS = ('uri', 'artist', 'title', 'album', 'year')
+# name, struct/array code
+_FIXED = (('id', 'i'), ('type', 'b'), ('track', 'i'), ('length', 'i'))
+
+_SECTIONS = (
+    ['id', 'type', 'track', 'length'] +
+    [name + suffix for name in _STRINGS for suffix in ('_offsets', '_heap')] +
+    ['uri_order', 'playlist_offsets', 'playlist_heap', 'playlist_order',
+     'entry_offsets', 'entries']
+)
+
+def _array_bytes(column):
+    if sys.byteorder == 'big':
+        column = array(column.typecode, column)
+        column.byteswap()
+    if hasattr(column, 'tobytes'):
+        return column.tobytes()
+    return column.tostring()
+
+def _encode(value):
+    if value is None:
+        return b''
+    if not isinstance(value, type(u'')):
+        value = u'%s' % value
+    return value.encode('utf-8')
+
+class _StringColumn(object):
+    def __init__(self):
+        self.offsets = array('I', [0])
+        self.heap = []
+        self.size = 0
+
+    def append(self, value):
+        value = _encode(value)
+        self.heap.append(value)
+        self.size += len(value)
+        if self.size >= 1 << 32:
+            raise ValueError("Too much text for a snapshot column")
+        self.offsets.append(self.size)
+
+def write(session, uri):
+    """ Writes a snapshot of the library session is bound to to the file at
+        uri. Audio is stored in id order """
+    c = audio_table.c
+    fixed = dict((name, array(code)) for name, code in _FIXED)
+    strings = dict((name, _StringColumn()) for name in _STRINGS)
+    rows = {}
+    query = select([c.id, c.type, c.track, c.length, c.uri, c.artist,
+                    c.title, c.album, c.year]).order_by(c.id)
+    for row in session.execute(query):
+        rows[row[0]] = len(rows)
+        for (name, code), value in zip(_FIXED, row[:4]):
+            fixed[name].append(value if value is not None else -1)
+        for name, value in zip(_STRINGS, row[4:]):
+            strings[name].append(value)
+
+    uris = strings['uri']
+    encoded_uris = uris.heap
+    uri_order = array('I', sorted(range(len(rows)),
+                                  key=encoded_uris.__getitem__))
+
+    names = _StringColumn()
+    entry_offsets = array('I', [0])
+    entries = array('I')
+    playlists = list(session.execute(select([playlist_table.c.id,
+                                             playlist_table.c.name])
+                                     .order_by(playlist_table.c.id)))
+    e = audio_playlist_table.c
+    for id, name in playlists:
+        names.append(name)
+        query = select([e.audio_id], e.playlist_id == id).order_by(e.position)
+        entries.extend(rows[audio_id] for audio_id, in session.execute(query)
+                       if audio_id in rows)
+        entry_offsets.append(len(entries))
+    playlist_order = array('I', sorted(range(len(playlists)),
+                                       key=names.heap.__getitem__))
+
+    sections = {}
+    for name, code in _FIXED:
+        sections[name] = _array_bytes(fixed[name])
+    for name in _STRINGS:
+        sections[name + '_offsets'] = _array_bytes(strings[name].offsets)
+        sections[name + '_heap'] = b''.join(strings[name].heap)
+    sections['uri_order'] = _array_bytes(uri_order)
+    sections['playlist_offsets'] = _array_bytes(names.offsets)
+    sections['playlist_heap'] = b''.join(names.heap)
+    sections['playlist_order'] = _array_bytes(playlist_order)
+    sections['entry_offsets'] = _array_bytes(entry_offsets)
+    sections['entries'] = _array_bytes(entries)
+
+    file = open(uri, 'wb')
+    try:
+        offset = _HEADER.size + _SECTION.size * len(_SECTIONS)
+        table = []
+        for name in _SECTIONS:
+            # keep every column aligned for the fixed-size reads
+            offset += -offset % 4
+            table.append((offset, len(sections[name])))
+            offset += len(sections[name])
+        file.write(_HEADER.pack(MAGIC, VERSION, len(rows), len(playlists),
+                                len(entries)))
+        for section in table:
+            file.write(_SECTION.pack(*section))
+        for name, (offset, length) in zip(_SECTIONS, table):
+            file.write(b'\0' * (offset - file.tell()))
+            file.write(sections[name])
+    finally:
+        file.close()
+
+class Snapshot(object):
+    """ A read-only view of a library written by write (or
+        Library.export_snapshot), served from the memory-mapped file.
+        Opening it costs the same for any size of catalog; looking up an
+        audio by uri or id is a binary search and only touches the pages
+        it reads """
+    def __init__(self, uri):
+        self.uri = uri
+        self._fixed = dict((name, struct.Struct('<' + code))
+                           for name, code in _FIXED)
+        file = open(uri, 'rb')
+        try:
+            # an empty file can't even be mapped
+            if os.fstat(file.fileno()).st_size < _HEADER.size:
+                raise self._invalid()
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            file.close()
+        try:
+            self._read_header()
+        except ValueError:
+            self._map.close()
+            raise
+
+    def _invalid(self):
+        return ValueError("'%s' is not a version %d snapshot" %
+                          (self.uri, VERSION))
+
+    def _read_header(self):
+        if len(self._map) < _HEADER.size + _SECTION.size * len(_SECTIONS):
+            raise self._invalid()
+        magic, version, self._count, self._playlist_count, entries = \
+            _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise self._invalid()
+        # the size every section but the heaps must have, so that reads
+        # within the counts stay inside the file
+        sizes = {'uri_order': 4 * self._count,
+                 'playlist_offsets': 4 * (self._playlist_count + 1),
+                 'playlist_order': 4 * self._playlist_count,
+                 'entry_offsets': 4 * (self._playlist_count + 1),
+                 'entries': 4 * entries}
+        for name, column in self._fixed.items():
+            sizes[name] = column.size * self._count
+        for name in _STRINGS:
+            sizes[name + '_offsets'] = 4 * (self._count + 1)
+        self._sections = {}
+        for i, name in enumerate(_SECTIONS):
+            offset, length = _SECTION.unpack_from(
+                self._map, _HEADER.size + _SECTION.size * i)
+            if (offset + length > len(self._map) or
+                    sizes.get(name, length) != length):
+                raise self._invalid()
+            self._sections[name] = offset
+
+    def close(self):
+        self._map.close()
+
+    def __len__(self):
+        return self._count
+
+    def _value(self, name, i):
+        column = self._fixed[name]
+        return column.unpack_from(self._map,
+                                  self._sections[name] + column.size * i)[0]
+
+    def _bytes(self, column, i):
+        start, end = struct.unpack_from('<II', self._map,
+                                        self._sections[column + '_offsets'] +
+                                        4 * i)
+        heap = self._sections[column + '_heap']
+        return self._map[heap + start:heap + end]
+
+    def _string(self, column, i):
+        return self._bytes(column, i).decode('utf-8')
+
+    def _order(self, name, i):
+        return struct.unpack_from('<I', self._map,
+                                  self._sections[name] + 4 * i)[0]
+
+    def row(self, i):
+        """ The columns of the i-th audio, in id order, as a dict """
+        if not 0 <= i < self._count:
+            raise IndexError("snapshot index out of range")
+        row = dict((name, self._value(name, i)) for name, code in _FIXED)
+        for name in _STRINGS:
+            row[name] = self._string(name, i)
+        return row
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self._count
+        row = self.row(i)
+        id = row.pop('id')
+        audio = Audio(row.pop('uri'), **row)
+        audio.id = id
+        return audio
+
+    def __iter__(self):
+        for i in range(self._count):
+            yield self[i]
+
+    def _search(self, order, column, count, key):
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._bytes(column, self._order(order, mid)) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < count:
+            i = self._order(order, lo)
+            if self._bytes(column, i) == key:
+                return i
+        return None
+
+    def audio_by_uri(self, uri):
+        i = self._search('uri_order', 'uri', self._count, _encode(uri))
+        return self[i] if i is not None else None
+
+    def audio_by_index(self, index):
+        # rows are in id order
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._value('id', mid) < index:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._count and self._value('id', lo) == index:
+            return self[lo]
+        return None
+
+    def playlist_names(self):
+        return [self._string('playlist', i)
+                for i in range(self._playlist_count)]
+
+    def playlist_by_name(self, name):
+        i = self._search('playlist_order', 'playlist', self._playlist_count,
+                         _encode(name))
+        if i is None:
+            return None
+        start, end = struct.unpack_from('<II', self._map,
+                                        self._sections['entry_offsets'] +
+                                        4 * i)
+        return Playlist(name, [self[self._order('entries', j)]
+                               for j in range(start, end)])
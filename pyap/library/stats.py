@@ -0,0 +1,157 @@
+# Pyap - The Python Audio Player Library
+#
+# Copyright (c) 2012 Joel Griffith
+# Copyright (c) 2005 Joe Wreschnig
+# Copyright (c) 2002 David I. Lehn
+# Copyright (c) 2005-2011 the SQLAlchemy authors and contributors
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+from sqlalchemy import text
+
+# aggregate tables of track count and total length (in seconds, unknown
+# lengths count as 0) per artist, per album of an artist and per year,
+# kept up to date by triggers on the audio table like the search index.
+# missing tags are grouped under ''
+GROUPS = {
+    'artist': ('artist',),
+    'album': ('artist', 'album'),
+    'year': ('year',)
+}
+
+def _table(group):
+    return '%s_stats' % group
+
+def _match(keys, row):
+    return ' AND '.join("%s = COALESCE(%s.%s, '')" % (key, row, key)
+                        for key in keys)
+
+# the row of a new group is added where there's none rather than by
+# INSERT OR IGNORE, which an INSERT ... ON CONFLICT on audio would override
+def _add(group, keys):
+    return (
+        "INSERT INTO %(table)s (%(keys)s, tracks, length) "
+        "SELECT %(values)s, 0, 0 WHERE NOT EXISTS "
+        "(SELECT 1 FROM %(table)s WHERE %(match)s); "
+        "UPDATE %(table)s SET tracks = tracks + 1, "
+        "length = length + MAX(COALESCE(new.length, 0), 0) "
+        "WHERE %(match)s; " % {
+            'table': _table(group),
+            'keys': ', '.join(keys),
+            'values': ', '.join("COALESCE(new.%s, '')" % key for key in keys),
+            'match': _match(keys, 'new')
+        })
+
+def _remove(group, keys):
+    return (
+        "UPDATE %(table)s SET tracks = tracks - 1, "
+        "length = length - MAX(COALESCE(old.length, 0), 0) "
+        "WHERE %(match)s; "
+        "DELETE FROM %(table)s WHERE %(match)s AND tracks <= 0; " % {
+            'table': _table(group),
+            'match': _match(keys, 'old')
+        })
+
+_ddl = []
+for _group, _keys in sorted(GROUPS.items()):
+    _ddl.append(
+        "CREATE TABLE IF NOT EXISTS %s (%s, tracks INTEGER NOT NULL, "
+        "length INTEGER NOT NULL, PRIMARY KEY (%s))" % (
+            _table(_group), ', '.join('%s TEXT NOT NULL' % key
+                                      for key in _keys), ', '.join(_keys)))
+
+_ddl += [
+    "CREATE TRIGGER IF NOT EXISTS audio_stats_insert AFTER INSERT ON audio "
+    "BEGIN " + ''.join(_add(group, keys) for group, keys in
+                       sorted(GROUPS.items())) + "END",
+
+    "CREATE TRIGGER IF NOT EXISTS audio_stats_delete AFTER DELETE ON audio "
+    "BEGIN " + ''.join(_remove(group, keys) for group, keys in
+                       sorted(GROUPS.items())) + "END",
+
+    "CREATE TRIGGER IF NOT EXISTS audio_stats_update "
+    "AFTER UPDATE OF artist, album, year, length ON audio "
+    "BEGIN " + ''.join(_remove(group, keys) + _add(group, keys)
+                       for group, keys in sorted(GROUPS.items())) + "END"
+]
+
+def install(engine):
+    """ Creates the aggregate tables and their triggers if they don't exist
+        yet, filling them from whatever audio is already there """
+    connection = engine.connect()
+    try:
+        exists = connection.execute("SELECT name FROM sqlite_master "
+                                    "WHERE name = 'artist_stats'").fetchone()
+        # triggers written by an earlier version are replaced
+        for name, sql in connection.execute(
+                "SELECT name, sql FROM sqlite_master WHERE type = 'trigger' "
+                "AND name LIKE 'audio_stats_%'").fetchall():
+            if sql not in [ddl.replace('IF NOT EXISTS ', '') for ddl in _ddl]:
+                connection.execute("DROP TRIGGER %s" % name)
+        for ddl in _ddl:
+            connection.execute(ddl)
+        if exists is None:
+            rebuild(connection)
+    finally:
+        connection.close()
+
+def rebuild(connection):
+    """ Recomputes every aggregate from the audio table """
+    transaction = connection.begin()
+    for group, keys in GROUPS.items():
+        columns = ', '.join("COALESCE(%s, '')" % key for key in keys)
+        connection.execute("DELETE FROM %s" % _table(group))
+        connection.execute(
+            "INSERT INTO %s (%s, tracks, length) "
+            "SELECT %s, COUNT(*), SUM(MAX(COALESCE(length, 0), 0)) "
+            "FROM audio GROUP BY %s" % (_table(group), ', '.join(keys),
+                                        columns, columns))
+    transaction.commit()
+
+def group_stats(session, group, where=None, order=None, descending=False,
+                limit=None):
+    """ Returns the rows of one aggregate table as (keys..., tracks,
+        length) tuples. where maps key columns to values that rows have to
+        match, order is a column to sort by (the keys by default) """
+    if group not in GROUPS:
+        raise ValueError("Unknown group '%s'" % group)
+    keys = GROUPS[group]
+    columns = keys + ('tracks', 'length')
+    where = where or {}
+    for column in list(where) + ([order] if order else []):
+        if column not in columns:
+            raise ValueError("'%s' is not a column of %s" % (column, group))
+
+    sql = "SELECT %s FROM %s" % (', '.join(columns), _table(group))
+    params = {}
+    if where:
+        sql += " WHERE " + " AND ".join("%s = :%s" % (key, key)
+                                        for key in sorted(where))
+        params.update(where)
+    order = [order] if order else list(keys)
+    sql += " ORDER BY " + ", ".join("%s%s" % (column,
+                                              " DESC" if descending else "")
+                                    for column in order)
+    if limit is not None:
+        sql += " LIMIT :limit"
+        params['limit'] = limit
+    return [tuple(row) for row in session.execute(text(sql), params)]
+
+def totals(session):
+    """ The (tracks, length) of the whole library, summed over artists """
+    tracks, length = session.execute(text(
+        "SELECT SUM(tracks), SUM(length) FROM artist_stats")).fetchone()
+    return (tracks or 0, length or 0)
@@ -0,0 +1,321 @@
+# Pyap - The Python Audio Player Library
+#
+# Copyright (c) 2012 Joel Griffith
+# Copyright (c) 2005 Joe Wreschnig
+# Copyright (c) 2002 David I. Lehn
+# Copyright (c) 2005-2011 the SQLAlchemy authors and contributors
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+from pyap.util import get_extension, is_audio
+
+log = logging.getLogger(__name__)
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# IN_CLOSE_WRITE rather than IN_MODIFY so a file is read once it's
+# written, not once per write
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR)
+
+_EVENT = struct.Struct('iIII')
+
+class _Inotify(object):
+    """ The inotify calls of libc, through ctypes. Raises OSError when
+        inotify isn't available or its limits are reached """
+    def __init__(self):
+        name = ctypes.util.find_library('c')
+        try:
+            libc = ctypes.CDLL(name, use_errno=True)
+            libc.inotify_init1
+        except (OSError, AttributeError):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self._libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            self._raise()
+        self.paths = {}
+        self.watches = {}
+
+    def _raise(self, path=None):
+        code = ctypes.get_errno()
+        raise OSError(code, os.strerror(code), path)
+
+    def add_watch(self, path):
+        encoded = path
+        if isinstance(path, type(u'')):
+            encoded = path.encode(sys.getfilesystemencoding())
+        wd = self._libc.inotify_add_watch(self.fd, encoded, WATCH_MASK)
+        if wd < 0:
+            self._raise(path)
+        self.paths[wd] = path
+        self.watches[path] = wd
+
+    def remove_watches(self, directory):
+        """ Stops watching directory and everything under it """
+        prefix = os.path.join(directory, u'')
+        for path in list(self.watches):
+            if path == directory or path.startswith(prefix):
+                self._libc.inotify_rm_watch(self.fd, self.watches.pop(path))
+
+    def read(self, timeout):
+        """ Waits up to timeout seconds for events and returns them as
+            (path, mask) tuples """
+        readable = select.select([self.fd], [], [], timeout)[0]
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return []
+            raise
+        events = []
+        offset = 0
+        while offset + _EVENT.size <= len(data):
+            wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset+length].rstrip(b'\0')
+            offset += length
+            directory = self.paths.get(wd)
+            if mask & IN_IGNORED:
+                # the kernel dropped the watch, the directory is gone
+                path = self.paths.pop(wd, None)
+                if self.watches.get(path) == wd:
+                    del self.watches[path]
+                continue
+            if directory is None and not mask & IN_Q_OVERFLOW:
+                continue
+            path = directory
+            if name:
+                try:
+                    name = name.decode(sys.getfilesystemencoding())
+                except UnicodeDecodeError:
+                    continue
+                path = os.path.join(directory, name)
+            events.append((path, mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class LibraryWatcher(object):
+    """ Keeps a library in line with the audio files under some roots from
+        a thread of its own. With inotify (Linux) every directory is
+        watched and changes are collected until none arrived for delay
+        seconds, or for at most max_delay seconds during a steady stream
+        of them, then handed to Library.refresh in one batch. When inotify
+        isn't available or its watch limit runs out, and whenever events
+        were lost, the roots are rescanned instead: every poll_interval
+        seconds in polling mode. workers, threads and fast are passed on
+        for reading tags. on_update, if given, is called from the watcher
+        thread with the (added, updated, removed) counts of each batch. A
+        batch that fails is logged and tried again, with whatever changed
+        since, max_delay seconds later. With initial_scan the roots are
+        rescanned before watching starts """
+    def __init__(self, library, roots, delay=0.5, max_delay=5.0,
+                 poll_interval=60.0, workers=0, threads=False,
+                 fast=False, on_update=None, initial_scan=True,
+                 use_inotify=True):
+        if isinstance(roots, basestring):
+            roots = [roots]
+        self.library = library
+        self.roots = [unicode(os.path.abspath(root)) for root in roots]
+        self.delay = delay
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self.workers = workers
+        self.threads = threads
+        self.fast = fast
+        self.on_update = on_update
+        self.initial_scan = initial_scan
+        self.use_inotify = use_inotify
+        self.mode = None
+        self._inotify = None
+        self._pending = set()
+        self._overflow = False
+        self._first = self._last = None
+        self._retry_at = None
+        self._stopping = threading.Event()
+        self._ready = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """ Starts watching and returns once the watches are in place """
+        self._thread = threading.Thread(target=self._run,
+                                        name='pyap-library-watcher')
+        self._thread.daemon = True
+        self._thread.start()
+        self._ready.wait()
+
+    def stop(self):
+        """ Stops watching; pending changes are written first """
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        try:
+            self._setup()
+            if self.initial_scan:
+                self._update(rescan=True)
+        finally:
+            self._ready.set()
+        try:
+            while not self._stopping.is_set():
+                if self.mode == 'inotify':
+                    self._wait_for_events()
+                elif not self._stopping.wait(self.poll_interval):
+                    self._overflow = True
+                if self._due():
+                    self._update()
+            if self._pending or self._overflow:
+                self._update()
+        finally:
+            if self._inotify is not None:
+                self._inotify.close()
+            self.library.close_session()
+
+    def _setup(self):
+        if self.use_inotify:
+            try:
+                self._inotify = _Inotify()
+                for root in self.roots:
+                    self._watch_tree(root)
+                self.mode = 'inotify'
+                return
+            except OSError:
+                self._fall_back()
+        self.mode = 'polling'
+
+    def _fall_back(self):
+        # out of watches (or no inotify at all): poll instead
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+        self.mode = 'polling'
+
+    def _watch_tree(self, directory):
+        self._inotify.add_watch(directory)
+        for path, directories, files in os.walk(directory):
+            directories[:] = [d for d in directories if not d.startswith('.')]
+            for name in directories:
+                self._inotify.add_watch(os.path.join(path, name))
+
+    def _wait_for_events(self):
+        timeout = 0.5
+        if self._first is not None:
+            timeout = min(timeout, max(self._deadline() - time.time(), 0))
+        try:
+            events = self._inotify.read(timeout)
+        except OSError:
+            self._fall_back()
+            self._overflow = True
+            return
+        for path, mask in events:
+            if self.mode != 'inotify':
+                # fell back while noting, the rescan covers the rest
+                break
+            self._note(path, mask)
+
+    def _note(self, path, mask):
+        now = time.time()
+        if mask & IN_Q_OVERFLOW:
+            # events were lost, only a rescan will do
+            self._overflow = True
+        elif mask & IN_ISDIR:
+            if os.path.basename(path).startswith('.'):
+                return
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                try:
+                    self._watch_tree(path)
+                except OSError:
+                    self._fall_back()
+                    self._overflow = True
+            elif mask & IN_MOVED_FROM:
+                # the watches would go on reporting under the old path
+                self._inotify.remove_watches(path)
+            self._pending.add(path)
+        elif mask & IN_DELETE_SELF:
+            self._pending.add(path)
+        else:
+            ext = get_extension(path)
+            if ext is None or not is_audio(ext):
+                return
+            self._pending.add(path)
+        if self._first is None:
+            self._first = now
+        self._last = now
+
+    def _deadline(self):
+        deadline = min(self._last + self.delay, self._first + self.max_delay)
+        if self._retry_at is not None:
+            deadline = max(deadline, self._retry_at)
+        return deadline
+
+    def _due(self):
+        if self._overflow:
+            return self._retry_at is None or time.time() >= self._retry_at
+        return self._first is not None and time.time() >= self._deadline()
+
+    def _update(self, rescan=False):
+        pending, self._pending = self._pending, set()
+        rescan, self._overflow = rescan or self._overflow, False
+        self._first = self._last = None
+        try:
+            if rescan:
+                counts = self.library.rescan(self.roots, self.workers,
+                                             self.threads, fast=self.fast)
+            else:
+                counts = self.library.refresh(pending, self.workers,
+                                              self.threads, fast=self.fast)
+        except Exception:
+            # keep watching, and keep the changes to try again with what
+            # comes in after max_delay
+            log.exception("Failed to update the library from %s",
+                          ', '.join(self.roots))
+            self._pending |= pending
+            self._overflow = self._overflow or rescan
+            self._first = self._last = time.time()
+            self._retry_at = self._first + self.max_delay
+            return
+        self._retry_at = None
+        if self.on_update is not None:
+            self.on_update(counts)
@@ -0,0 +1,188 @@
+# Pyap - The Python Audio Player Library
+#
+# Copyright (c) 2012 Joel Griffith
+# Copyright (c) 2005 Joe Wreschnig
+# Copyright (c) 2002 David I. Lehn
+# Copyright (c) 2005-2011 the SQLAlchemy authors and contributors
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import logging
+import Queue
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# the Library methods a WriteBehind can queue
+WRITES = (
+    'add_audio',
+    'remove_audio',
+    'add_audio_by_uri',
+    'remove_audio_by_uri',
+    'bulk_load',
+    'add_playlist',
+    'remove_playlist',
+    'add_to_playlist',
+    'insert_in_playlist',
+    'remove_from_playlist',
+    'move_in_playlist'
+)
+
+class _Barrier(object):
+    def __init__(self):
+        self.done = threading.Event()
+
+class WriteBehind(object):
+    """ Queues writes to a Library and commits them from a thread of its
+        own, many to a transaction: a batch is committed once it holds
+        max_batch writes or max_delay seconds after its first write arrived.
+        The writes in WRITES are methods of the same name taking the same
+        arguments plus an optional callback, called from the writer thread
+        with None once the write is committed or with the exception it
+        raised. Objects passed in belong to the writer until then. A
+        failing write doesn't take the rest of its batch with it; the batch
+        is rolled back and its writes committed one by one """
+    def __init__(self, library, max_batch=500, max_delay=0.05):
+        self.library = library
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.batches = 0
+        self.writes = 0
+        self.failures = 0
+        self._queue = Queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run,
+                                        name='pyap-library-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __getattr__(self, name):
+        if name in WRITES:
+            def write(*args, **kwargs):
+                self.submit(name, *args, **kwargs)
+            return write
+        raise AttributeError(name)
+
+    def submit(self, method, *args, **kwargs):
+        """ Queues library.method(*args, **kwargs) """
+        callback = kwargs.pop('callback', None)
+        if method not in WRITES:
+            raise ValueError("'%s' can't be written behind" % method)
+        if self._closed:
+            raise ValueError("Write-behind queue is closed")
+        self._queue.put((method, args, kwargs, callback))
+
+    def flush(self, timeout=None):
+        """ Blocks until every write queued so far is committed. Returns
+            False if timeout ran out first """
+        barrier = _Barrier()
+        self._queue.put(barrier)
+        deadline = None if timeout is None else time.time() + timeout
+        # nobody is left to set it if the writer thread died
+        while not barrier.done.is_set() and self._thread.is_alive():
+            wait = 0.1
+            if deadline is not None:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0:
+                    break
+            barrier.done.wait(wait)
+        return barrier.done.is_set()
+
+    def pending(self):
+        """ Roughly how many writes are waiting """
+        return self._queue.qsize()
+
+    def close(self):
+        """ Commits what's queued and stops the writer thread """
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            batch, barriers, stop = self._next_batch()
+            try:
+                if batch:
+                    self._write(batch)
+            finally:
+                for barrier in barriers:
+                    barrier.done.set()
+            if stop:
+                self.library.close_session()
+                return
+
+    def _next_batch(self):
+        batch = []
+        barriers = []
+        item = self._queue.get()
+        deadline = time.time() + self.max_delay
+        while True:
+            if item is None:
+                return (batch, barriers, True)
+            if isinstance(item, _Barrier):
+                # whoever is waiting shouldn't wait out the window too
+                barriers.append(item)
+                return (batch, barriers, False)
+            batch.append(item)
+            remaining = deadline - time.time()
+            if len(batch) >= self.max_batch or remaining <= 0:
+                return (batch, barriers, False)
+            try:
+                item = self._queue.get(timeout=remaining)
+            except Queue.Empty:
+                return (batch, barriers, False)
+
+    def _write(self, batch):
+        library = self.library
+        session = library.Session()
+        library._local.batch = True
+        try:
+            for method, args, kwargs, callback in batch:
+                getattr(library, method)(*args, **kwargs)
+            library._local.batch = False
+            session.commit()
+        except Exception as e:
+            library._local.batch = False
+            library._rollback(session)
+            if len(batch) > 1:
+                for write in batch:
+                    self._write([write])
+                return
+            self.failures += 1
+            self._done(batch, e)
+            return
+        self.batches += 1
+        self.writes += len(batch)
+        try:
+            # the writes are in, so a failure from here on mustn't have
+            # them retried
+            library._after_commit()
+        except Exception:
+            log.exception("Failed after committing a write-behind batch")
+        self._done(batch, None)
+
+    def _done(self, batch, error):
+        for method, args, kwargs, callback in batch:
+            if callback is None:
+                continue
+            try:
+                callback(error)
+            except Exception:
+                # a broken callback mustn't stop the writer
+                log.exception("Write-behind callback for %s failed", method)
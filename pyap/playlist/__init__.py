@@ -21,6 +21,8 @@
 # Boston, MA 02111-1307, USA.
 
 import random
+from bisect import bisect_left, bisect_right, insort
+from operator import attrgetter
 
 from pyap.util import get_extension
 from pyap.playlist.decoder import get_decoder
@@ -31,33 +33,144 @@ REPEAT_ONE = 0
 REPEAT_ALL = 1
 REPEAT_OFF = 2
 
+# the fields Playlist.sort sorts by, in turn. 'artist' is the order of
+# Audio.__cmp__: by artist, then the artist's albums by year, then tracks
+SORT_ORDERS = {
+    'artist': ('artist', 'year', 'album', 'track', 'title'),
+    'album': ('album', 'track', 'title'),
+    'title': ('title',),
+    'year': ('year', 'artist', 'album', 'track', 'title'),
+    'length': ('length', 'title')
+}
+
+# fields compared by collation_key rather than as they are
+COLLATED = ('artist', 'album', 'title')
+
+# leading words that don't count when sorting, as in "The Beatles"
+ARTICLES = (u'the', u'a', u'an')
+
+# the spacing of the keys Playlist orders its entries by, so that many
+# entries can go in between two others before they're renumbered
+_ENTRY_GAP = 1 << 32
+
 # imports a playlist in a different format (.m3u, .pls, etc.) and returns
-# a Playlist object
-def import_playlist(playlist_uri):
+# a Playlist object. lazy defers reading the tags of its audio until they're
+# used, see Audio
+def import_playlist(playlist_uri, lazy=False):
     ext = get_extension(playlist_uri)
     decoder = get_decoder(ext)
-    return decoder.decode(playlist_uri)
+    return decoder.decode(playlist_uri, lazy)
 
 # TODO: add a history of played audio so that when a user manually
 #       selects an audio, using previous() will make sense
 
-class Playlist(object):
-    def __init__(self, name, audio_list=[]):
+class Playback(object):
+    """ Walking through audio in play order with repeat, shared by Playlist
+        and VirtualPlaylist (see pyap.playlist.virtual). Subclasses provide
+        __len__ and _audio_at, the audio at a position in play order """
+    current_index = 0
+    _shuffle = False
+    _repeat = REPEAT_ALL
+
+    def is_shuffling(self):
+        return self._shuffle
+
+    def set_repeat(self, setting):
+        self._repeat = setting
+
+    def get_repeat(self):
+        return self._repeat
+        
+    def is_repeating(self):
+        return self.is_repeating_one() or self.is_repeating_all()
+        
+    def is_repeating_one(self):
+        return self._repeat == REPEAT_ONE
+
+    def is_repeating_all(self):
+        return self._repeat == REPEAT_ALL
+        
+    def peek_next(self):
+        """ Returns the next Audio object in the list after the current """
+        if self.is_repeating_one():
+            return self._audio_at(self.current_index)
+        elif self.is_repeating_all():
+            if self.current_index+1 == len(self):
+                return self._audio_at(0)
+            return self._audio_at(self.current_index+1)
+        elif not self.is_repeating():
+            if self.current_index+1 == len(self):
+                return None
+            return self._audio_at(self.current_index+1)
+
+    # FIXME: this doesn't account for the case where it's set to repeat one
+    #        song (and it has at least once). Is this an issue?
+    def peek_previous(self):
+        if self.current_index == 0:
+            return self._audio_at(len(self)-1)
+        return self._audio_at(self.current_index-1)
+
+    def next(self):
+        """ Gets the next Audio object in the list and makes it the current """
+        audio = self.peek_next()
+        if self.is_repeating_all():
+            if self.current_index+1 == len(self):
+                self.current_index = 0
+            else:
+                self.current_index += 1
+        elif not self.is_repeating():
+            if self.current_index+1 == len(self):
+                self.current_index = 0
+            else:
+                self.current_index += 1
+        return audio
+
+    # FIXME: this, too, ignores the case where a single song is repeating
+    def previous(self):
+        audio = self.peek_previous()
+        if self.current_index == 0:
+            self.current_index = len(self) - 1
+        else:
+            self.current_index -= 1
+        return audio
+
+
+class Playlist(Playback):
+    """ Audio is told apart by uri: index, count, remove and in look it up
+        in an index of the entries of every uri. Each entry has a key, kept
+        in _order alongside the list in ascending order and spaced
+        _ENTRY_GAP apart, and the index holds keys rather than positions,
+        so an edit anywhere only touches the keys of the entries it adds
+        or removes; a position is found by bisecting _order. The uri of
+        every key is kept too, so the audio itself isn't read again (it
+        may be gone from the library by then, or built on demand by an
+        AudioTable).
+
+        current_index is a position in play order, which is the order of
+        the list unless shuffling. Every edit keeps it on the same audio """
+    # instances loaded by the library don't go through __init__
+    _keyed = None
+    _random = None
+    _ordered = None
+
+    def __init__(self, name, audio_list=None):
         self.name = name
-        self._audio_list = audio_list
+        self._audio_list = audio_list if audio_list is not None else []
         self.reset()
         
     def reset(self):
-        self.current_index = 0
         self.set_shuffle(False)
+        self.current_index = 0
         self.set_repeat(REPEAT_ALL)
-        self._reorder()
         
     def _reorder(self):
-        if self.is_shuffling():
-            self._order = random.shuffle(range(len(self._audio_list)))
-        else:
-            self._order = range(len(self._audio_list))
+        """ Starts the play order over once _audio_list was replaced: a new
+            shuffle if shuffling """
+        self._ordering()
+        if self.current_index >= len(self):
+            self.current_index = 0
+        if self._shuffle:
+            self._shuffle_all(None)
             
     def __len__(self):
         return len(self._audio_list)
@@ -75,27 +188,252 @@ class Playlist(object):
             
     def __setitem__(self, index, audio):
         if 0 <= index < len(self):
+            key = self._ordering()[index]
+            self._unindex(key)
+            self._uris[key] = audio.uri
+            insort(self._entries.setdefault(audio.uri, []), key)
             self._audio_list[index] = audio
                 
     def __delitem__(self, index):
         if 0 <= index < len(self):
+            rank = self._rank(index)
+            key = self._ordering().pop(index)
+            self._unindex(key)
             del self._audio_list[index]
-            self._reorder()
+            self._removed(key, rank)
             
     def __iter__(self):
         for audio in self._audio_list:
             yield audio
             
     def __contains__(self, audio):
-        return audio in self._audio_list
+        self._ordering()
+        return getattr(audio, 'uri', None) in self._entries
         
     def append(self, audio):
-        self._audio_list.append(audio)
-        self._reorder()
+        self.insert(len(self), audio)
         
     def extend(self, audio_list):
-        self._audio_list.extend(audio_list)
-        self._reorder()
+        for audio in audio_list:
+            self.insert(len(self), audio)
+
+    def insert(self, index, audio):
+        # where list.insert puts it
+        if index < 0:
+            index = max(len(self) + index, 0)
+        index = min(index, len(self))
+        shuffled = self._shuffled()
+        self._index_entry(index, audio.uri)
+        self._audio_list.insert(index, audio)
+        self._added(index, shuffled)
+
+    def move(self, old_index, new_index):
+        """ Moves the audio at old_index so that it ends up at new_index.
+            While shuffling this leaves the play order as it is """
+        if old_index < 0:
+            old_index += len(self)
+        shuffled = self._shuffled()
+        order = self._ordering()
+        key = order[old_index]
+        if shuffled:
+            # the entry gets a new key, but keeps its place in play order
+            rank = self._rank_of(key)
+            shuffle_key = self._shuffle_keys.pop(key)
+            self._shuffled_entries[rank] = None
+        audio = self._audio_list.pop(old_index)
+        uri = self._unindex(order.pop(old_index))
+        if new_index < 0:
+            new_index = max(len(self) + new_index, 0)
+        new_index = min(new_index, len(self))
+        self._index_entry(new_index, uri)
+        self._audio_list.insert(new_index, audio)
+        if shuffled:
+            key = self._order[new_index]
+            self._shuffle_keys[key] = shuffle_key
+            self._shuffled_entries[rank] = key
+            return
+        current = self.current_index
+        if current == old_index:
+            current = new_index
+        else:
+            if old_index < current:
+                current -= 1
+            if new_index <= current:
+                current += 1
+        self.current_index = current
+
+    def _ordering(self):
+        # the keys of the entries, numbered afresh if _audio_list was
+        # replaced since
+        if self._ordered is not self._audio_list:
+            self._order = [(i + 1) * _ENTRY_GAP
+                           for i in range(len(self._audio_list))]
+            self._uris = dict(zip(self._order,
+                                  (audio.uri for audio in self._audio_list)))
+            entries = {}
+            for key in self._order:
+                entries.setdefault(self._uris[key], []).append(key)
+            self._entries = entries
+            self._ordered = self._audio_list
+        return self._order
+
+    def _renumber(self, order):
+        # puts the entries in order, a list of their old positions, with
+        # their keys spaced out again
+        old = self._ordering()
+        old = [old[i] for i in order]
+        self._order = [(i + 1) * _ENTRY_GAP for i in range(len(old))]
+        self._rekey(dict(zip(old, self._order)), self._entries)
+
+    def _respace(self, index):
+        # spaces out the keys around index, over a wider stretch each time
+        # until they can be at least _ENTRY_GAP >> 16 apart
+        order = self._order
+        width = 16
+        while True:
+            lo, hi = max(index - width, 0), min(index + width, len(order))
+            low = order[lo-1] if lo > 0 else 0
+            if hi == len(order):
+                step = _ENTRY_GAP
+                break
+            step = (order[hi] - low) // (hi - lo + 1)
+            if step >= _ENTRY_GAP >> 16:
+                break
+            width *= 2
+        renumbered = {}
+        for i in range(lo, hi):
+            renumbered[order[i]] = order[i] = low + step * (i - lo + 1)
+        self._rekey(renumbered, set(self._uris[key] for key in renumbered))
+
+    def _rekey(self, renumbered, uris):
+        # updates the entries of uris for renumbered, old keys to new. the
+        # old keys all go before the new ones are put in, as one may be
+        # the other's
+        moved = [(new, self._uris.pop(old))
+                 for old, new in renumbered.iteritems()]
+        self._uris.update(moved)
+        for uri in uris:
+            keys = self._entries[uri]
+            keys[:] = sorted(renumbered.get(key, key) for key in keys)
+        if self._shuffle and self._keyed is self._audio_list:
+            ranks = [(self._rank_of(old), new)
+                     for old, new in renumbered.iteritems()]
+            moved = [(new, self._shuffle_keys.pop(old))
+                     for old, new in renumbered.iteritems()]
+            self._shuffle_keys.update(moved)
+            for rank, new in ranks:
+                self._shuffled_entries[rank] = new
+
+    def _index_entry(self, index, uri):
+        # adds a key for an entry of uri that's about to go in at index
+        order = self._ordering()
+        low = order[index-1] if index > 0 else 0
+        high = order[index] if index < len(order) else low + 2 * _ENTRY_GAP
+        if high - low < 2:
+            self._respace(index)
+            return self._index_entry(index, uri)
+        key = (low + high) // 2
+        order.insert(index, key)
+        self._uris[key] = uri
+        insort(self._entries.setdefault(uri, []), key)
+
+    def _unindex(self, key):
+        # drops the entry with key from the index, returning its uri
+        uri = self._uris.pop(key)
+        keys = self._entries[uri]
+        del keys[bisect_left(keys, key)]
+        if not keys:
+            del self._entries[uri]
+        return uri
+
+    def _occurrence(self, index):
+        # how many entries of the same uri come before the one at index
+        key = self._ordering()[index]
+        return bisect_left(self._entries[self._uris[key]], key)
+
+    def _position(self, key):
+        # the index of the entry with key
+        return bisect_left(self._order, key)
+
+    # While shuffling, every entry has a random key in _shuffle_keys, by
+    # the key it's ordered by, and the play order is the order of the
+    # random keys. It's kept as the sorted random keys and the entries they
+    # belong to, so that audio is added to and deleted from it without
+    # touching the rest
+
+    def _shuffled(self):
+        # whether shuffling, with the keys made over if _audio_list was
+        # replaced since
+        if not self._shuffle:
+            return False
+        if self._keyed is not self._audio_list:
+            self._reorder()
+        return True
+
+    def _shuffle_all(self, first):
+        # new keys for all of the audio, with the audio at index first (if
+        # any) playing first
+        order = self._ordering()
+        rand = self._random.random
+        keys = [rand() for key in order]
+        if first is not None:
+            keys[first] = 0.0
+        ranks = sorted(range(len(keys)), key=keys.__getitem__)
+        self._shuffle_keys = dict(zip(order, keys))
+        self._shuffled_keys = [keys[i] for i in ranks]
+        self._shuffled_entries = [order[i] for i in ranks]
+        self._keyed = self._audio_list
+
+    def _rank_of(self, key):
+        # the position in play order of the entry with key
+        rank = bisect_left(self._shuffled_keys, self._shuffle_keys[key])
+        while self._shuffled_entries[rank] != key:
+            rank += 1
+        return rank
+
+    def _rank(self, index):
+        # the position in play order of the audio at index
+        if not self._shuffled():
+            return index
+        return self._rank_of(self._order[index])
+
+    def _index_at(self, rank):
+        # the index of the audio at a position in play order
+        if not self._shuffled():
+            return rank
+        return self._position(self._shuffled_entries[rank])
+
+    def _audio_at(self, rank):
+        return self._audio_list[self._index_at(rank)]
+
+    def _added(self, index, shuffled):
+        # audio was inserted at index
+        if shuffled:
+            # somewhere among the audio yet to play
+            low = 0.0
+            if self.current_index < len(self._shuffled_keys):
+                low = self._shuffled_keys[self.current_index]
+            shuffle_key = low + (1.0 - low) * self._random.random()
+            key = self._order[index]
+            self._shuffle_keys[key] = shuffle_key
+            rank = bisect_right(self._shuffled_keys, shuffle_key)
+            self._shuffled_keys.insert(rank, shuffle_key)
+            self._shuffled_entries.insert(rank, key)
+        else:
+            rank = index
+        if rank <= self.current_index and len(self) > 1:
+            self.current_index += 1
+
+    def _removed(self, key, rank):
+        # the entry with key, at rank in play order, was deleted
+        if self._shuffle:
+            del self._shuffle_keys[key]
+            del self._shuffled_keys[rank]
+            del self._shuffled_entries[rank]
+        if rank < self.current_index:
+            self.current_index -= 1
+        elif self.current_index >= len(self):
+            self.current_index = 0
             
     def remove(self, audio):
         index = self.index(audio)
@@ -110,21 +448,24 @@ class Playlist(object):
             return audio
             
     def index(self, audio):
-        for i, a in enumerate(self._audio_list):
-            if audio == a:
-                return i
-        raise Exception # FIXME: make more specific later
+        """ The first position of audio's uri, like list.index raises
+            ValueError if it isn't there """
+        self._ordering()
+        found = self._entries.get(getattr(audio, 'uri', None))
+        if not found:
+            raise ValueError("%r is not in the playlist" % (audio,))
+        return self._position(found[0])
         
     def count(self, audio):
-        count = 0
-        for a in self.audio_list:
-            if audio == a: 
-                count += 1
-        return count
+        self._ordering()
+        return len(self._entries.get(getattr(audio, 'uri', None), ()))
             
-    # FIXME: do this correctly
     def reverse(self):
-        self._audio_list = self._audio_list[::-1]
+        shuffled = self._shuffled()
+        self._renumber(range(len(self) - 1, -1, -1))
+        self._audio_list.reverse()
+        if not shuffled and len(self):
+            self.current_index = len(self) - 1 - self.current_index
     
     def clear(self):
         self._audio_list = []
@@ -137,107 +478,55 @@ class Playlist(object):
                 duration += audio.length
         return duration
 
-    def _order_by_album(self):
-        """ Assumes a pre-sorted list by artist """
-        i = 0
-        artist = self[i].artist
-        for j in range(len(self)):
-            if self[j].artist != artist:
-                quicksort(self, i, j-1, 'album')
-                i = j
-                artist = self[i].artist
-        quicksort(self, i, j-1, 'album')
-
-    def _order_by_track(self):
-        """ Assumes a pre-sorted list by album """
-        i = 0
-        album = self[i].album
-        for j in range(len(self)):
-            if self[j].album != album:
-                quicksort(self, i, j-1, 'track')
-                i = j
-                album = self[i].album
-        quicksort(self, i, j-1, 'track')
-
     def sort(self, by='artist'):
-        quicksort(self, 0, len(self)-1, by)
-        if by == 'artist':
-            self._order_by_album()
-        if by == 'album' or by == 'artist':
-            self._order_by_track()
+        """ Sorts the playlist in place by one of SORT_ORDERS. The sort is
+            stable and compares keys worked out once per audio, with the
+            collation keys of its tags kept from one sort to the next """
+        if by not in SORT_ORDERS:
+            raise ValueError("Unknown sort order '%s'" % by)
+        cache = self.__dict__.get('_collation_cache')
+        if cache is None or len(cache) > 4 * len(self) + 1024:
+            # mostly the tags of audio that has since left
+            cache = CollationCache()
+        keys = sort_keys(self._audio_list, SORT_ORDERS[by], cache)
+        self._collation_cache = cache
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        shuffled = self._shuffled()
+        self._renumber(order)
+        self._audio_list[:] = [self._audio_list[i] for i in order]
+        if not shuffled and len(self):
+            self.current_index = order.index(self.current_index)
 
     def all_audio(self, with_shuffle=True):
         """ Returns all Audio objects in the playlist, optionally in shuffle
             order. with_shuffle only has effect if already shuffling """
-        if with_shuffle and self.is_shuffling():
-            return [self._audio_list[i] for i in self._order]
+        if with_shuffle and self._shuffled():
+            positions = dict(zip(self._order, range(len(self))))
+            return [self._audio_list[positions[key]]
+                    for key in self._shuffled_entries]
         return self._audio_list
 
-    def set_shuffle(self, shuffle):
+    def set_shuffle(self, shuffle, seed=None):
+        """ Shuffling plays the audio in a random order that starts with
+            the current audio. Audio added meanwhile lands somewhere among
+            the audio yet to play and deleting audio leaves the order of
+            the rest. The order only depends on seed, if given, and the
+            current audio """
+        if seed is not None or self._random is None:
+            self._random = random.Random(seed)
+        current = None
+        if self.current_index < len(self):
+            current = self._index_at(self.current_index)
         self._shuffle = shuffle
-        self._reorder()
-        
-    def is_shuffling(self):
-        return self._shuffle
-
-    def set_repeat(self, setting):
-        self._repeat = setting
-
-    def get_repeat(self):
-        return self._repeat
-        
-    def is_repeating(self):
-        return self.is_repeating_one() or self.is_repeating_all()
-        
-    def is_repeating_one(self):
-        return self._repeat == REPEAT_ONE
-
-    def is_repeating_all(self):
-        return self._repeat == REPEAT_ALL
-        
-    def peek_next(self):
-        """ Returns the next Audio object in the list after the current """
-        if self.is_repeating_one():
-            return self._audio_list[self._order[self.current_index]]
-        elif self.is_repeating_all():
-            if self.current_index+1 == len(self):
-                return self._audio_list[self._order[0]]
-            return self._audio_list[self._order[self.current_index+1]]
-        elif not self.is_repeating():
-            if self.current_index+1 == len(self):
-                return None
-            return self._audio_list[self._order[self.current_index+1]]
-
-    # FIXME: this doesn't account for the case where it's set to repeat one
-    #        song (and it has at least once). Is this an issue?
-    def peek_previous(self):
-        if self.current_index == 0:
-            return self._audio_list[self._order[len(self._order)-1]]
-        return self._audio_list[self._order[self.current_index-1]]
-
-    def next(self):
-        """ Gets the next Audio object in the list and makes it the current """
-        audio = self.peek_next()
-        if self.is_repeating_all():
-            if self.current_index+1 == len(self):
-                self.current_index = 0
-            else:
-                self.current_index += 1
-        elif not self.is_repeating():
-            if self.current_index+1 == len(self):
-                self.current_index = 0
-            else:
-                self.current_index += 1
-        return audio
-
-    # FIXME: this, too, ignores the case where a single song is repeating
-    def previous(self):
-        audio = self.peek_previous()
-        if self.current_index == 0:
-            self.current_index = len(self) - 1
+        if shuffle:
+            self._shuffle_all(current)
+            self.current_index = 0
         else:
-            self.current_index -= 1
-        return audio
+            self._shuffle_keys = None
+            self._shuffled_keys = self._shuffled_entries = None
+            self._keyed = None
+            if current is not None:
+                self.current_index = current
         
     # exports the Playlist object to a playlist file (.m3u, .pls, etc.)
     def export(self, type, uri):
@@ -261,20 +550,42 @@ class Playlist(object):
         return u"<Playlist('%s', '%s')>" % (id, self.name)
 
 
-def quicksort(audio_list, left, right, by):
-    if right > left:
-        pivot = (left+right)/2
-        new_pivot = partition(audio_list, left, right, pivot, by)
-        quicksort(audio_list, left, new_pivot-1)
-        quicksort(audio_list, new_pivot+1, right)
-
-def partition(audio_list, left, right, pivot, by):
-    pivot_val = audio_list[pivot]
-    audio_list[pivot], audio_list[right] = audio_list[right], audio_list[pivot]
-    index = left
-    for i in range(left, right):
-        if audio_list[i].lt(pivot_val, by):
-            audio_list[i], audio_list[index] = audio_list[index], audio_list[i]
-            index += 1
-    audio_list[index], audio_list[right] = audio_list[right], audio_list[index]
-    return index
+def collation_key(value):
+    """ The key a tag sorts by: case-insensitive, with surrounding white
+        space and a leading article in ARTICLES ignored. Missing tags sort
+        first """
+    if not value:
+        return u''
+    key = value.strip().lower()
+    first, space, rest = key.partition(u' ')
+    if space and first in ARTICLES:
+        key = rest.lstrip()
+    return key
+
+class CollationCache(dict):
+    """ The collation keys of tags by tag, each worked out the first time
+        it's looked up """
+    def __missing__(self, value):
+        key = self[value] = collation_key(value)
+        return key
+
+def sort_keys(audio_list, fields, cache=None):
+    """ Returns the tuples of the fields of every audio in audio_list it
+        sorts by, with the text ones collated (see collation_key). This
+        goes a field at a time rather than an audio at a time, which keeps
+        the work per audio down to a few lookups. The collation keys are
+        looked up in cache, a CollationCache, which fills as it goes """
+    if cache is None:
+        cache = CollationCache()
+    collate = cache.__getitem__
+    for audio in audio_list:
+        if audio._lazy:
+            audio.materialize()
+    columns = []
+    for field in fields:
+        # the attributes behind Audio's lazy-loading properties
+        column = list(map(attrgetter('_' + field), audio_list))
+        if field in COLLATED:
+            column = list(map(collate, column))
+        columns.append(column)
+    return list(zip(*columns))
@@ -21,7 +21,8 @@
 # Boston, MA 02111-1307, USA.
 
 class Decoder(object):
-    def decode(self, playlist_uri):
+    def decode(self, playlist_uri, lazy=False):
+        """ lazy defers reading each file's tags, see Audio """
         raise NotImplementedError("Decode is not implemented")
 
 def get_decoder(ext):
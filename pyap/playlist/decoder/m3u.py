@@ -20,6 +20,9 @@
 # Free Software Foundation, Inc., 59 Temple Place - Suite 330,
 # Boston, MA 02111-1307, USA.
 
+import os
+
+from pyap.util import iter_files
 from pyap.playlist.decoder import Decoder
 from pyap.playlist import Playlist
 from pyap.audio import Audio
@@ -27,18 +30,23 @@ from pyap.audio import Audio
 # TODO: Decide whether to ignore EXTINFOs when creating Audio objects
 #       If it's a stream, it should not be ignored
 class M3UDecoder(Decoder):
-    def decode(self, playlist_uri):
-        playlist = Playlist()
+    def decode(self, playlist_uri, lazy=False):
+        name = os.path.splitext(os.path.basename(playlist_uri))[0]
+        playlist = Playlist(name, [])
         extended = False
         file = open(playlist_uri, 'r')
-        if file.readline().lower().startswith('#EXTM3U'):
+        if file.readline().lower().startswith('#extm3u'):
             extended = True
+        else:
+            file.seek(0)
 
         if extended:
             # Parse it as an extended M3U file
             info = (0, "")
             for line in file.readlines():
                 line = line.replace('\n', '')
+                if not line:
+                    continue
                 if line.startswith('#'):
                     if line.startswith('#EXTINF'):
                         length, title = line.split("#EXTINF:", 1)[1].split(",", 1)
@@ -48,38 +56,38 @@ class M3UDecoder(Decoder):
                     if not (uri.startswith(os.sep) or uri[1] == ':'):
                         directory_uri = os.path.dirname(playlist_uri)
                         uri = os.path.join(directory_uri, uri)
-                    self.add(playlist, uri)
+                    add(playlist, uri, lazy)
         else:
             # Parse it as a generic M3U file
             for line in file.readlines():
                 line = line.replace('\n', '')
+                if not line:
+                    continue
                 if line.startswith('#'):
                     continue
                 uri = line
                 if not (uri.startswith(os.sep) or uri[1] == ':'):
                     directory_uri = os.path.dirname(playlist_uri)
                     uri = os.path.join(directory_uri, uri)
-                self.add(playlist, uri)
+                add(playlist, uri, lazy)
 
         file.close()
         return playlist
 
 
-def add(playlist, uri):
-    try:
-        get_extension(uri)
-        add_file(playlist, uri)
-    except ValueError:
-        add_directory(playlist, uri)
+def add(playlist, uri, lazy=False):
+    if os.path.isdir(uri):
+        add_directory(playlist, uri, lazy)
+    else:
+        add_file(playlist, uri, lazy)
 
-def add_directory(playlist, uri):
-    for root, dirs, files in os.walk(uri):
-        for file in files:
-            add_file(playlist, os.path.join(root, file))
+def add_directory(playlist, uri, lazy=False):
+    for file_uri in iter_files(uri):
+        add_file(playlist, file_uri, lazy)
 
-def add_file(playlist, uri):
+def add_file(playlist, uri, lazy=False):
     try:
-        playlist.append(Audio(uri))
+        playlist.append(Audio(uri, lazy=lazy))
     except IOError: pass
 
 
@@ -23,5 +23,5 @@
 from pyap.playlist.decoder import Decoder
 
 class PLSDecoder(Decoder):
-    def decode(playlist_uri):
+    def decode(self, playlist_uri, lazy=False):
         pass
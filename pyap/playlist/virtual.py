@@ -0,0 +1,214 @@
+# Pyap - The Python Audio Player Library
+#
+# Copyright (c) 2012 Joel Griffith
+# Copyright (c) 2005 Joe Wreschnig
+# Copyright (c) 2002 David I. Lehn
+# Copyright (c) 2005-2011 the SQLAlchemy authors and contributors
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import random
+from collections import OrderedDict
+
+from pyap.playlist import Playback, REPEAT_ALL
+
+class _Permutation(object):
+    # a keyed pseudo-random permutation of [0, n) in constant memory: a
+    # four round Feistel network over the smallest even power of two
+    # covering n, walking the cycle until it lands back inside [0, n).
+    # the domain is less than 4n, so that takes a few steps at most on
+    # average
+    rounds = 4
+
+    def __init__(self, n, rand):
+        self.n = n
+        self.half = 0
+        while 1 << (2 * self.half) < n:
+            self.half += 1
+        self.mask = (1 << self.half) - 1
+        self.keys = [int(rand.getrandbits(32)) for i in range(self.rounds)]
+
+    def _round(self, value, key):
+        value = (value ^ key) * 0x9e3779b1 & 0xffffffff
+        return (value ^ value >> 15) & self.mask
+
+    def _encrypt(self, value):
+        left, right = value >> self.half, value & self.mask
+        for key in self.keys:
+            left, right = right, left ^ self._round(right, key)
+        return left << self.half | right
+
+    def __call__(self, index):
+        index = self._encrypt(index)
+        while index >= self.n:
+            index = self._encrypt(index)
+        return index
+
+class VirtualPlaylist(Playback):
+    """ A read-only playlist of the audio in a library that match filters
+        (see Library.audio_page), sorted by order. Rather than holding all
+        of it, the audio is read window_size at a time as it's needed and
+        only the cache_windows most recently used windows are kept. The
+        audio read_ahead places further in play order is read as each one
+        plays, so it's at hand by the time it's asked for. Playing through
+        the whole library takes as much memory as a few windows.
+
+        The length is counted once, refresh picks up changes made to the
+        library since. Shuffling plays the audio through a keyed
+        pseudo-random permutation of the positions, which visits each once
+        without keeping an order around """
+    def __init__(self, library, name, order='library', window_size=100,
+                 cache_windows=16, read_ahead=5, **filters):
+        self.library = library
+        self.name = name
+        self.order = order
+        self.filters = filters
+        self.window_size = window_size
+        self.cache_windows = cache_windows
+        self.read_ahead = read_ahead
+        self.fetches = 0
+        self._windows = OrderedDict()
+        self._length = None
+        self._random = None
+        self.reset()
+
+    def reset(self):
+        self.set_shuffle(False)
+        self.current_index = 0
+        self.set_repeat(REPEAT_ALL)
+
+    def refresh(self):
+        """ Forgets the audio read so far and counts it again. Playing goes
+            on from the same position, a new shuffle starting there if
+            shuffling """
+        current = self._index_at(self.current_index)
+        self._windows.clear()
+        self._length = None
+        if current >= len(self):
+            current = 0
+        if self._shuffle:
+            self._shuffle_from(current)
+        else:
+            self.current_index = current
+
+    def __len__(self):
+        if self._length is None:
+            self._length = self.library.count_audio(**self.filters)
+        return self._length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            indices = index.indices(len(self))
+            return [self._audio(i) for i in range(*indices)]
+        if index < 0:
+            index += len(self)
+        if 0 <= index < len(self):
+            return self._audio(index)
+
+    def __iter__(self):
+        """ Every audio in order, read page by page like Library.iter_audio
+            rather than through the window cache """
+        return self.library.iter_audio(self.order, self.window_size,
+                                       **self.filters)
+
+    def all_audio(self, with_shuffle=True):
+        """ Reads all of the audio, in shuffle order if shuffling and
+            with_shuffle. This is what a virtual playlist is there to avoid,
+            it's meant for exporting and the like """
+        if with_shuffle and self._shuffle:
+            return [self._audio_at(rank) for rank in range(len(self))]
+        return list(self)
+
+    def set_shuffle(self, shuffle, seed=None):
+        """ Like Playlist.set_shuffle, shuffling starts from the current
+            audio and seed makes the order reproducible """
+        if seed is not None or self._random is None:
+            self._random = random.Random(seed)
+        current = self._index_at(self.current_index)
+        self._shuffle = shuffle
+        if shuffle:
+            self._shuffle_from(current)
+        else:
+            self.current_index = current
+
+    def _shuffle_from(self, first):
+        # play order position rank is audio (permute(rank) + offset) %
+        # length, offset making the first one played first
+        self._permute = _Permutation(len(self), self._random)
+        self._offset = 0
+        if len(self):
+            self._offset = (first - self._permute(0)) % len(self)
+        self.current_index = 0
+
+    def _index_at(self, rank):
+        if not self._shuffle or not len(self):
+            return rank
+        return (self._permute(rank) + self._offset) % len(self)
+
+    def _audio_at(self, rank):
+        audio = self._audio(self._index_at(rank))
+        # have what comes next at hand before it's asked for. what comes
+        # in between was read ahead when it was that far off
+        ahead = min(self.read_ahead, len(self) - 1)
+        if ahead > 0:
+            self._audio(self._index_at((rank + ahead) % len(self)))
+        return audio
+
+    def _audio(self, index):
+        if self._shuffle:
+            # shuffled audio is all over the place, so it's read by itself
+            start, size = index, 1
+        else:
+            size = self.window_size
+            start = index - index % size
+        page = self._window(start, size)[0]
+        index -= start
+        return page[index] if index < len(page) else None
+
+    def _window(self, start, size):
+        # the (audio, key) page of size audio from start, the most recently
+        # used last
+        window = self._windows.pop((start, size), None)
+        if window is None:
+            window = self._fetch(start, size)
+        self._windows[(start, size)] = window
+        while len(self._windows) > self.cache_windows:
+            self._windows.popitem(last=False)
+        return window
+
+    def _fetch(self, start, size):
+        # read by keyset if the window before is at hand, by offset if not
+        previous = self._windows.get((start - size, size))
+        if previous is not None and previous[1] is not None:
+            window = self.library.audio_page(size, previous[1], self.order,
+                                             **self.filters)
+        else:
+            window = self.library.audio_page(size, None, self.order,
+                                             offset=start, **self.filters)
+        self.fetches += 1
+        return window
+
+    def __eq__(self, playlist):
+        return self.name == getattr(playlist, 'name', None)
+
+    def __hash__(self):
+        return hash(self.name)
+
+    def __str__(self):
+        return self.name
+
+    def __repr__(self):
+        return u"<VirtualPlaylist('%s', '%s')>" % (self.name, self.order)
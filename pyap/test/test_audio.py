@@ -22,8 +22,17 @@
 
 import unittest
 import os
+import shutil
+import sqlite3
+import struct
+import tempfile
 import time
 from pyap.audio import *
+from pyap.audio import _interned
+from pyap.audio.cache import MetadataCache
+from pyap.audio.digest import payload_hash, payload_ranges, skip_id3v2
+from pyap.audio.mpeg import find_frame, estimate_length, scan_length
+from pyap.audio.table import AudioTable
 from pyap.player import Player
 
 class TestAudio(unittest.TestCase):
@@ -70,6 +79,42 @@ class TestAudio(unittest.TestCase):
         for i, uri in enumerate(uris):
             self.assertEqual(audio_info(uri), expected_infos[i])
 
+    def test_fast_audio_info(self):
+        uri = os.path.abspath(os.path.join('resources', 'test.mp3'))
+        info = audio_info(uri, fast=True)
+        self.assertEqual(info.pop('length_estimated'), False)
+        self.assertEqual(info, audio_info(uri))
+        self.assertTrue(audio_info(os.path.join('resources', 'test'),
+                                   fast=True) is None)
+
+        directory = tempfile.mkdtemp()
+        try:
+            # without its Xing frame the length can only be estimated
+            with open(uri, 'rb') as file:
+                data = file.read()
+            offset, header = find_frame(data, skip_id3v2(data, 0, len(data)))
+            stripped = os.path.join(directory, 'stripped.mp3')
+            with open(stripped, 'wb') as file:
+                file.write(data[:offset] + data[offset+header.size:])
+            length, estimated = estimate_length(stripped)
+            self.assertTrue(estimated)
+            self.assertAlmostEqual(length, scan_length(uri), places=0)
+            self.assertAlmostEqual(scan_length(stripped), scan_length(uri))
+            self.assertEqual(exact_length(stripped), 1)
+
+            # a corrupt frame midway costs that frame, not the rest
+            with open(stripped, 'rb') as file:
+                data = bytearray(file.read())
+            offset = find_frame(bytes(data), len(data) // 2)[0]
+            data[offset:offset+4] = b'\0\0\0\0'
+            corrupt = os.path.join(directory, 'corrupt.mp3')
+            with open(corrupt, 'wb') as file:
+                file.write(bytes(data))
+            self.assertAlmostEqual(scan_length(corrupt), scan_length(uri),
+                                   places=1)
+        finally:
+            shutil.rmtree(directory)
+
     def test_init(self):
         uris = [
             os.path.join('resources', 'test.mp3'),
@@ -87,6 +132,27 @@ class TestAudio(unittest.TestCase):
         audio = Audio(uri)
         self.assertTrue(audio.is_stream())
 
+    def test_lazy(self):
+        uri = os.path.join('resources', 'test.mp3')
+        audio = Audio(uri, lazy=True)
+        self.assertTrue(audio.is_lazy())
+        self.assertEqual(audio.uri, os.path.abspath(uri))
+        self.assertEqual(audio.artist, "Artist")
+        self.assertFalse(audio.is_lazy())
+
+        audio = Audio(uri, lazy=True)
+        audio.title = u"Another Title"
+        self.assertEqual((audio.artist, audio.title), ("Artist", "Another Title"))
+
+        audio_list = [Audio(uri, lazy=True) for i in range(3)]
+        audio_list.append(Audio(os.path.join('resources', 'missing.mp3'),
+                                lazy=True))
+        failed = materialize_all(audio_list, workers=2, threads=True)
+        self.assertEqual([audio for audio, error in failed], audio_list[3:])
+        for audio in audio_list[:3]:
+            self.assertFalse(audio.is_lazy())
+            self.assertEqual(audio.album, "Album")
+
     def test_play(self):
         def callback(audio):
             self.audio_finished = True
@@ -194,6 +260,141 @@ class TestAudio(unittest.TestCase):
     def test___str__(self):
         self.assertEqual(self.audio.__str__(), "Artist - Title")
 
+    def test_intern_tag(self):
+        tag = intern_tag(u'Interned Artist')
+        self.assertTrue(intern_tag(u'Interned Artist') is tag)
+        self.assertEqual(tag, u'Interned Artist')
+        self.assertTrue(intern_tag(None) is None)
+        # a tag no Audio holds any more isn't kept around
+        del tag
+        self.assertFalse(u'Interned Artist' in _interned)
+
+    def test_cache(self):
+        directory = tempfile.mkdtemp()
+        try:
+            cache = MetadataCache(os.path.join(directory, 'cache.db'),
+                                  max_entries=1)
+            uri = os.path.join(directory, 'test.mp3')
+            shutil.copy(os.path.join('resources', 'test.mp3'), uri)
+            expected = audio_info(uri)
+            self.assertEqual(cache.audio_info(uri), expected)
+            self.assertEqual(cache.audio_info(uri), expected)
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+            # the entry is dropped once the file changes
+            os.utime(uri, (0, 0))
+            self.assertEqual(cache.audio_info(uri), expected)
+            self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+            # and the least recently used entry goes once it's full
+            cache.audio_info(os.path.abspath(os.path.join('resources', 'test')))
+            self.assertEqual(len(cache), 1)
+
+            set_cache(cache)
+            try:
+                Audio(uri)
+                self.assertEqual(Audio(uri).artist, "Artist")
+                self.assertEqual((cache.hits, cache.misses), (2, 4))
+            finally:
+                set_cache(None)
+                cache.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_cache_touches(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'cache.db')
+            cache = MetadataCache(path)
+            uri = os.path.abspath(os.path.join('resources', 'test.mp3'))
+            def used():
+                connection = sqlite3.connect(path)
+                try:
+                    return connection.execute(
+                        "SELECT used FROM audio_info").fetchone()[0]
+                finally:
+                    connection.close()
+            cache.audio_info(uri)
+            added = used()
+            time.sleep(0.01)
+            # hits only write when they were used once the cache closes
+            cache.audio_info(uri)
+            self.assertEqual((cache.hits, used()), (1, added))
+            cache.close()
+            self.assertTrue(used() > added)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_payload_hash(self):
+        directory = tempfile.mkdtemp()
+        try:
+            uri = os.path.join(directory, 'test.mp3')
+            shutil.copy(os.path.join('resources', 'test.mp3'), uri)
+            expected = payload_hash(uri)
+
+            # retagging doesn't change the hash
+            from mutagen.easyid3 import EasyID3
+            tags = EasyID3(uri)
+            tags['title'] = u'A much longer title than before'
+            tags.save()
+            file = open(uri, 'ab')
+            file.write(b'TAG' + b'\0' * 125)
+            file.close()
+            self.assertEqual(payload_hash(uri), expected)
+
+            # but changing the audio does
+            file = open(uri, 'r+b')
+            data = file.read()
+            start, end = payload_ranges(data, len(data))[0]
+            file.seek(start + (end - start) // 2)
+            file.write(b'\xff\x00')
+            file.close()
+            self.assertNotEqual(payload_hash(uri), expected)
+
+            flac = b'fLaC' + b'\x80\x00\x00\x02ab' + b'audio'
+            self.assertEqual(payload_ranges(flac, len(flac)), [(10, 15)])
+
+            # a zero sized APE footer is left alone rather than looped on
+            ape = b'audio' + b'APETAGEX' + struct.pack('<III', 2000, 0, 0) + \
+                  b'\0' * 12
+            self.assertEqual(payload_ranges(ape, len(ape)), [(0, len(ape))])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_audio_table(self):
+        table = AudioTable([self.audio])
+        table.append_row(u'/music/b.mp3', artist=u'Artist', title=u'B')
+        table.append(Audio(u'/music/c.mp3', artist=u'Other', title=u'C',
+                           track=3))
+        self.assertEqual(len(table), 3)
+        self.assertEqual(table[0].uri, self.audio.uri)
+        self.assertEqual(table[0].album, "Album")
+        self.assertEqual((table[2].artist, table[2].track), (u'Other', 3))
+        self.assertEqual(table.row(1)[:4],
+                         (u'/music/b.mp3', FILE, u'Artist', u'B'))
+
+        self.assertTrue(Audio(u'/music/b.mp3', title=u'B') in table)
+        self.assertEqual(table.index(table[2]), 2)
+        table[1] = Audio(u'/music/d.mp3', title=u'D')
+        self.assertFalse(Audio(u'/music/b.mp3', title=u'B') in table)
+        del table[0]
+        self.assertEqual([audio.title for audio in table], [u'D', u'C'])
+        table.reverse()
+        self.assertEqual([audio.title for audio in table[:]], [u'C', u'D'])
+
+        table.insert(1, Audio(u'/music/c.mp3', title=u'C'))
+        table.insert(0, Audio(u'/music/e.mp3', title=u'E'))
+        self.assertEqual([audio.title for audio in table],
+                         [u'E', u'C', u'C', u'D'])
+        self.assertEqual((table.index(table[3]), table.count(table[1])),
+                         (3, 2))
+        self.assertRaises(ValueError, table.index, self.audio)
+        table[1:3] = [Audio(u'/music/f.mp3', title=u'F')]
+        self.assertEqual([audio.title for audio in table], [u'E', u'F', u'D'])
+        table[:] = table[::-1]
+        self.assertEqual([audio.title for audio in table], [u'D', u'F', u'E'])
+        self.assertEqual(table.count(Audio(u'/music/c.mp3', title=u'C')), 0)
+
 
 def suite():
     suite = unittest.TestSuite()
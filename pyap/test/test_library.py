@@ -21,6 +21,796 @@
 # Boston, MA 02111-1307, USA.
 
 import unittest
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+from pyap.audio import Audio
+from pyap.library import Library
+from pyap.library import search
+from pyap.library.db import audio_playlist_table
+from pyap.playlist import Playlist, REPEAT_OFF
+from pyap.audio.digest import skip_id3v2
+from pyap.audio.mpeg import find_frame
+
+class TestLibrary(unittest.TestCase):
+    """
+    A test class for the library module
+    """
+    def setUp(self):
+        self.library = Library()
+
+    def tearDown(self):
+        self.library.close()
+
+    def test_separate_libraries(self):
+        directory = tempfile.mkdtemp()
+        try:
+            first = Library(os.path.join(directory, 'first.db'))
+            second = Library(os.path.join(directory, 'second.db'))
+            first.add_audio(Audio(u'/first.mp3', title=u'First'))
+            self.assertEqual(len(first.all_audio()), 1)
+            self.assertEqual(second.all_audio(), [])
+            mode = first.Session().execute("PRAGMA journal_mode").scalar()
+            self.assertEqual(mode, 'wal')
+            first.close()
+            second.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_migrate(self):
+        # a database made before the fingerprint, hash and position columns
+        directory = tempfile.mkdtemp()
+        try:
+            uri = os.path.join(directory, 'old.db')
+            connection = sqlite3.connect(uri)
+            connection.executescript("""
+                CREATE TABLE audio (id INTEGER PRIMARY KEY, uri VARCHAR,
+                    type INTEGER NOT NULL, artist VARCHAR, title VARCHAR,
+                    album VARCHAR, track INTEGER, length INTEGER);
+                CREATE UNIQUE INDEX ix_audio_uri ON audio (uri);
+                CREATE TABLE playlists (id INTEGER PRIMARY KEY,
+                    name VARCHAR);
+                CREATE UNIQUE INDEX ix_playlists_name ON playlists (name);
+                CREATE TABLE audio_playlists (audio_id INTEGER,
+                    playlist_id INTEGER);
+                INSERT INTO audio VALUES (1, '/old/a.mp3', 0, 'A', 'a',
+                                          NULL, 1, 60);
+                INSERT INTO audio VALUES (2, '/old/b.mp3', 0, 'B', 'b',
+                                          NULL, 2, 90);
+                INSERT INTO playlists VALUES (1, 'Old');
+                INSERT INTO audio_playlists VALUES (2, 1);
+                INSERT INTO audio_playlists VALUES (1, 1);
+                INSERT INTO audio_playlists VALUES (2, 1);
+            """)
+            connection.commit()
+            connection.close()
+
+            for i in range(2):
+                # and once more to check migrating twice changes nothing
+                library = Library(uri)
+                self.assertEqual([a.title for a in library.all_audio()][:2],
+                                 [u'a', u'b'])
+                self.assertEqual(library.audio_by_uri(u'/old/a.mp3').year,
+                                 None)
+                playlist = library.playlist_by_name(u'Old')
+                self.assertEqual([a.title for a in playlist],
+                                 [u'b', u'a', u'b'])
+                if i == 0:
+                    library.add_audio(Audio(u'/old/c.mp3', title=u'c',
+                                            year=u'2001'))
+                    library.add_to_playlist(playlist, [library.audio_by_uri(
+                        u'/old/c.mp3')])
+                    library.remove_from_playlist(playlist, 3)
+                self.assertEqual(library.year_stats()[-1][:2], (u'2001', 1))
+                library.close()
+            connection = sqlite3.connect(uri)
+            plan = connection.execute(
+                "EXPLAIN QUERY PLAN SELECT id FROM audio WHERE title >= 'b' "
+                "ORDER BY title, id").fetchall()
+            connection.close()
+            self.assertTrue('ix_audio_title' in str(plan))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_threads(self):
+        directory = tempfile.mkdtemp()
+        try:
+            library = Library(os.path.join(directory, 'library.db'))
+            errors = []
+            def work(n):
+                try:
+                    for i in range(20):
+                        uri = u'/thread/%d/%d.mp3' % (n, i)
+                        library.add_audio(Audio(uri, title=u'%d' % i))
+                        self.assertEqual(library.audio_by_uri(uri).uri, uri)
+                        library.remove_audio(library.audio_by_uri(uri))
+                    library.close_session()
+                except Exception as e:
+                    errors.append(e)
+            threads = [threading.Thread(target=work, args=(n,))
+                       for n in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(errors, [])
+            self.assertEqual(library.all_audio(), [])
+            library.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_ingest(self):
+        uris = [
+            os.path.join('resources', 'test.mp3'),
+            os.path.join('resources', 'test'),
+            os.path.join('resources', 'test.mp3')
+        ]
+        results = list(self.library.ingest(uris, workers=2, threads=True))
+        self.assertEqual([uri for uri, audio, error in results],
+                         [os.path.abspath(uri) for uri in uris])
+
+        uri, row, error = results[0]
+        self.assertTrue(error is None)
+        self.assertEqual(row['artist'], "Artist")
+        self.assertEqual(self.library.audio_by_uri(uri).title, "Title")
+
+        # unreadable files are reported, not raised
+        self.assertTrue(results[1][1] is None and results[1][2] is not None)
+        # and files already in the library are updated
+        self.assertTrue(results[2][2] is None)
+        self.assertEqual([audio.uri for audio in self.library.all_audio()
+                          if audio.uri == uri], [uri])
+
+    def test_bulk_load(self):
+        rows = [{'uri': u'/bulk/%d.mp3' % i, 'title': u'%d' % i}
+                for i in range(10)]
+        self.assertEqual(self.library.bulk_load(rows, chunk_size=3), (10, 0))
+        rows = [{'uri': u'/bulk/%d.mp3' % i, 'artist': u'Artist'}
+                for i in range(5, 15)]
+        self.assertEqual(self.library.bulk_load(rows), (5, 5))
+
+        # an update only touches the columns its row has
+        audio = self.library.audio_by_uri(u'/bulk/7.mp3')
+        self.assertEqual((audio.artist, audio.title, audio.track),
+                         (u'Artist', u'7', -1))
+        self.assertEqual(self.library.audio_by_uri(u'/bulk/12.mp3').title, u'')
+        self.assertEqual(self.library.audio_by_uri(u'/bulk/3.mp3').title, u'3')
+
+        # a uri another writer adds after the lookup is updated, not
+        # inserted twice
+        self.library._ids_by_uri = lambda session, uris: {}
+        try:
+            self.library.bulk_load([{'uri': u'/bulk/3.mp3', 'track': 3}])
+        finally:
+            del self.library._ids_by_uri
+        audio = self.library.audio_by_uri(u'/bulk/3.mp3')
+        self.assertEqual((audio.title, audio.track), (u'3', 3))
+        self.assertEqual(self.library.artist_stats()[-1][:2], (u'Artist', 10))
+
+    def test_all_audio_table(self):
+        self.library.bulk_load([{'uri': u'/table/a.mp3', 'artist': u'A'}])
+        table = self.library.all_audio_table()
+        self.assertEqual(len(table), len(self.library.all_audio()))
+        self.assertTrue(Audio(u'/table/a.mp3', artist=u'A') in table)
+
+    def test_iter_audio(self):
+        rows = []
+        for i in range(30):
+            rows.append({'uri': u'/page/%02d.mp3' % i,
+                         'artist': [u'B', u'A', None][i % 3],
+                         'album': u'Album %d' % (i % 2),
+                         'year': u'%d' % (2000 + i % 4),
+                         'track': i, 'length': i * 10})
+        self.library.bulk_load(rows)
+
+        audio = list(self.library.iter_audio(page_size=7))
+        self.assertEqual(len(audio), 30)
+        keys = [(a.artist, a.year, a.album, a.track) for a in audio]
+        self.assertEqual(keys, sorted(keys))
+        self.assertEqual(len(set(a.uri for a in audio)), 30)
+
+        by_id = list(self.library.iter_audio(order='id', page_size=4))
+        self.assertEqual([a.id for a in by_id], sorted(a.id for a in audio))
+
+        audio = list(self.library.iter_audio(artist=u'A', min_length=100,
+                                             max_length=200, page_size=2))
+        self.assertEqual([a.track for a in audio], [16, 13, 10, 19])
+
+        page, after = self.library.audio_page(10, order='title')
+        self.assertEqual(len(page), 10)
+        page, after = self.library.audio_page(10, after, order='title')
+        self.assertEqual(page[0].id, by_id[10].id)
+        self.assertRaises(ValueError, self.library.audio_page, order='size')
+
+    def test_stats(self):
+        self.library.bulk_load([
+            {'uri': u'/stats/1.mp3', 'artist': u'A', 'album': u'X',
+             'year': u'2001', 'length': 100},
+            {'uri': u'/stats/2.mp3', 'artist': u'A', 'album': u'Y',
+             'year': u'2002', 'length': 200},
+            {'uri': u'/stats/3.mp3', 'artist': u'B', 'album': u'X',
+             'year': u'2001'},
+            {'uri': u'/stats/4.mp3', 'album': u'X', 'length': 50}
+        ])
+        self.assertEqual(self.library.artist_stats(),
+                         [(u'', 1, 50), (u'A', 2, 300), (u'B', 1, 0)])
+        self.assertEqual(self.library.album_stats(artist=u'A'),
+                         [(u'A', u'X', 1, 100), (u'A', u'Y', 1, 200)])
+        self.assertEqual(self.library.year_stats(order='tracks',
+                                                 descending=True, limit=1),
+                         [(u'2001', 2, 100)])
+        self.assertEqual(self.library.totals(), (4, 350))
+
+        # updates and deletes move the numbers along
+        self.library.bulk_load([{'uri': u'/stats/2.mp3', 'artist': u'B',
+                                 'album': u'Y', 'length': 20}])
+        self.library.remove_audio_by_uri(u'/stats/1.mp3')
+        self.assertEqual(self.library.artist_stats(),
+                         [(u'', 1, 50), (u'B', 2, 20)])
+        self.assertEqual(self.library.totals(), (3, 70))
+        self.assertRaises(ValueError, self.library.artist_stats,
+                          order='title')
+
+    def test_interned_tags(self):
+        self.library.bulk_load([
+            {'uri': u'/interned/%d.mp3' % i, 'artist': u'A', 'album': u'X',
+             'year': u'1999', 'track': i} for i in range(3)])
+        found = self.library.all_audio()
+        # loaded tags share a single copy
+        for name in ('artist', 'album', 'year'):
+            self.assertTrue(getattr(found[0], name) is
+                            getattr(found[2], name))
+
+    def test_search(self):
+        self.library.bulk_load([
+            {'uri': u'/search/1.mp3', 'artist': u'Nirvana',
+             'album': u'Nevermind', 'title': u'Lounge Act'},
+            {'uri': u'/search/2.mp3', 'artist': u'Nirvana',
+             'album': u'In Utero', 'title': u'All Apologies'},
+            {'uri': u'/search/3.mp3', 'artist': u'Silversun Pickups',
+             'album': u'Carnavas', 'title': u'Lazy Eye'}
+        ])
+        titles = lambda found: sorted(audio.title for audio in found)
+        self.assertEqual(titles(self.library.search(u'nirv')),
+                         [u'All Apologies', u'Lounge Act'])
+        self.assertEqual(titles(self.library.search(u'nirvana utero')),
+                         [u'All Apologies'])
+        self.assertEqual(len(self.library.search(u'nirvana', limit=1)), 1)
+        self.assertEqual(self.library.search(u'nevermind',
+                                             fields=['title']), [])
+        self.assertRaises(ValueError, self.library.search, u'sugar',
+                          fields=['uri'])
+        self.assertEqual(self.library.search(u'  '), [])
+        self.assertTrue(self.library.searchable)
+
+        # without FTS5 the rest of the library works, searching says why not
+        ddl = search._ddl[0]
+        search._ddl[0] = ddl.replace('USING fts5', 'USING fts5_missing')
+        try:
+            library = Library()
+        finally:
+            search._ddl[0] = ddl
+        library.bulk_load([{'uri': u'/search/1.mp3', 'title': u'Lounge'}])
+        self.assertFalse(library.searchable)
+        self.assertRaises(RuntimeError, library.search, u'lounge')
+        library.close()
+
+        # the index follows updates and deletes
+        self.library.bulk_load([{'uri': u'/search/3.mp3',
+                                 'artist': u'Pickups', 'title': u'Lazy Eye'}])
+        self.assertEqual(self.library.search(u'silversun'), [])
+        self.assertEqual(len(self.library.search(u'pickups')), 1)
+        self.library.remove_audio(self.library.audio_by_uri(u'/search/3.mp3'))
+        self.assertEqual(self.library.search(u'lazy'), [])
+
+    def test_virtual_playlist(self):
+        self.library.bulk_load([
+            {'uri': u'/virtual/%02d.mp3' % i, 'artist': u'A%d' % (i % 2),
+             'title': u'%02d' % i, 'track': i} for i in range(25)])
+        playlist = self.library.virtual_playlist(u'A0', order='title',
+                                                 artist=u'A0', window_size=4,
+                                                 cache_windows=3, read_ahead=2)
+        titles = [u'%02d' % i for i in range(0, 25, 2)]
+        self.assertEqual(len(playlist), 13)
+        self.assertEqual([a.title for a in playlist], titles)
+        self.assertEqual(playlist[5].title, titles[5])
+        self.assertEqual(playlist[-1].title, titles[-1])
+        self.assertEqual(playlist[20], None)
+
+        # playing goes window by window, keeping only a few of them
+        playlist.fetches = 0
+        played = [playlist.next().title for i in range(13)]
+        self.assertEqual(played, titles[1:] + titles[:1])
+        self.assertTrue(playlist.fetches <= 5)
+        self.assertTrue(len(playlist._windows) <= 3)
+
+        playlist.set_shuffle(True, seed=7)
+        shuffled = [playlist.next().title for i in range(13)]
+        self.assertEqual(sorted(shuffled), titles)
+        self.assertNotEqual(shuffled, played)
+        again = self.library.virtual_playlist(u'again', order='title',
+                                              artist=u'A0')
+        again.set_shuffle(True, seed=7)
+        self.assertEqual([again.next().title for i in range(13)], shuffled)
+
+        self.library.bulk_load([{'uri': u'/virtual/new.mp3',
+                                 'artist': u'A0', 'title': u'99'}])
+        self.assertEqual(len(playlist), 13)
+        playlist.refresh()
+        self.assertEqual(len(playlist), 14)
+        playlist.set_shuffle(False)
+        playlist.set_repeat(REPEAT_OFF)
+        playlist.current_index = 12
+        self.assertEqual(playlist.next().title, u'99')
+        self.assertEqual(playlist.peek_next(), None)
+
+    def test_virtual_shuffle(self):
+        self.library.bulk_load([{'uri': u'/virtual/%02d.mp3' % i,
+                                 'title': u'%02d' % i} for i in range(40)])
+        playlist = self.library.virtual_playlist(u'all', order='title')
+        playlist.current_index = 9
+        playlist.set_shuffle(True, seed=3)
+        indices = [playlist._index_at(rank) for rank in range(40)]
+        self.assertEqual(indices[0], 9)
+        self.assertEqual(sorted(indices), list(range(40)))
+        # not a fixed stride through the positions
+        steps = set((b - a) % 40 for a, b in zip(indices, indices[1:]))
+        self.assertTrue(len(steps) > 1)
+
+    def test_smart_playlist(self):
+        self.library.bulk_load([
+            {'uri': u'/smart/1.mp3', 'artist': u'Low', 'album': u'B',
+             'title': u'1', 'length': 200, 'year': u'1994'},
+            {'uri': u'/smart/2.mp3', 'artist': u'Slint', 'album': u'A',
+             'title': u'2', 'length': 400, 'year': u'1991'},
+            {'uri': u'/smart/3.mp3', 'artist': u'Slint', 'album': u'C',
+             'title': u'3', 'length': 300, 'year': u'1991'},
+            {'uri': u'/smart/4.mp3', 'artist': u'Low', 'album': u'D',
+             'title': u'4', 'length': 100, 'year': u'1989'},
+            {'uri': u'/smart/5.mp3', 'artist': u'Ride', 'album': u'A',
+             'title': u'5', 'length': 100, 'year': u'1990'}
+        ])
+        rule = ['all', [['artist', 'in', [u'Low', u'Slint']],
+                        ['length', '<', 360], ['year', '>=', u'1990']]]
+        playlist = self.library.add_smart_playlist(u'smart', rule, 'album')
+        titles = lambda p: [audio.title for audio in p]
+        self.assertEqual(titles(playlist), [u'1', u'3'])
+        self.assertEqual(self.library.refresh_smart_playlist(playlist), (0, 0))
+
+        # only what changed is looked at, and lands where it sorts
+        self.library.bulk_load([
+            {'uri': u'/smart/2.mp3', 'artist': u'Slint', 'album': u'A',
+             'title': u'2', 'length': 350, 'year': u'1991'},
+            {'uri': u'/smart/6.mp3', 'artist': u'Low', 'album': u'BB',
+             'title': u'6', 'length': 100, 'year': u'2001'},
+            {'uri': u'/smart/3.mp3', 'artist': u'Slint', 'album': u'C',
+             'title': u'3', 'length': 500, 'year': u'1991'}
+        ])
+        self.library.remove_audio_by_uri(u'/smart/1.mp3')
+        self.assertEqual(self.library.refresh_smart_playlist(playlist), (2, 1))
+        self.assertEqual(titles(playlist), [u'2', u'6'])
+        self.assertEqual(titles(self.library.playlist_by_name(u'smart')),
+                         [u'2', u'6'])
+
+        self.library.bulk_load([{'uri': u'/smart/4.mp3', 'artist': u'Low',
+                                 'album': u'Z', 'title': u'4',
+                                 'length': 100, 'year': u'1999'}])
+        self.assertEqual(self.library.refresh_smart_playlists(),
+                         {u'smart': (1, 0)})
+        self.assertEqual(titles(self.library.playlist_by_name(u'smart')),
+                         [u'2', u'6', u'4'])
+
+        self.assertRaises(ValueError, self.library.add_smart_playlist,
+                          u'bad', ['bitrate', '>', 128])
+        self.assertRaises(ValueError, self.library.add_smart_playlist,
+                          u'bad', ['any', ['title', '~', u'x']])
+        self.library.add_playlist(Playlist(u'plain'))
+        self.assertRaises(ValueError, self.library.refresh_smart_playlist,
+                          u'plain')
+
+        # contains ignores case beyond ASCII too
+        self.library.bulk_load([{'uri': u'/smart/7.mp3',
+                                 'artist': u'\xd6rn \xc9tude'}])
+        found = self.library.add_smart_playlist(
+            u'\xf6rn', ['artist', 'contains', u'\xf6RN \xe9'], 'title')
+        self.assertEqual([a.uri for a in found], [u'/smart/7.mp3'])
+
+    def test_playlists(self):
+        audio = [Audio(u'/list/%d.mp3' % i, title=u'%d' % i) for i in range(6)]
+        self.library.add_playlist(Playlist(u'List', audio[:4]))
+        titles = lambda playlist: [a.title for a in playlist]
+
+        playlist = self.library.playlist_by_name(u'List')
+        self.assertEqual(titles(playlist), [u'0', u'1', u'2', u'3'])
+        self.library.add_to_playlist(playlist, [audio[4], audio[0]])
+        self.library.insert_in_playlist(playlist, 1, audio[5])
+        self.library.remove_from_playlist(playlist, 3)
+        self.library.move_in_playlist(playlist, 0, 3)
+        expected = [u'5', u'1', u'3', u'0', u'4', u'0']
+        self.assertEqual(titles(playlist), expected)
+
+        self.library.close_session()
+        playlist = self.library.playlist_by_name(u'List')
+        self.assertEqual(titles(playlist), expected)
+        self.assertEqual(titles(self.library.iter_playlist(playlist, 2)),
+                         expected)
+
+        # running out of room between two entries renumbers the playlist
+        for i in range(12):
+            self.library.insert_in_playlist(playlist, 1, audio[2])
+        expected[1:1] = [u'2'] * 12
+        self.assertEqual(titles(self.library.playlist_by_name(u'List')),
+                         expected)
+
+        self.assertRaises(IndexError, self.library.remove_from_playlist,
+                          playlist, 100)
+
+        # moves to either end, and between entries of the same audio
+        playlist = self.library.playlist_by_name(u'List')
+        self.library.move_in_playlist(playlist, 0, -1)
+        self.library.move_in_playlist(playlist, -2, 0)
+        self.library.move_in_playlist(playlist, 3, 6)
+        self.library.insert_in_playlist(playlist, -1, audio[1])
+        self.library.remove_from_playlist(playlist, 4)
+        expected = titles(playlist)
+        self.library.close_session()
+        self.assertEqual(titles(self.library.playlist_by_name(u'List')),
+                         expected)
+
+        # a new playlist under the same name replaces it
+        self.library.add_playlist(Playlist(u'List', audio[:2]))
+        playlist = self.library.playlist_by_name(u'List')
+        self.assertEqual(titles(playlist), [u'0', u'1'])
+        self.library.remove_playlist(playlist)
+        self.assertTrue(self.library.playlist_by_name(u'List') is None)
+        self.assertEqual(self.library.Session().query(
+            audio_playlist_table).count(), 0)
+        self.assertEqual(len(self.library.all_audio()), 6)
+
+    def test_cache(self):
+        library = Library(cache_size=10)
+        cache = library.cache
+        self.assertTrue(library.audio_by_uri(u'/cache/1.mp3') is None)
+        library.add_audio(Audio(u'/cache/1.mp3', title=u'One'))
+        audio = library.audio_by_uri(u'/cache/1.mp3')
+        self.assertEqual(audio.title, u'One')
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+
+        # hits are merged into the calling thread's session
+        library.close_session()
+        audio = library.audio_by_uri(u'/cache/1.mp3')
+        self.assertEqual(audio.title, u'One')
+        self.assertTrue(audio in library.Session())
+        self.assertEqual(library.audio_by_index(audio.id).uri, audio.uri)
+        self.assertEqual(len(library.all_audio_table()), 1)
+        # a cached table is copied, so changing one changes no other
+        library.all_audio_table().append_row(u'/cache/extra.mp3')
+        self.assertEqual(len(library.all_audio_table()), 1)
+        self.assertEqual(cache.hits, 3)
+
+        library.bulk_load([{'uri': u'/cache/1.mp3', 'title': u'Uno'},
+                           {'uri': u'/cache/2.mp3'}])
+        self.assertEqual(library.audio_by_uri(u'/cache/1.mp3').title, u'Uno')
+        self.assertEqual(len(library.all_audio_table()), 2)
+
+        library.add_playlist(Playlist(u'Cached', [audio]))
+        self.assertEqual(len(library.playlist_by_name(u'Cached')), 1)
+        self.assertEqual(len(library.playlist_by_name(u'Cached')), 1)
+        library.remove_audio(audio)
+        self.assertEqual(len(library.playlist_by_name(u'Cached')), 0)
+        self.assertTrue(library.audio_by_uri(u'/cache/1.mp3') is None)
+        library.remove_playlist(library.playlist_by_name(u'Cached'))
+        self.assertTrue(library.playlist_by_name(u'Cached') is None)
+
+        for i in range(20):
+            library.audio_by_index(i)
+        self.assertEqual(len(cache), 10)
+        self.assertTrue(0 < cache.hit_rate() < 1)
+
+        library.cache.ttl = 0
+        library.all_audio_table()
+        found, value = cache.get(('all_audio_table',))
+        self.assertFalse(found)
+        library.close()
+
+    def test_write_behind(self):
+        directory = tempfile.mkdtemp()
+        try:
+            library = Library(os.path.join(directory, 'library.db'),
+                              cache_size=10)
+            writer = library.write_behind(max_batch=50, max_delay=1)
+            done = []
+            for i in range(120):
+                audio = Audio(u'/behind/%d.mp3' % i, title=u'%d' % i)
+                writer.add_audio(audio, callback=done.append)
+            writer.add_playlist(Playlist(u'Behind', []))
+            # a failing write is reported without losing the rest
+            writer.remove_playlist(Playlist(u'Missing', []),
+                                   callback=done.append)
+            writer.remove_audio_by_uri(u'/behind/0.mp3', callback=done.append)
+            self.assertTrue(writer.flush(timeout=10))
+
+            self.assertEqual(len(done), 122)
+            self.assertEqual(done.count(None), 121)
+            self.assertEqual(len(library.all_audio()), 119)
+            self.assertTrue(library.playlist_by_name(u'Behind') is not None)
+            self.assertTrue(writer.batches < writer.writes)
+            self.assertEqual(writer.failures, 1)
+
+            playlist = library.playlist_by_name(u'Behind')
+            audio = library.audio_by_uri(u'/behind/1.mp3')
+            writer.add_to_playlist(playlist, audio)
+            writer.close()
+            self.assertEqual(len(playlist), 1)
+            self.assertEqual(len(library.playlist_by_name(u'Behind')), 1)
+            self.assertRaises(ValueError, writer.add_audio, None)
+
+            # what fails after a commit doesn't have the batch written again
+            writer = library.write_behind()
+            def broken(kind, arg):
+                raise RuntimeError("broken")
+            library._drop_cached = broken
+            logged = []
+            handler = logging.Handler()
+            handler.emit = logged.append
+            logger = logging.getLogger('pyap.library.writer')
+            logger.addHandler(handler)
+            done = []
+            try:
+                writer.add_audio(Audio(u'/behind/new.mp3', title=u'new'),
+                                 callback=done.append)
+                self.assertTrue(writer.flush(timeout=10))
+            finally:
+                logger.removeHandler(handler)
+            self.assertEqual((done, writer.failures), ([None], 0))
+            # and is logged rather than lost
+            self.assertEqual(len(logged), 1)
+            del library._drop_cached
+
+            # and flush doesn't wait on a writer thread that died
+            def die(batch):
+                raise RuntimeError("died")
+            writer._write = die
+            writer.add_audio(Audio(u'/behind/dead.mp3', title=u'dead'))
+            writer.flush()
+            writer._thread.join(10)
+            self.assertFalse(writer.flush())
+            library.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_snapshot(self):
+        directory = tempfile.mkdtemp()
+        try:
+            rows = [{'uri': u'/snap/%d.mp3' % i, 'artist': u'Bj\xf6rk',
+                     'title': u'%d' % i, 'track': i, 'length': 100 + i}
+                    for i in range(50)]
+            self.library.bulk_load(rows)
+            uris = [u'/snap/7.mp3', u'/snap/3.mp3', u'/snap/7.mp3']
+            self.library.add_playlist(Playlist(u'Snap', [
+                self.library.audio_by_uri(uri) for uri in uris]))
+            self.library.add_playlist(Playlist(u'Empty', []))
+
+            uri = os.path.join(directory, 'library.snapshot')
+            self.library.export_snapshot(uri)
+            snapshot = Library.open_snapshot(uri)
+            self.assertEqual(len(snapshot), 50)
+
+            audio = snapshot.audio_by_uri(u'/snap/42.mp3')
+            self.assertEqual((audio.artist, audio.title, audio.track,
+                              audio.length), (u'Bj\xf6rk', u'42', 42, 142))
+            self.assertEqual(snapshot.audio_by_index(audio.id).uri,
+                             audio.uri)
+            self.assertTrue(snapshot.audio_by_uri(u'/snap/50.mp3') is None)
+            self.assertTrue(snapshot.audio_by_index(1000) is None)
+            self.assertEqual(sorted(a.uri for a in snapshot),
+                             sorted(a.uri for a in self.library.all_audio()))
+
+            self.assertEqual(sorted(snapshot.playlist_names()),
+                             [u'Empty', u'Snap'])
+            playlist = snapshot.playlist_by_name(u'Snap')
+            self.assertEqual([a.uri for a in playlist], uris)
+            self.assertEqual(len(snapshot.playlist_by_name(u'Empty')), 0)
+            self.assertTrue(snapshot.playlist_by_name(u'None') is None)
+            snapshot.close()
+
+            with open(uri, 'rb') as file:
+                data = file.read()
+            # a file that isn't one, or a snapshot cut short anywhere
+            for corrupt in (b'x' * 100, b'', data[:10], data[:200],
+                            data[:len(data) // 2], data[:-1]):
+                with open(uri, 'wb') as file:
+                    file.write(corrupt)
+                self.assertRaises(ValueError, Library.open_snapshot, uri)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_refine_lengths(self):
+        directory = tempfile.mkdtemp()
+        try:
+            # an MP3 without a Xing frame, so that fast mode has to guess
+            with open(os.path.join('resources', 'test.mp3'), 'rb') as file:
+                data = file.read()
+            offset, header = find_frame(data, skip_id3v2(data, 0, len(data)))
+            uri = os.path.join(directory, 'test.mp3')
+            with open(uri, 'wb') as file:
+                file.write(data[:offset] + data[offset+header.size:])
+
+            list(self.library.ingest([uri], workers=0, fast=True))
+            self.assertTrue(self.library.audio_by_uri(uri).length_estimated)
+            self.assertEqual(self.library.refine_lengths(workers=0), (1, 0))
+            audio = self.library.audio_by_uri(uri)
+            self.assertEqual((audio.length, audio.length_estimated),
+                             (1, False))
+            self.assertEqual(self.library.refine_lengths(workers=0), (0, 0))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_duplicates(self):
+        directory = tempfile.mkdtemp()
+        try:
+            uris = [os.path.join(directory, name)
+                    for name in ('a.mp3', 'b.mp3', 'c.mp3')]
+            for uri in uris:
+                shutil.copy(os.path.join('resources', 'test.mp3'), uri)
+            file = open(uris[2], 'ab')
+            file.write(b'\x00' * 100)
+            file.close()
+            list(self.library.ingest(uris, workers=0))
+
+            self.assertEqual(self.library.hash_audio(workers=0), (3, 0))
+            groups = self.library.duplicates()
+            self.assertEqual([sorted(a.uri for a in group)
+                              for group in groups], [uris[:2]])
+            self.assertEqual(self.library.hash_audio(workers=0), (0, 0))
+
+            os.utime(uris[1], (0, 0))
+            self.assertEqual(self.library.hash_audio(workers=2, threads=True),
+                             (1, 0))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_refresh(self):
+        root = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(root, 'album'))
+            uri = os.path.join(root, 'album', 'test.mp3')
+            shutil.copy(os.path.join('resources', 'test.mp3'), uri)
+            self.assertEqual(self.library.refresh([uri], workers=0),
+                             (1, 0, 0))
+            self.assertEqual(self.library.refresh([uri], workers=0),
+                             (0, 0, 0))
+            shutil.rmtree(os.path.join(root, 'album'))
+            self.assertEqual(self.library.refresh(
+                [os.path.join(root, 'album')], workers=0), (0, 0, 1))
+        finally:
+            shutil.rmtree(root)
+
+    def test_watch(self):
+        root = tempfile.mkdtemp()
+        directory = tempfile.mkdtemp()
+        # the watcher writes from a thread of its own, so not in memory
+        library = Library(os.path.join(directory, 'library.db'))
+        try:
+            def wait_for(*names):
+                # the watcher works in the background
+                uris = sorted(os.path.join(root, name) for name in names)
+                for i in range(100):
+                    if sorted(a.uri for a in library.all_audio()) == uris:
+                        return True
+                    time.sleep(0.05)
+                return False
+
+            for use_inotify in (True, False):
+                watcher = library.watch(root, delay=0.05, poll_interval=0.1,
+                                        use_inotify=use_inotify)
+                try:
+                    if not use_inotify:
+                        self.assertEqual(watcher.mode, 'polling')
+                    album = os.path.join(root, 'album')
+                    os.mkdir(album)
+                    for name in ('test.mp3', 'copy.mp3'):
+                        shutil.copy(os.path.join('resources', 'test.mp3'),
+                                    os.path.join(album, name))
+                    self.assertTrue(wait_for('album/test.mp3',
+                                             'album/copy.mp3'))
+                    os.remove(os.path.join(album, 'copy.mp3'))
+                    self.assertTrue(wait_for('album/test.mp3'))
+                    os.rename(album, os.path.join(root, 'moved'))
+                    self.assertTrue(wait_for('moved/test.mp3'))
+                    shutil.rmtree(os.path.join(root, 'moved'))
+                    self.assertTrue(wait_for())
+                finally:
+                    watcher.stop()
+        finally:
+            library.close()
+            shutil.rmtree(directory)
+            shutil.rmtree(root)
+
+    def test_watch_retries(self):
+        root = tempfile.mkdtemp()
+        directory = tempfile.mkdtemp()
+        library = Library(os.path.join(directory, 'library.db'))
+        try:
+            uri = os.path.join(root, 'test.mp3')
+            for name in ('refresh', 'rescan'):
+                # an update that fails once, say on a locked database,
+                # loses none of the changes it was given
+                failures = []
+                update = getattr(library, name)
+                def failing(*args, **kwargs):
+                    if not failures:
+                        failures.append(name)
+                        raise RuntimeError("locked")
+                    return update(*args, **kwargs)
+                setattr(library, name, failing)
+                # refreshes come from inotify events, rescans from polling
+                watcher = library.watch(root, delay=0.05, max_delay=0.1,
+                                        poll_interval=0.1,
+                                        initial_scan=False,
+                                        use_inotify=name == 'refresh')
+                try:
+                    if name == 'refresh':
+                        shutil.copy(os.path.join('resources', 'test.mp3'),
+                                    uri)
+                    else:
+                        os.remove(uri)
+                    for i in range(100):
+                        found = [a.uri for a in library.all_audio()]
+                        if failures and found == ([uri] if name == 'refresh'
+                                                  else []):
+                            break
+                        library.close_session()
+                        time.sleep(0.05)
+                    self.assertEqual(failures, [name])
+                    self.assertEqual(found, [uri] if name == 'refresh'
+                                     else [])
+                finally:
+                    watcher.stop()
+                    delattr(library, name)
+        finally:
+            library.close()
+            shutil.rmtree(directory)
+            shutil.rmtree(root)
+
+    def test_rescan(self):
+        root = tempfile.mkdtemp()
+        try:
+            uri = os.path.join(root, 'test.mp3')
+            shutil.copy(os.path.join('resources', 'test.mp3'), uri)
+            shutil.copy(os.path.join('resources', 'test'), root)
+            self.assertEqual(self.library.rescan(root, workers=0), (1, 0, 0))
+            self.assertEqual(self.library.audio_by_uri(uri).artist, "Artist")
+            self.assertEqual(self.library.rescan(root, workers=0), (0, 0, 0))
+
+            os.utime(uri, (0, 0))
+            self.assertEqual(self.library.rescan(root, workers=0), (0, 1, 0))
+
+            os.remove(uri)
+            self.assertEqual(self.library.rescan(root, workers=0), (0, 0, 1))
+            self.assertTrue(self.library.audio_by_uri(uri) is None)
+
+            # audio in a directory the walk skips isn't taken for vanished
+            os.mkdir(os.path.join(root, '.hidden'))
+            uri = os.path.join(root, '.hidden', 'test.mp3')
+            shutil.copy(os.path.join('resources', 'test.mp3'), uri)
+            self.assertEqual(self.library.rescan(root, workers=0,
+                                                 hidden=True), (1, 0, 0))
+            self.assertEqual(self.library.rescan(root, workers=0), (0, 0, 0))
+            self.assertTrue(self.library.audio_by_uri(uri) is not None)
+        finally:
+            shutil.rmtree(root)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestLibrary))
+    return suite
 
 if __name__ == '__main__':
     unittest.main()
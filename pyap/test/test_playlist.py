@@ -22,5 +22,178 @@
 
 import unittest
 
+from pyap.audio import Audio
+from pyap.audio.table import AudioTable
+from pyap.playlist import Playlist, collation_key
+
+def audio(name, **tags):
+    return Audio(u'/playlist/%s.mp3' % name, **tags)
+
+class TestPlaylist(unittest.TestCase):
+    def test_collation_key(self):
+        self.assertEqual(collation_key(u'The Beatles'), u'beatles')
+        self.assertEqual(collation_key(u' a  Perfect Circle'),
+                         u'perfect circle')
+        self.assertEqual(collation_key(u'Theory'), u'theory')
+        self.assertEqual(collation_key(u'The'), u'the')
+        self.assertEqual(collation_key(None), u'')
+
+    def test_sort(self):
+        tracks = [
+            audio('1', artist=u'The Beatles', album=u'Abbey Road',
+                  year=u'1969', track=2, title=u'Something'),
+            audio('2', artist=u'beatles', album=u'Revolver', year=u'1966',
+                  track=1, title=u'Taxman'),
+            audio('3', artist=u'The Beatles', album=u'Abbey Road',
+                  year=u'1969', track=1, title=u'Come Together'),
+            audio('4', artist=u'Abba', album=u'Arrival', year=u'1976',
+                  track=1, title=u'When I Kissed the Teacher'),
+            audio('5', title=u'Untagged')
+        ]
+        playlist = Playlist(u'sort', list(tracks))
+        playlist.sort()
+        self.assertEqual([a.uri[-5] for a in playlist], list('54231'))
+
+        playlist.sort('title')
+        self.assertEqual([a.title for a in playlist],
+                         [u'Come Together', u'Something', u'Taxman',
+                          u'Untagged', u'When I Kissed the Teacher'])
+
+        # stable: equal keys keep their order
+        playlist.sort('album')
+        self.assertEqual([a.uri[-5] for a in playlist], list('53142'))
+        self.assertRaises(ValueError, playlist.sort, 'uri')
+
+        # cached keys don't outlive a change to the tags
+        tracks[3].artist = u'ZZ Top'
+        playlist.sort()
+        self.assertEqual(playlist[-1].uri[-5], '4')
+
+        # a playlist can hold an AudioTable
+        playlist = Playlist(u'table', AudioTable(tracks))
+        playlist.sort('title')
+        self.assertTrue(isinstance(playlist._audio_list, AudioTable))
+        self.assertEqual([a.uri[-5] for a in playlist], list('31254'))
+
+    def test_index(self):
+        a, b, c = audio('a', title=u'A'), audio('b', title=u'B'), \
+            audio('c', title=u'C')
+        playlist = Playlist(u'index')
+        playlist.extend([a, b, a])
+        self.assertTrue(a in playlist)
+        self.assertFalse(c in playlist)
+        # by uri, not by tags
+        self.assertTrue(audio('a', title=u'Other') in playlist)
+        self.assertEqual(playlist.index(a), 0)
+        self.assertEqual(playlist.count(a), 2)
+        self.assertRaises(ValueError, playlist.index, c)
+
+        playlist.append(c)
+        playlist[0] = c
+        self.assertEqual((playlist.index(a), playlist.count(c)), (2, 2))
+        playlist.remove(b)
+        self.assertEqual([x.title for x in playlist], [u'C', u'A', u'C'])
+        self.assertEqual((playlist.index(a), playlist.count(b)), (1, 0))
+        self.assertEqual(playlist.pop(), c)
+        self.assertEqual(playlist.count(c), 1)
+        playlist.reverse()
+        self.assertEqual(playlist.index(c), 1)
+        playlist.insert(0, b)
+        self.assertEqual(playlist.index(a), 1)
+
+        # so do lists handed to the playlist from outside
+        playlist._audio_list = [c, a]
+        self.assertEqual((playlist.index(a), playlist.count(b)), (1, 0))
+        playlist.clear()
+        self.assertFalse(a in playlist)
+        self.assertEqual(Playlist(u'fresh').count(a), 0)
+
+        # edits anywhere keep the index right, including ones that run out
+        # of room between two entries
+        tracks = [audio(str(i), title=u'%d' % i) for i in range(100)]
+        playlist = Playlist(u'edits', list(tracks))
+        for i in range(40):
+            playlist.insert(50, tracks[i])
+            playlist.move(0, 30)
+            del playlist[10]
+        uris = [track.uri for track in playlist]
+        for track in tracks:
+            if track.uri in uris:
+                self.assertEqual(playlist.index(track), uris.index(track.uri))
+            self.assertEqual(playlist.count(track), uris.count(track.uri))
+
+
+    def test_shuffle(self):
+        tracks = [audio(str(i), title=u'%d' % i) for i in range(50)]
+        playlist = Playlist(u'shuffle', list(tracks))
+        playlist.current_index = 10
+        playlist.set_shuffle(True, seed=1)
+        order = playlist.all_audio()
+        # starts from the current audio, and a seed gives the same order
+        self.assertTrue(order[0] is tracks[10])
+        self.assertEqual(sorted(order, key=tracks.index), tracks)
+        self.assertNotEqual(order, tracks)
+        other = Playlist(u'other', list(tracks))
+        other.current_index = 10
+        other.set_shuffle(True, seed=1)
+        self.assertEqual(other.all_audio(), order)
+
+        for i in range(5):
+            playlist.next()
+        current = playlist.all_audio()[playlist.current_index]
+        played = order[:5]
+
+        # edits leave the order of the rest and the current audio be
+        new = audio('new', title=u'new')
+        playlist.append(new)
+        shuffled = playlist.all_audio()
+        self.assertTrue(shuffled.index(new) > playlist.current_index)
+        del playlist[playlist.index(order[3])]
+        playlist.insert(0, audio('first', title=u'first'))
+        playlist.move(0, 20)
+        playlist.sort('title')
+        playlist.reverse()
+        shuffled = playlist.all_audio()
+        self.assertTrue(shuffled[playlist.current_index] is current)
+        self.assertEqual(shuffled[:4], played[:3] + played[4:])
+        self.assertEqual([a for a in shuffled if a in order],
+                         [a for a in order if a is not order[3]])
+
+        # the current audio stays current when shuffling stops
+        playlist.set_shuffle(False)
+        self.assertTrue(playlist[playlist.current_index] is current)
+        self.assertEqual(playlist.all_audio(), playlist[:])
+
+        # an AudioTable hands out new audio every time, which is no matter
+        table = Playlist(u'table', AudioTable(tracks))
+        table.current_index = 10
+        table.set_shuffle(True, seed=1)
+        uris = lambda audio_list: [audio.uri for audio in audio_list]
+        self.assertEqual(uris(table.all_audio()), uris(order))
+        table.next()
+        current = table.all_audio()[table.current_index].uri
+        del table[table.index(order[3])]
+        table[table.index(order[4])] = new
+        table.move(0, 30)
+        shuffled = uris(table.all_audio())
+        self.assertEqual(shuffled[table.current_index], current)
+        self.assertEqual(shuffled[:4], uris(order[:3]) + [new.uri])
+
+    def test_current_index(self):
+        a, b, c, d = [audio(name, title=name) for name in u'abcd']
+        playlist = Playlist(u'current', [a, b, c])
+        playlist.current_index = 1
+        playlist.insert(0, d)
+        self.assertTrue(playlist.peek_next() is c)
+        playlist.move(2, 0)
+        self.assertEqual(playlist.current_index, 0)
+        del playlist[2]
+        self.assertTrue(playlist.next() is d)
+        playlist.reverse()
+        self.assertEqual(playlist.current_index, 1)
+        playlist.pop(0)
+        self.assertTrue(playlist[playlist.current_index] is d)
+
+
 if __name__ == '__main__':
     unittest.main()
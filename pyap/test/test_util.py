@@ -21,6 +21,10 @@
 # Boston, MA 02111-1307, USA.
 
 import unittest
+import os
+import shutil
+import tempfile
+import threading
 
 from pyap.util import *
 
@@ -42,6 +46,75 @@ class TestUtil(unittest.TestCase):
         uri = "file"
         self.assertRaises(ValueError, get_extension, uri)
 
+    def test_formats(self):
+        self.assertTrue(is_audio("mp3"))
+        self.assertTrue(is_audio("FLAC"))
+        self.assertFalse(is_audio("m3u"))
+        self.assertFalse(is_audio(None))
+        self.assertTrue(is_playlist("M3U"))
+        self.assertEqual(get_format("m4a"), "aac")
+        self.assertEqual(get_format("txt"), "unknown")
+
+        registry = FormatRegistry(extensions, signatures)
+        registry.register("audio", "wave", ["wav"], [(8, b"WAVE")])
+        self.assertEqual(registry.lookup("WAV"), ("audio", "wave"))
+        self.assertTrue("wav" in registry.extensions("audio"))
+        self.assertEqual(formats.lookup("wav"), None)
+
+        directory = tempfile.mkdtemp()
+        try:
+            uri = os.path.join(directory, 'track.txt')
+            shutil.copy(os.path.join('resources', 'test.mp3'), uri)
+            self.assertEqual(registry.sniff(uri), ("audio", "mp3"))
+            self.assertEqual(registry.classify(uri), None)
+            self.assertEqual(registry.classify(uri, sniff=True),
+                             ("audio", "mp3"))
+
+            uri = os.path.join(directory, 'track')
+            header = open(uri, 'wb')
+            header.write(b"RIFF\x00\x00\x00\x00WAVEfmt ")
+            header.close()
+            self.assertEqual(registry.classify(uri, sniff=True),
+                             ("audio", "wave"))
+            self.assertEqual(formats.classify(uri, sniff=True), None)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_iter_files(self):
+        root = tempfile.mkdtemp()
+        other = tempfile.mkdtemp()
+        try:
+            for path in ('a.mp3', 'b.txt', '.c.mp3', 'sub/d.MP3',
+                         'sub/deep/e.ogg', '.hidden/f.mp3'):
+                path = os.path.join(root, path)
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                open(path, 'w').close()
+            open(os.path.join(other, 'g.mp3'), 'w').close()
+            os.symlink(other, os.path.join(root, 'link'))
+            os.symlink(root, os.path.join(other, 'loop'))
+
+            def found(**kwargs):
+                return sorted(os.path.relpath(path, root)
+                              for path in iter_files(root, **kwargs))
+
+            self.assertEqual(found(), ['a.mp3', 'sub/d.MP3', 'sub/deep/e.ogg'])
+            self.assertEqual(found(max_depth=1), ['a.mp3', 'sub/d.MP3'])
+            self.assertEqual(found(hidden=True, max_depth=0),
+                             ['.c.mp3', 'a.mp3'])
+            self.assertEqual(found(follow_symlinks=True),
+                             ['a.mp3', 'link/g.mp3', 'sub/d.MP3',
+                              'sub/deep/e.ogg'])
+            self.assertEqual(found(extensions=set(['ogg'])),
+                             ['sub/deep/e.ogg'])
+
+            cancel = threading.Event()
+            cancel.set()
+            self.assertEqual(found(cancel=cancel), [])
+        finally:
+            shutil.rmtree(root)
+            shutil.rmtree(other)
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(TestUtil))
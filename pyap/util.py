@@ -20,9 +20,14 @@
 # Free Software Foundation, Inc., 59 Temple Place - Suite 330,
 # Boston, MA 02111-1307, USA.
 
-import re
 import os
 
+try:
+    from os import scandir
+except ImportError:
+    # python < 3.5 needs the scandir backport
+    from scandir import scandir
+
 class EventGenerator(object):
     def __init__(self):
         self.events = {}
@@ -58,13 +63,17 @@ class Event(object):
         for listener in self.listeners:
             listener(*args, **kwargs)
 
-ext_regex = re.compile(r"^.+\.(.+)$")
+def fingerprint(uri):
+    """ Returns the (mtime, size, inode) of a file, which changes whenever
+        the file is rewritten """
+    stat = os.stat(uri)
+    return (stat.st_mtime, stat.st_size, stat.st_ino)
+
 def get_extension(uri):
-    if uri.find(os.sep):
-        uri = os.path.split(uri)[1]
-    match = ext_regex.match(uri)
-    if match is not None:
-        return match.group(1)
+    name = os.path.basename(uri)
+    dot = name.rfind('.')
+    if 0 < dot < len(name) - 1:
+        return name[dot+1:]
     return None
 
 extensions = {
@@ -86,21 +95,202 @@ extensions = {
     }
 }
 
+# how many bytes from the start of a file sniffing looks at
+SNIFF_SIZE = 512
+
+def _is_mpeg_frame(header):
+    # an MPEG audio frame sync with a layer set; layer 0 is ADTS AAC
+    return (len(header) > 1 and ord(header[0:1]) == 0xff and
+            ord(header[1:2]) & 0xe0 == 0xe0 and ord(header[1:2]) & 0x06 != 0)
+
+def _is_adts_frame(header):
+    return (len(header) > 1 and ord(header[0:1]) == 0xff and
+            ord(header[1:2]) & 0xf6 == 0xf0)
+
+# (offset, magic bytes) prefixes, or functions of the header, that
+# identify a format from a file's content
+signatures = {
+    "asf":          [(0, b"\x30\x26\xb2\x75\x8e\x66\xcf\x11")],
+    "flac":         [(0, b"fLaC")],
+    "aac":          [(4, b"ftyp"), _is_adts_frame],
+    "monkeysaudio": [(0, b"MAC ")],
+    "mp3":          [(0, b"ID3"), _is_mpeg_frame],
+    "musepack":     [(0, b"MPCK"), (0, b"MP+")],
+    "ogg":          [(0, b"OggS")],
+    "trueaudio":    [(0, b"TTA1")],
+    "wavpack":      [(0, b"wvpk")],
+    "optimfrog":    [(0, b"OFR ")],
+    "m3u":          [(0, b"#EXTM3U")],
+    "pls":          [(0, b"[playlist]")]
+}
+
+class FormatRegistry(object):
+    """ A flat, case-insensitive map of file extension to (file type,
+        format), built once so lookups don't have to search every format.
+        Formats can also be told apart by content, see sniff """
+    def __init__(self, extensions=None, signatures=None):
+        self._formats = {}
+        self._extensions = {}
+        self._signatures = []
+        for file_type in (extensions or {}):
+            for format in extensions[file_type]:
+                self.register(file_type, format, extensions[file_type][format],
+                              (signatures or {}).get(format, ()))
+
+    def register(self, file_type, format, format_extensions, signatures=()):
+        """ Adds (or extends) a format. signatures are (offset, magic bytes)
+            pairs or functions taking the first SNIFF_SIZE bytes of a file
+            and returning whether it's in this format """
+        format_extensions = set(ext.lower() for ext in format_extensions)
+        for ext in format_extensions:
+            self._formats[ext] = (file_type, format)
+        self._extensions.setdefault(file_type, set()).update(format_extensions)
+        for signature in signatures:
+            self._signatures.append((signature, file_type, format))
+
+    def lookup(self, ext):
+        """ Returns the (file type, format) of an extension, or None """
+        if not ext:
+            return None
+        return self._formats.get(ext.lower())
+
+    def extensions(self, file_type):
+        """ Returns the set of extensions of a file type. Don't modify it,
+            use register instead """
+        return self._extensions.get(file_type, set())
+
+    def sniff(self, uri, size=SNIFF_SIZE):
+        """ Returns the (file type, format) of a file going by its first
+            size bytes only, or None if no signature matches """
+        file = open(uri, 'rb')
+        try:
+            header = file.read(size)
+        finally:
+            file.close()
+        for signature, file_type, format in self._signatures:
+            if callable(signature):
+                if signature(header):
+                    return (file_type, format)
+            else:
+                offset, magic = signature
+                if header[offset:offset+len(magic)] == magic:
+                    return (file_type, format)
+        return None
+
+    def classify(self, uri, sniff=False):
+        """ Returns the (file type, format) of a file, or None. With sniff
+            the content decides, which catches wrong or missing extensions;
+            the extension is still used for files that can't be read or
+            aren't recognised """
+        if sniff:
+            try:
+                result = self.sniff(uri)
+            except IOError:
+                result = None
+            if result is not None:
+                return result
+        return self.lookup(get_extension(uri))
+
+formats = FormatRegistry(extensions, signatures)
+
+def register_format(file_type, format, format_extensions, signatures=()):
+    formats.register(file_type, format, format_extensions, signatures)
+    extensions.setdefault(file_type, {}).setdefault(format, set()).update(
+        format_extensions)
+
 def is_audio(ext):
-    for audio_format in extensions["audio"]:
-        if ext in extensions["audio"][audio_format]:
-            return True
-    return False
+    result = formats.lookup(ext)
+    return result is not None and result[0] == "audio"
+
+def audio_extensions():
+    return formats.extensions("audio")
 
 def is_playlist(ext):
-    for playlist_format in extensions["playlist"]:
-        if ext in extensions["playlist"][playlist_format]:
-            return True
-    return False
+    result = formats.lookup(ext)
+    return result is not None and result[0] == "playlist"
 
 def get_format(ext):
-    for file_type in extensions:
-        for format in extensions[file_type]:
-            if ext in extensions[file_type][format]:
-                return format
-    return "unknown"
\ No newline at end of file
+    result = formats.lookup(ext)
+    if result is None:
+        return "unknown"
+    return result[1]
+
+def iter_files(roots, extensions=None, follow_symlinks=False, hidden=False,
+               max_depth=None, cancel=None):
+    """ Walks one or more directories with scandir and yields the path of
+        every file with one of the given extensions (any audio extension
+        by default). Files are picked by name alone, so nothing is opened
+        or stat'ed along the way. Symlinked directories are only entered
+        with follow_symlinks, hidden files and directories are skipped
+        unless hidden is set, max_depth limits how many levels below each
+        root are walked (0 is the root alone) and setting cancel, a
+        threading.Event, stops the walk """
+    if isinstance(roots, basestring):
+        roots = [roots]
+    if extensions is None:
+        extensions = audio_extensions()
+
+    visited = set()
+    stack = [(root, 0) for root in reversed(roots)]
+    while stack:
+        if cancel is not None and cancel.is_set():
+            return
+        directory, depth = stack.pop()
+        try:
+            if follow_symlinks:
+                # guard against symlink loops
+                stat = os.stat(directory)
+                if (stat.st_dev, stat.st_ino) in visited:
+                    continue
+                visited.add((stat.st_dev, stat.st_ino))
+            entries = list(scandir(directory))
+        except OSError:
+            continue
+
+        subdirectories = []
+        for entry in entries:
+            name = entry.name
+            if not hidden and name.startswith('.'):
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=follow_symlinks):
+                    if max_depth is None or depth < max_depth:
+                        subdirectories.append((entry.path, depth + 1))
+                    continue
+                dot = name.rfind('.')
+                if (dot > 0 and name[dot+1:].lower() in extensions and
+                    entry.is_file()):
+                    yield entry.path
+            except OSError:
+                continue
+        stack.extend(reversed(subdirectories))
+
+
+def iter_pool(job, items, workers=None, threads=False, ordered=True,
+              chunksize=16):
+    """ Yields job(item) for each of items, computed in a pool of worker
+        processes (or threads). job has to be a module-level function for
+        processes and shouldn't raise. Results come back in the order of
+        items if ordered is set, otherwise as they complete.
+        workers=None uses one worker per CPU, 0 runs inline """
+    if workers == 0:
+        for item in items:
+            yield job(item)
+        return
+
+    if threads:
+        from multiprocessing.pool import ThreadPool as Pool
+    else:
+        from multiprocessing import Pool
+    pool = Pool(workers)
+    try:
+        if ordered:
+            results = pool.imap(job, items, chunksize)
+        else:
+            results = pool.imap_unordered(job, items, chunksize)
+        for result in results:
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
@@ -7,5 +7,5 @@ setup(name='Pyap',
       description='Python Audio Player Library',
       author='Joel Griffith',
       packages=find_packages(),
-      requires=['mutagen', 'pygst', 'sqlalchemy']
+      requires=['mutagen', 'pygst', 'sqlalchemy', 'scandir']
 )